@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+"""Compare wildcard factoid lookups through the in-memory WildcardMatcher
+with the old reversed-LIKE table scan, against an in-memory SQLite database.
+
+Usage: benchmark-factoid-wildcards.py [names ...]
+"""
+
+import random
+import sys
+from time import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import ibid
+from ibid.db import metadata
+import ibid.db.models
+from ibid.plugins.factoid import Factoid, FactoidName, FactoidValue, \
+                                 WildcardMatcher
+
+words = [u'weather', u'in', u'the', u'what', u'is', u'time', u'for', u'who',
+         u'karma', u'of', u'tell', u'me', u'about', u'why', u'does', u'foo']
+
+def random_name(i):
+    parts = random.sample(words, random.randint(1, 4))
+    parts.insert(random.randint(0, len(parts)), u'$arg')
+    parts.append(unicode(i))
+    return u' '.join(parts)
+
+def populate(session, count):
+    for i in xrange(count):
+        factoid = Factoid()
+        factoid.names.append(FactoidName(random_name(i), None))
+        factoid.values.append(FactoidValue(u'is value %i' % i, None))
+        session.add(factoid)
+        if i % 1000 == 999:
+            session.flush()
+    session.commit()
+
+def like_lookup(session, name):
+    return session.query(FactoidName.id).filter(
+            'lower(:fact) LIKE lower(name) ESCAPE :escape'
+        ).params(fact=name, escape='\\').all()
+
+def benchmark(count, queries=200):
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    populate(session, count)
+
+    names = [random_name(random.randint(0, count)).replace(u'$arg', u'x y')
+             for i in xrange(queries)]
+
+    start = time()
+    for name in names:
+        like_lookup(session, name)
+    like = (time() - start) / queries
+
+    matcher = WildcardMatcher()
+    start = time()
+    matcher.load(session)
+    load = time() - start
+
+    start = time()
+    for name in names:
+        matcher.match(name)
+    match = (time() - start) / queries
+
+    print u'%7i names: LIKE %8.3fms  matcher %8.3fms  (index load %.2fs)' % (
+            count, like * 1000, match * 1000, load)
+    session.close()
+
+def main():
+    ibid.config = {u'plugins': {}}
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    for count in counts:
+        benchmark(count)
+
+if __name__ == '__main__':
+    main()
+
+# vi: set et sta sw=4 ts=4:
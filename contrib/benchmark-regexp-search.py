@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+"""Compare regex searches of factoid values through the old REGEXP function
+(re.search() for every row) with the cached SQLRegexp and the LIKE
+prefilter added by get_regexp_op(), against an in-memory SQLite database.
+
+Usage: benchmark-regexp-search.py [number of values]
+"""
+
+import random
+import re
+import sys
+from datetime import datetime
+from time import time
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+import ibid
+from ibid.core import sqlite_creator
+from ibid.db import metadata, get_regexp_op
+from ibid.db.regexp import sql_regexp
+import ibid.db.models
+from ibid.plugins.factoid import FactoidValue
+
+words = [u'weather', u'in', u'the', u'what', u'is', u'time', u'for', u'who',
+         u'karma', u'of', u'tell', u'me', u'about', u'why', u'does', u'foo',
+         u'http://example.com/', u'<reply>', u'<action>', u'$who', u'bar']
+
+patterns = [u'example\\.com/[a-z]+', u'^<reply>.*karma', u'\\bweather\\b',
+            u'foo (bar|baz)', u'(time|what)s? is']
+
+def old_regexp(pattern, item):
+    return re.search(pattern, item, re.I) and True or False
+
+def populate(engine, count):
+    now = datetime.utcnow()
+    table = FactoidValue.__table__
+    for start in xrange(0, count, 10000):
+        engine.execute(table.insert(), [{
+                'value': u' '.join(random.sample(words, 6)),
+                'factoid_id': i % 1000, 'time': now}
+            for i in xrange(start, min(start + 10000, count))])
+
+def search(session, op, pattern):
+    start = time()
+    count = session.query(func.count(FactoidValue.id)) \
+            .filter(op(FactoidValue.value, pattern)).scalar()
+    return time() - start, count
+
+def benchmark(count):
+    engine = create_engine('sqlite:///', creator=sqlite_creator(':memory:'))
+    metadata.create_all(engine)
+    populate(engine, count)
+    session = sessionmaker(bind=engine)()
+    connection = session.connection().connection
+
+    old_op = lambda x, y: x.op('REGEXP')(y)
+    new_op = get_regexp_op(session)
+    for pattern in patterns:
+        connection.create_function('regexp', 2, old_regexp)
+        old, old_count = search(session, old_op, pattern)
+        connection.create_function('regexp', 2, sql_regexp)
+        new, new_count = search(session, new_op, pattern)
+        assert old_count == new_count
+        print u'%-24s %7i matches: old %7.3fs  new %7.3fs' % (
+                pattern, new_count, old, new)
+    session.close()
+
+def main():
+    ibid.config = {}
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 1000000
+    benchmark(count)
+
+if __name__ == '__main__':
+    main()
+
+# vi: set et sta sw=4 ts=4:
@@ -83,6 +83,8 @@ sources = InsensitiveDict()
 config = {}
 dispatcher = None
 processors = []
+dispatch_index = None
+scheduler = None
 categories = {}
 reloader = None
 databases = {}
@@ -2,32 +2,377 @@
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
 from cgi import parse_qs
+from collections import deque
+from datetime import datetime
+from heapq import heappush, heappop
 import inspect
 import re
 import logging
+from random import uniform
 import socket
 from os.path import join, expanduser
+from threading import Lock, currentThread, local
+from time import time
 
-from twisted.internet import reactor, threads
+from twisted.internet import defer, reactor, threads
+from twisted.internet.error import ConnectError, TimeoutError
+from twisted.python.threadpool import ThreadPool
 from twisted.python.modules import getModule
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import SingletonThreadPool
 from sqlalchemy.exceptions import IntegrityError
 
 import ibid
+from ibid.compat import defaultdict
 from ibid.event import Event
 from ibid.db import SchemaVersionException, schema_version_check
+from ibid.db.regexp import sql_regexp
 from ibid.utils import JSONException
 
 import auth
 
+# Flag set on the code objects of generator functions
+CO_GENERATOR = 0x20
+
+class DispatchQueues(object):
+    """Runs events through function on a dedicated thread pool.
+
+    Events are queued per source and channel. Each queue is processed in
+    order, one event at a time, so replies are never re-ordered. Queues that
+    reach their high-water mark drop new events, and events of coalesced
+    types (e.g. clock ticks) are discarded if one is already waiting.
+
+    If function returns a callable, rather than a result, it is called in
+    the reactor thread, and must return a Deferred. That fires with another
+    function to continue processing the event in the pool. The thread is
+    free in the meantime, but the event's queue waits for it.
+    """
+
+    def __init__(self, function, threads=10, limit=100, coalesce=(u'clock',)):
+        self.log = logging.getLogger('core.dispatcher.queues')
+        self.function = function
+        self.limit = limit
+        self.coalesce = coalesce
+        self.pool = ThreadPool(0, threads, 'dispatcher')
+        self.started = self.stopping = False
+        self.lock = Lock()
+        self.queues = {}
+        self.running = set()
+        self.counts = defaultdict(int)
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        if not self.started and not self.stopping:
+            self.started = True
+            self.pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          self._stop_pool)
+
+    def stop(self):
+        "Stop the thread pool, once all queued events have been processed"
+        self.lock.acquire()
+        try:
+            self.stopping = True
+            idle = not self.running
+        finally:
+            self.lock.release()
+
+        if idle:
+            self._stop_pool()
+
+    def _stop_pool(self):
+        if self.started:
+            self.started = False
+            self.pool.stop()
+
+    def put(self, event):
+        """Queue event for processing. Must be called from the reactor thread.
+        Returns a Deferred that fires with the processed event.
+        """
+        self.start()
+        key = (event.source, event.get('channel', None))
+
+        self.lock.acquire()
+        try:
+            queue = self.queues.setdefault(key, deque())
+            if event.type in self.coalesce and [True for waiting, _, _ in queue
+                                                if waiting.type == event.type]:
+                self.counts['coalesced'] += 1
+                self.log.debug(u'Coalesced %s event from %s', event.type, key)
+                return defer.succeed(event)
+
+            if len(queue) >= self.limit:
+                self.counts['dropped'] += 1
+                self.log.warning(u'Dispatch queue for %s is full (%i events). '
+                                 u'Dropping %s event.',
+                                 key, len(queue), event.type)
+                return defer.succeed(event)
+
+            result = defer.Deferred()
+            queue.append((event, result, time()))
+            self.counts['queued'] += 1
+            self.max_depth = max(self.max_depth, len(queue))
+            if key not in self.running:
+                self._next(key)
+        finally:
+            self.lock.release()
+
+        return result
+
+    def _next(self, key):
+        "Start processing the next event in key's queue. Hold the lock."
+        event, result, queued = self.queues[key].popleft()
+        wait = time() - queued
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.running.add(key)
+        self._call(key, result, self.function, event)
+
+    def _call(self, key, result, function, *args):
+        self.pool.callInThreadWithCallback(
+                lambda success, value: reactor.callFromThread(
+                    self._finished, key, result, success, value),
+                function, *args)
+
+    def _finished(self, key, result, success, value):
+        if success and callable(value):
+            waiting = defer.maybeDeferred(value)
+            waiting.addCallback(lambda resume: self._call(key, result, resume))
+            waiting.addErrback(lambda failure:
+                    self._finished(key, result, False, failure))
+            return
+
+        self.lock.acquire()
+        try:
+            self.counts['processed'] += 1
+            self.running.discard(key)
+            if self.queues.get(key):
+                self._next(key)
+            else:
+                self.queues.pop(key, None)
+            idle = not self.running
+        finally:
+            self.lock.release()
+
+        if self.stopping and idle:
+            self._stop_pool()
+
+        if success:
+            result.callback(value)
+        else:
+            result.errback(value)
+
+    def stats(self):
+        """Return a dict of queue metrics: event counts, current and maximum
+        queue depths, and average and maximum wait times in seconds.
+        """
+        self.lock.acquire()
+        try:
+            started = self.counts['processed'] + len(self.running)
+            return {
+                'queued': self.counts['queued'],
+                'processed': self.counts['processed'],
+                'dropped': self.counts['dropped'],
+                'coalesced': self.counts['coalesced'],
+                'waiting': sum(len(queue) for queue in self.queues.values()),
+                'running': len(self.running),
+                'queues': len(self.queues),
+                'max_depth': self.max_depth,
+                'wait_avg': started and self.wait_total / started or 0.0,
+                'wait_max': self.wait_max,
+            }
+        finally:
+            self.lock.release()
+
+class PeriodicScheduler(object):
+    """Runs the @periodic handlers of the loaded processors when they are due,
+    on a dedicated thread pool of up to threads threads.
+
+    Handlers are kept in a heap keyed by the time they are next due, so the
+    scheduler only wakes up when there's something to do. Each run gets a
+    fresh clock event from source. Afterwards, its session is committed and
+    its responses are sent, without passing it through the processors.
+    Up to jitter seconds (but no more than a tenth of the interval) are
+    added to each run, to spread load.
+    """
+
+    def __init__(self, source, threads=4, jitter=5):
+        self.log = logging.getLogger('core.scheduler')
+        self.source = source
+        self.jitter = jitter
+        self.pool = ThreadPool(0, threads, 'periodic')
+        self.heap = []
+        self.scheduled = {}
+        self.running = set()
+        self.call = None
+        self.started = False
+        self.sequence = 0
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+            self.rebuild(ibid.processors)
+
+    def stop(self):
+        if self.started:
+            self.started = False
+            if self.call is not None and self.call.active():
+                self.call.cancel()
+            self.call = None
+            self.pool.stop()
+
+    def rebuild(self, processors):
+        "Reschedule the periodic handlers of processors. Thread-safe."
+        reactor.callFromThread(self._rebuild, list(processors))
+
+    def _rebuild(self, processors):
+        if not self.started:
+            return
+
+        now = time()
+        scheduled = {}
+        self.heap = []
+        for processor in processors:
+            for method in processor._get_periodic_handlers():
+                if method.interval.seconds <= 0 or method.disabled:
+                    continue
+                key = (processor, method.__name__)
+                if key in self.scheduled:
+                    due = self.scheduled[key]
+                else:
+                    delay = method.initial_delay or method.interval
+                    due = now + delay.seconds + self._jitter(method)
+                scheduled[key] = due
+                if key not in self.running:
+                    self._push(due, key)
+
+        self.scheduled = scheduled
+        self._schedule()
+
+    def _jitter(self, method):
+        return uniform(0, min(self.jitter, method.interval.seconds / 10.0))
+
+    def _push(self, due, key):
+        self.sequence += 1
+        heappush(self.heap, (due, self.sequence, key))
+
+    def _schedule(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        if self.heap and self.started:
+            self.call = reactor.callLater(max(0, self.heap[0][0] - time()),
+                                          self._wake)
+
+    def _wake(self):
+        self.call = None
+        now = time()
+        while self.heap and self.heap[0][0] <= now:
+            due, _, key = heappop(self.heap)
+            if self.scheduled.get(key) != due or key in self.running:
+                # Stale entry, left over from a rebuild
+                continue
+            self.running.add(key)
+            self.pool.callInThreadWithCallback(
+                    lambda success, value, key=key: reactor.callFromThread(
+                        self._finished, key),
+                    self._run, *key)
+        self._schedule()
+
+    def _finished(self, key):
+        self.running.discard(key)
+        if key not in self.scheduled:
+            # Unloaded while running
+            return
+
+        processor, name = key
+        method = getattr(processor, name)
+        due = max(self.scheduled[key] + method.interval.seconds, time()) \
+                + self._jitter(method)
+        self.scheduled[key] = due
+        self._push(due, key)
+        self._schedule()
+
+    def _run(self, processor, name):
+        "Run a periodic handler. Called in a pool thread."
+        method = getattr(processor, name)
+        if method.disabled or not method.lock.acquire(0):
+            return
+
+        try:
+            event = Event(self.source, u'clock')
+            event.time = datetime.utcnow()
+            method.im_func.initial_delay = None
+            method.im_func.last_called = event.time
+            name = u'%s.%s' % (processor.__class__.__name__, name)
+            try:
+                self.log.debug(u'Running periodic event: %s', name)
+                method(event)
+                if method.failing:
+                    self.log.info(u'No longer failing: %s', name)
+                    method.im_func.failing = False
+            except:
+                if not method.failing:
+                    self.log.exception(u'Periodic method failing: %s', name)
+                    method.im_func.failing = True
+                else:
+                    self.log.debug(u'Still failing: %s', name)
+                if 'session' in event:
+                    # Closing rolls back all its changes
+                    event['session'].close()
+                    del event['session']
+                return
+
+            # Clock events don't go through the processors
+            ibid.dispatcher._commit(event)
+            for response in event.responses:
+                if response['source'] != event.source:
+                    ibid.dispatcher.send(response)
+        finally:
+            method.lock.release()
+
+def unit_of_work():
+    """Whether the dispatcher is configured to commit each event's changes
+    once, after its last processor, with a savepoint for each processor"""
+    return ibid.config.get('dispatcher', {}).get('unit_of_work', False) \
+            in (True, 'True', 'true')
+
 class Dispatcher(object):
 
     def __init__(self):
         self.log = logging.getLogger('core.dispatcher')
-
-    def _process(self, event):
-        for processor in ibid.processors:
+        config = ibid.config.get('dispatcher', {})
+        self.queues = DispatchQueues(self._process,
+                threads=int(config.get('threads', 10)),
+                limit=int(config.get('queue_limit', 100)),
+                coalesce=config.get('coalesce', (u'clock',)))
+        self.unit_of_work = unit_of_work()
+
+    def _process(self, event, processors=None):
+        """Run event through processors (by default, all of them).
+        If asynchronous handlers matched, return a function to call in the
+        reactor thread, which returns a Deferred that fires with a function
+        to finish processing the event. Otherwise, return the event.
+        """
+        index = ibid.dispatch_index
+        if processors is None:
+            if index is not None:
+                index.start(event)
+            processors = list(ibid.processors)
+        else:
+            processors = list(processors)
+
+        while processors:
+            processor = processors.pop(0)
+            if index is not None and not index.accepts(processor, event):
+                continue
+            if 'session' in event:
+                event['session'].used = False
             try:
                 processor.process(event)
             except Exception, e:
@@ -37,27 +382,32 @@ class Dispatcher(object):
                         processor.__class__.__name__,
                         processor.name,
                         event)
-                event.complain = isinstance(e, (IOError, socket.error, JSONException)) and u'network' or u'exception'
-                event.processed = True
+                self._complain(event, e)
+                if 'session' in event and event['session'].used:
+                    self._discard(event)
+            else:
                 if 'session' in event:
-                    event.session.rollback()
-                    event.session.close()
-                    del event['session']
-
-            if 'session' in event and (event.session.dirty or event.session.deleted):
-                try:
-                    event.session.commit()
-                except IntegrityError:
-                    self.log.exception(u"Exception occured committing session from the %s processor of %s plugin",
-                            processor.__class__.__name__, processor.name)
-                    event.complain = u'exception'
-                    event.session.rollback()
-                    event.session.close()
-                    del event['session']
-
-        if 'session' in event:
-            event.session.close()
-            del event['session']
+                    try:
+                        event['session'].release()
+                    except IntegrityError:
+                        self.log.exception(u'Exception occured committing '
+                                u'session from the %s processor of %s plugin',
+                                processor.__class__.__name__, processor.name)
+                        event.complain = u'exception'
+                        self._discard(event)
+
+            if event.get('asynchronous'):
+                calls = event.asynchronous
+                del event['asynchronous']
+                # The rest of the processing may be in another thread
+                self._commit(event)
+                return lambda: self._call_asynchronous(event, processor,
+                                                       calls, processors)
+
+        self._commit(event)
+
+        if index is not None:
+            index.finish(event)
 
         log_level = logging.DEBUG
         if event.type == u'clock' and not event.processed:
@@ -76,6 +426,74 @@ class Dispatcher(object):
 
         return event
 
+    def _process_blocking(self, event):
+        "Process event, waiting for any asynchronous handlers to finish"
+        result = self._process(event)
+        while callable(result):
+            result = threads.blockingCallFromThread(reactor, result)()
+        return result
+
+    def _discard(self, event):
+        """Roll back the changes made by the processor that has just failed.
+        Without savepoints, they can't be told apart from earlier processors'.
+        """
+        session = event['session']
+        if session.deferred:
+            session.discard()
+        else:
+            session.rollback()
+            session.close()
+            del event['session']
+
+    def _commit(self, event):
+        "Commit the changes made while processing event, and close its session"
+        if 'session' not in event:
+            return
+        session = event['session']
+        del event['session']
+        try:
+            try:
+                session.finish()
+            except IntegrityError:
+                self.log.exception(u'Exception occured committing session '
+                                   u'for event %s', event)
+                event.complain = u'exception'
+        finally:
+            session.close()
+
+    def _complain(self, event, exception):
+        if isinstance(exception, (IOError, socket.error, JSONException,
+                                  ConnectError, TimeoutError)):
+            event.complain = u'network'
+        else:
+            event.complain = u'exception'
+        event.processed = True
+
+    def _call_asynchronous(self, event, processor, calls, processors):
+        """Call a processor's asynchronous handlers, in the reactor thread.
+        Return a Deferred that fires with a function to process the event
+        through the remaining processors, once they have all finished.
+        """
+        deferreds = []
+        for method, args in calls:
+            if method.im_func.func_code.co_flags & CO_GENERATOR:
+                d = defer.inlineCallbacks(method.im_func)(method.im_self,
+                                                          event, *args)
+            else:
+                d = defer.maybeDeferred(method, event, *args)
+            d.addErrback(self._asynchronous_failed, processor, event)
+            deferreds.append(d)
+
+        return defer.DeferredList(deferreds).addCallback(
+                lambda results: lambda: self._process(event, processors))
+
+    def _asynchronous_failed(self, failure, processor, event):
+        self.log.error(u'Exception occured in %s processor of %s plugin.\n'
+                       u'Event: %s\n%s',
+                       processor.__class__.__name__, processor.name, event,
+                       failure.getTraceback())
+        self._complain(event, failure.value)
+
     def send(self, response):
         source = response['source']
         if source in ibid.sources:
@@ -90,7 +508,11 @@ class Dispatcher(object):
             log_level -= 5
         self.log.log(log_level, u"Received event from %s source", event.source)
 
-        return threads.deferToThread(self._process, event)
+        return self.queues.put(event)
+
+    def shutdown(self):
+        "Stop the dispatcher thread pool, once queued events are processed"
+        self.queues.stop()
 
     def call_later(self, delay, callable, oldevent, *args, **kw):
         "Run callable after delay seconds. Pass args and kw to it"
@@ -105,7 +527,7 @@ class Dispatcher(object):
         # Twisted doesn't catch exceptions here, so we must do it ourselves
         try:
             callable(event, *args, **kw)
-            self._process(event)
+            self._process_blocking(event)
             reactor.callFromThread(self.delayed_response, event)
         except:
             self.log.exception(u'Call Later')
@@ -114,6 +536,188 @@ class Dispatcher(object):
         for response in event.responses:
             ibid.sources[event.source].send(response)
 
+_literal_chars = frozenset(u'abcdefghijklmnopqrstuvwxyz0123456789 _-:,!\'"/@%&=<>~`;')
+_inline_flags = re.compile(r'\(\?[iLmsux]+\)')
+
+def literal_prefix(regex):
+    """Return the (lower-case) literal text that every match of regex must
+    start with, or None if it can't be determined.
+    Only patterns anchored with ^, and without top-level alternation, have
+    prefixes.
+    """
+    if not isinstance(regex, basestring) or not regex.startswith(u'^') \
+            or _inline_flags.search(regex):
+        return None
+
+    depth = 0
+    escaped = inclass = False
+    for i, char in enumerate(regex):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif inclass:
+            if char == ']' and regex[i-1] != '[' and regex[i-2:i] != '[^':
+                inclass = False
+        elif char == '[':
+            inclass = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return None
+
+    prefix = []
+    i = 1
+    while i < len(regex):
+        char = regex[i]
+        if (char == '\\' and i + 1 < len(regex) and ord(regex[i+1]) < 128
+                and not regex[i+1].isalnum()):
+            literal, step = regex[i+1], 2
+        elif char.lower() in _literal_chars:
+            literal, step = char.lower(), 1
+        else:
+            break
+        if regex[i+step:i+step+1] in ('?', '*', '{'):
+            break
+        prefix.append(literal)
+        i += step
+
+    return prefix and u''.join(prefix) or None
+
+class DispatchIndex(object):
+    """Pre-computed dispatch information for the loaded processors.
+
+    Processors that can't accept an event (by event type, addressed and
+    processed flags) are skipped without being called, and @match handlers
+    whose patterns start with literal text are only regex-tested against
+    messages starting with that text.
+    """
+
+    def __init__(self, processors=()):
+        self.log = logging.getLogger('core.dispatch_index')
+        self._filters = {}
+        self._prefixes = {}
+        self._trie = {}
+        self._depth = 0
+        self._local = local()
+        self._stats_lock = Lock()
+        # event type: [events, processors, regexes tested, regexes skipped]
+        self._stats = defaultdict(lambda: [0, 0, 0, 0])
+
+        for processor in processors:
+            self.add(processor)
+
+    def add(self, processor):
+        "Index processor's filters and handler patterns"
+        base_process = ibid.plugins.Processor.process.im_func
+        process = getattr(type(processor), 'process', None)
+        if getattr(process, 'im_func', None) is base_process:
+            self._filters[processor] = (frozenset(processor.event_types),
+                    processor.addressed, processor.processed)
+        else:
+            # Custom process() functions see every event
+            self._filters[processor] = None
+
+        for method in processor._get_event_handlers():
+            pattern = getattr(method, 'pattern', None)
+            prefix = pattern is not None and literal_prefix(pattern.pattern)
+            if prefix:
+                node = self._trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                node.setdefault(None, set()).add(method.im_func)
+                self._prefixes[method.im_func] = prefix
+                self._depth = max(self._depth, len(prefix))
+
+    def _reset(self):
+        self._local.candidates = {}
+        self._local.counts = [0, 0, 0]
+
+    def start(self, event):
+        "Prepare to count candidates for event"
+        self._reset()
+
+    def finish(self, event):
+        "Record the candidate counts for event"
+        counts = getattr(self._local, 'counts', None)
+        if counts is None:
+            return
+        self._stats_lock.acquire()
+        try:
+            stats = self._stats[event.type]
+            stats[0] += 1
+            for i, count in enumerate(counts):
+                stats[i+1] += count
+        finally:
+            self._stats_lock.release()
+
+    def accepts(self, processor, event):
+        "Could processor do anything with event at this point in the chain?"
+        if processor in self._filters and self._filters[processor] is not None:
+            types, addressed, processed = self._filters[processor]
+            if event.type not in types:
+                return False
+            if addressed and not event.get('addressed', False):
+                return False
+            if not processed and event.processed:
+                return False
+
+        if hasattr(self._local, 'counts'):
+            self._local.counts[0] += 1
+        return True
+
+    def candidates(self, text):
+        "Return the set of indexed handler functions that text could match"
+        if not hasattr(self._local, 'candidates'):
+            self._reset()
+        if text in self._local.candidates:
+            return self._local.candidates[text]
+
+        matches = set()
+        node = self._trie
+        for char in text[:self._depth].lower():
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                matches.update(node[None])
+
+        self._local.candidates[text] = matches
+        return matches
+
+    def plausible(self, method, text):
+        "Is it worth testing method's pattern against text?"
+        if not hasattr(self._local, 'counts'):
+            self._reset()
+        function = method.im_func
+        result = (function not in self._prefixes
+                  or function in self.candidates(text))
+        self._local.counts[result and 1 or 2] += 1
+        return result
+
+    def stats(self):
+        """Return a dict of event type to a dict of the number of events seen
+        and the average number of processors called, regexes tested, and
+        regexes skipped per event.
+        """
+        self._stats_lock.acquire()
+        try:
+            stats = {}
+            for type, (events, processors, tested, skipped) \
+                    in self._stats.iteritems():
+                events = float(events)
+                stats[type] = {
+                    'events': int(events),
+                    'processors': processors / events,
+                    'regexes': tested / events,
+                    'skipped': skipped / events,
+                }
+            return stats
+        finally:
+            self._stats_lock.release()
+
 class Reloader(object):
 
     def __init__(self):
@@ -129,6 +733,8 @@ class Reloader(object):
         try:
             reload(ibid.core)
             dispatcher = ibid.core.Dispatcher()
+            if ibid.dispatcher is not None:
+                ibid.dispatcher.shutdown()
             ibid.dispatcher = dispatcher
             self.log.info(u"Reloaded reloader")
             return True
@@ -247,6 +853,7 @@ class Reloader(object):
             return False
 
         ibid.processors.sort(key=lambda x: x.priority)
+        self.index_processors()
 
         self.log.debug(u"Loaded %s plugin", name)
         return True
@@ -262,10 +869,18 @@ class Reloader(object):
             for processor in processors:
                 processor.shutdown()
                 ibid.processors.remove(processor)
+            self.index_processors()
 
             self.log.info(u"Unloaded %s plugin", name)
             return True
 
+    def index_processors(self):
+        "Rebuild the dispatch index for the loaded processors"
+        ibid.dispatch_index = DispatchIndex(ibid.processors)
+        if ibid.scheduler is not None:
+            ibid.scheduler.rebuild(ibid.processors)
+        self.log.debug(u'Indexed %i processors', len(ibid.processors))
+
     def reload_databases(self):
         reload(ibid.core)
         ibid.databases = DatabaseManager()
@@ -287,22 +902,101 @@ class Reloader(object):
             processor.setup()
         for source in ibid.sources:
             ibid.sources[source].setup()
+        self.index_processors()
         self.log.info(u"Notified all processors of config reload")
 
-def regexp(pattern, item):
-    return re.search(pattern, item, re.I) and True or False
+sqlite_pragmas = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -8192),
+    ('mmap_size', 67108864),
+)
 
-def sqlite_creator(database):
+def sqlite_creator(database, config=None):
+    """Return a function that opens database, tuned by the pragmas in
+    config (the [sqlite] configuration section)."""
     try:
         from pysqlite2 import dbapi2 as sqlite
     except ImportError:
         from sqlite3 import dbapi2 as sqlite
+    config = config or {}
+    busy_timeout = float(config.get('busy_timeout', 5000)) / 1000
+    pragmas = [(name, config.get(name, default))
+               for name, default in sqlite_pragmas]
     def connect():
-        connection = sqlite.connect(database)
-        connection.create_function('regexp', 2, regexp)
+        # SQLitePool closes the connections of finished threads from others
+        connection = sqlite.connect(database, timeout=busy_timeout,
+                                    check_same_thread=False)
+        connection.create_function('regexp', 2, sql_regexp)
+        for name, value in pragmas:
+            # Older SQLite versions ignore pragmas they don't know
+            connection.execute('PRAGMA %s = %s' % (name, value)).fetchall()
         return connection
     return connect
 
+class SQLitePool(SingletonThreadPool):
+    """Keeps a connection open for each thread that uses the database.
+    SingletonThreadPool closes any connection, even one that another thread
+    is using, once it holds more than pool_size. Instead, only close the
+    connections of threads that have finished.
+    """
+
+    def __init__(self, creator, pool_size=5, **kw):
+        SingletonThreadPool.__init__(self, creator, pool_size, **kw)
+        self._threads = {}
+
+    def dispose(self):
+        SingletonThreadPool.dispose(self)
+        self._threads.clear()
+
+    def _cleanup(self):
+        for connection, thread in self._threads.items():
+            # Another thread may be cleaning up at the same time
+            if not thread.isAlive() \
+                    and self._threads.pop(connection, None) is not None:
+                self._all_conns.discard(connection)
+                try:
+                    connection.close()
+                except Exception:
+                    self.logger.exception(u'Exception closing connection')
+
+    def _do_get(self):
+        connection = SingletonThreadPool._do_get(self)
+        if connection not in self._threads:
+            self._threads[connection] = currentThread()
+        return connection
+
+def sqlite_savepoints(engine):
+    """Leave beginning engine's transactions to SQLAlchemy, rather than
+    pysqlite, which commits before any SAVEPOINT statement.
+    Like pysqlite, only begin the transaction before the first statement
+    that isn't a SELECT, so transactions that only read don't hold a lock.
+    Needs SQLAlchemy 0.7 or later.
+    """
+    from sqlalchemy import event
+
+    def connect(dbapi_con, con_record):
+        dbapi_con.isolation_level = None
+    def checkin(dbapi_con, con_record):
+        con_record.info.pop('sqlite_begin', None)
+    def begin(connection):
+        connection.info['sqlite_begin'] = True
+    def end(connection):
+        connection.info.pop('sqlite_begin', None)
+    def before_cursor_execute(connection, cursor, statement, parameters,
+                              context, executemany):
+        if connection.info.get('sqlite_begin') \
+                and not statement.lstrip()[:6].upper() == 'SELECT':
+            del connection.info['sqlite_begin']
+            cursor.execute('BEGIN')
+
+    event.listen(engine, 'connect', connect)
+    event.listen(engine, 'checkin', checkin)
+    event.listen(engine, 'begin', begin)
+    event.listen(engine, 'commit', end)
+    event.listen(engine, 'rollback', end)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+
 class DatabaseManager(dict):
 
     def __init__(self, check_schema_versions=True):
@@ -322,12 +1016,17 @@ class DatabaseManager(dict):
         echo = ibid.config.debugging.get(u'sqlalchemy_echo', False)
 
         if uri.startswith('sqlite:///'):
+            config = ibid.config.get('sqlite', {})
+            sql_regexp.configure()
             engine = create_engine('sqlite:///',
                 creator=sqlite_creator(join(ibid.options['base'],
-                    expanduser(uri.replace('sqlite:///', '', 1)))),
+                    expanduser(uri.replace('sqlite:///', '', 1))), config),
+                poolclass=SQLitePool,
                 encoding='utf-8', convert_unicode=True,
                 assert_unicode=True, echo=echo
             )
+            if unit_of_work():
+                sqlite_savepoints(engine)
 
         else:
             if uri.startswith(u'mysql://'):
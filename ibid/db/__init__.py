@@ -1,14 +1,18 @@
 # Copyright (c) 2009-2011, Stefano Rivera
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+import re as _re
 import warnings as _warnings
+import weakref as _weakref
 
 from ibid.db.types import TypeDecorator, Integer, DateTime, Boolean, \
                           IbidUnicode, IbidUnicodeText
 
 from sqlalchemy import Table, Column, ForeignKey, Index, UniqueConstraint, \
-                       server_default, or_, and_, MetaData as _MetaData
-from sqlalchemy.orm import eagerload, relation, synonym
-from sqlalchemy.sql import func
+                       server_default, or_, and_, select, bindparam, \
+                       MetaData as _MetaData
+from sqlalchemy.orm import eagerload, relation, synonym, MapperExtension, \
+                           EXT_CONTINUE
+from sqlalchemy.sql import func, desc
 from sqlalchemy.ext.declarative import declarative_base as _declarative_base
 
 from sqlalchemy.exceptions import IntegrityError, SADeprecationWarning
@@ -18,15 +22,183 @@ Base = _declarative_base(metadata=metadata)
 
 from ibid.db.versioned_schema import VersionedSchema, SchemaVersionException, \
                                      schema_version_check, upgrade_schemas
+from ibid.db.regexp import required_literal, RegexpTimeout
 
 # We use SQLAlchemy 0.4 compatible .save_or_update() functions
 _warnings.filterwarnings('ignore', 'Use session.add\(\)', SADeprecationWarning)
 
+_escape_like_re = _re.compile(r'([%_#])')
+
+class EventSession(object):
+    """The session shared by the processors handling an event.
+
+    If deferred, each processor's changes are made in a savepoint, which is
+    rolled back if the processor fails, commit() only flushes, and finish()
+    commits the event's changes once it has been through every processor.
+    The savepoint is only opened before a processor's first write, so
+    processors that only read don't pay for one.
+    Callbacks registered with after_commit() are called once the changes
+    made before them have been committed, and are dropped if those changes
+    are rolled back.
+    """
+
+    def __init__(self, session, deferred=True):
+        self.session = session
+        self.deferred = deferred
+        self.pending = False
+        self.used = True
+        self.savepoint = None
+        self.callbacks = []
+        self.processor_callbacks = []
+        if deferred:
+            _event_sessions[session] = self
+
+    def use(self):
+        "Note that the current processor uses the session"
+        self.used = True
+        if self.deferred and not _lazy_savepoints:
+            self.begin()
+
+    def begin(self):
+        """Open the current processor's savepoint, before it writes.
+        begin_nested() flushes pending changes outside the new savepoint, so
+        this is called once they have been flushed, or from a flush.
+        """
+        if self.deferred and self.savepoint is None:
+            self.savepoint = self.session.begin_nested()
+
+    def after_commit(self, callback, *args):
+        "Call callback(*args) once the changes made so far are committed"
+        if self.deferred:
+            self.processor_callbacks.append((callback, args))
+        else:
+            self.callbacks.append((callback, args))
+
+    def flush(self):
+        if not _lazy_savepoints:
+            self.begin()
+        self.session.flush()
+
+    def execute(self, *args, **kwargs):
+        # Opening the savepoint would flush pending changes outside it
+        self.flush()
+        self.begin()
+        return self.session.execute(*args, **kwargs)
+
+    def commit(self):
+        if not self.deferred:
+            self.session.commit()
+            self._run_callbacks()
+            return
+        self.flush()
+        self.pending = True
+
+    def rollback(self):
+        """Roll back the current processor's changes, or every uncommitted
+        change, if not deferred"""
+        if not self.deferred:
+            self.session.rollback()
+            self.pending = False
+            self.callbacks = []
+            return
+        self.discard()
+        self.used = True
+
+    def release(self):
+        "Keep the changes made by the processor that has just finished"
+        session = self.session
+        if not self.deferred:
+            if session.dirty or session.deleted:
+                self.commit()
+        else:
+            if session.new or session.dirty or session.deleted:
+                self.flush()
+                self.pending = True
+            if self.savepoint is not None:
+                if not self.savepoint.is_active:
+                    # A flush failed, and the processor didn't roll back
+                    self.discard()
+                else:
+                    self.savepoint.commit()
+                self.savepoint = None
+        self.callbacks.extend(self.processor_callbacks)
+        self.processor_callbacks = []
+        self.used = False
+
+    def discard(self):
+        "Roll back the changes made by the processor that has just failed"
+        session = self.session
+        if self.savepoint is None \
+                and (session.new or session.dirty or session.deleted):
+            # Write the changes into a savepoint, to roll them back with it
+            try:
+                self.flush()
+            except Exception:
+                pass
+        if self.savepoint is not None:
+            self.savepoint.rollback()
+        self.savepoint = None
+        self.processor_callbacks = []
+        self.used = False
+
+    def finish(self):
+        "Commit all changes made while handling the event"
+        self.release()
+        session = self.session
+        _event_sessions.pop(session, None)
+        try:
+            try:
+                if self.pending or session.new or session.dirty \
+                        or session.deleted:
+                    session.commit()
+            except:
+                session.rollback()
+                self.callbacks = []
+                raise
+        finally:
+            self.pending = False
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback, args in callbacks:
+            callback(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+_event_sessions = _weakref.WeakKeyDictionary()
+
+def _before_flush(session, flush_context, instances):
+    "Open the savepoint of the event session that session is flushing for"
+    event_session = _event_sessions.get(session)
+    if event_session is not None:
+        event_session.begin()
+
+try:
+    from sqlalchemy import event as _event
+    from sqlalchemy.orm import Session as _Session
+    _event.listen(_Session, 'before_flush', _before_flush)
+    _lazy_savepoints = True
+except ImportError:
+    # Without flush events, savepoints must be opened before any changes
+    _lazy_savepoints = False
+
 def get_regexp_op(session):
-    "Return a regexp operator"
+    """Return a regexp operator.
+    Where REGEXP is slow, rows that don't contain the pattern's literal text
+    are first excluded with LIKE.
+    """
     if session.bind.engine.name in ('postgres', 'postgresql'):
         return lambda x, y: x.op('~')(y)
     else:
-        return lambda x, y: x.op('REGEXP')(y)
+        def op(x, y):
+            literal = required_literal(y)
+            if literal is None or len(literal) < 2:
+                return x.op('REGEXP')(y)
+            literal = _escape_like_re.sub(r'#\1', literal)
+            return and_(x.like(u'%%%s%%' % literal, escape='#'),
+                        x.op('REGEXP')(y))
+        return op
 
 # vi: set et sta sw=4 ts=4:
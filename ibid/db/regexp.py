@@ -0,0 +1,111 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+"""The REGEXP function for SQLite, which is evaluated in Python for every
+row a query scans."""
+
+import re
+import sre_constants
+import sre_parse
+from threading import local, Lock
+from time import time
+
+import ibid
+
+class RegexpTimeout(Exception):
+    "Raised when a regex query takes longer than its timeout"
+    pass
+
+def required_literal(pattern):
+    """Return the longest (lower-case) ASCII literal string that every match
+    of pattern, searched case-insensitively, must contain.
+    Return None if there isn't one, or it can't be determined.
+    """
+    try:
+        parsed = sre_parse.parse(pattern, re.I)
+    except (sre_constants.error, OverflowError, RuntimeError):
+        return None
+    if parsed.pattern.flags & (sre_constants.SRE_FLAG_LOCALE
+                               | sre_constants.SRE_FLAG_UNICODE):
+        # Case-folding outside ASCII makes lower() comparisons unsafe
+        return None
+
+    best = run = u''
+    for op, av in parsed:
+        if op == sre_constants.LITERAL and av < 128:
+            run += unichr(av)
+        elif op != sre_constants.AT:
+            # SQLite's LIKE only ignores the case of ASCII letters
+            run = u''
+        if len(run) > len(best):
+            best = run
+    return best and best.lower() or None
+
+class SQLRegexp(object):
+    """The REGEXP function registered with SQLite connections.
+    Compiled patterns are cached, and calls can be limited in time.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.cache = {}
+        self.cache_size = 500
+        self.timeout = 10
+        self.state = local()
+
+    def configure(self, cache_size=None, timeout=None):
+        "Apply the [sqlite] configuration section, overridden by arguments"
+        config = ibid.config and ibid.config.get('sqlite', {}) or {}
+        self.cache_size = int(cache_size
+                              or config.get('regexp_cache_size', 500))
+        self.timeout = float(timeout or config.get('regexp_timeout', 10))
+
+    def compile(self, pattern):
+        "Return pattern compiled case-insensitively, from the cache if possible"
+        compiled = self.cache.get(pattern)
+        if compiled is None:
+            compiled = re.compile(pattern, re.I)
+            self.lock.acquire()
+            try:
+                if len(self.cache) >= self.cache_size:
+                    self.cache.clear()
+                self.cache[pattern] = compiled
+            finally:
+                self.lock.release()
+        return compiled
+
+    def __call__(self, pattern, item):
+        deadline = getattr(self.state, 'deadline', None)
+        if deadline is not None:
+            self.state.calls += 1
+            if self.state.calls & 1023 == 0 and time() > deadline:
+                self.state.timed_out = True
+                raise RegexpTimeout()
+        if item is None:
+            return False
+        return self.compile(pattern).search(item) is not None
+
+    def limit(self, function, *args, **kwargs):
+        """Call function, raising RegexpTimeout if the REGEXP calls it makes
+        in this thread take longer than the configured timeout.
+        SQLite can't interrupt a single slow match, so this only stops
+        queries that scan many rows.
+        """
+        state = self.state
+        state.deadline = time() + self.timeout
+        state.calls = 0
+        state.timed_out = False
+        try:
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                # The database wraps the exception in its own
+                if state.timed_out:
+                    raise RegexpTimeout()
+                raise
+        finally:
+            state.deadline = None
+
+sql_regexp = SQLRegexp()
+
+# vi: set et sta sw=4 ts=4:
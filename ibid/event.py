@@ -4,6 +4,7 @@
 import warnings
 
 import ibid
+from ibid.db import EventSession
 
 class Event(dict):
 
@@ -15,8 +16,11 @@ class Event(dict):
         self.processed = False
 
     def __getattr__(self, name):
-        if name == 'session' and 'session' not in self:
-            self['session'] = ibid.databases.ibid()
+        if name == 'session':
+            if 'session' not in self:
+                self['session'] = EventSession(ibid.databases.ibid(),
+                        getattr(ibid.dispatcher, 'unit_of_work', False))
+            self['session'].use()
         try:
             return self[name]
         except KeyError, e:
@@ -4,7 +4,6 @@
 from copy import copy
 from datetime import timedelta
 from inspect import getargspec, getmembers, ismethod
-import logging
 import re
 from threading import Lock
 
@@ -75,8 +74,6 @@ class Processor(object):
     _event_handlers = None
     _periodic_handlers = None
 
-    __log = logging.getLogger('plugins')
-
     def __new__(cls, *args):
         if cls.processed and cls.priority == 0:
             cls.priority = 1500
@@ -116,10 +113,6 @@ class Processor(object):
 
     def process(self, event):
         "Process a single event"
-        if event.type == 'clock':
-            for method in self._get_periodic_handlers():
-                self._run_periodic_handler(method, event)
-
         if event.type not in self.event_types:
             return
 
@@ -129,6 +122,7 @@ class Processor(object):
         if not self.processed and event.processed:
             return
 
+        index = ibid.dispatch_index
         found = False
         for method in self._get_event_handlers():
             args = None
@@ -137,14 +131,20 @@ class Processor(object):
                 args = ()
             elif hasattr(event, 'message'):
                 found = True
-                match = method.pattern.search(
-                        event.message[method.message_version])
-                if match is not None:
-                    args = match.groups()
+                message = event.message[method.message_version]
+                if index is None or index.plausible(method, message):
+                    match = method.pattern.search(message)
+                    if match is not None:
+                        args = match.groups()
             if args is not None:
                 if (not getattr(method, 'auth_required', False)
                         or auth_responses(event, self.permission)):
-                    method(event, *args)
+                    if getattr(method, 'asynchronous', False):
+                        # Called by the dispatcher, in the reactor thread
+                        event.setdefault('asynchronous', []) \
+                                .append((method, args))
+                    else:
+                        method(event, *args)
                 elif not getattr(method, 'auth_fallthrough', True):
                     event.processed = True
 
@@ -163,37 +163,6 @@ class Processor(object):
         for handler in self._periodic_handlers or self.__periodic_handlers:
             yield getattr(self, handler)
 
-    def _run_periodic_handler(self, method, event):
-        "Run a periodic handler, if appropriate"
-        if (method.interval.seconds > 0
-                and not method.disabled
-                and method.lock.acquire(0)):
-            try:
-                if method.last_called is None:
-                    # First call, set up initial_delay
-                    method.im_func.last_called = event.time
-                elif event.time - method.last_called >= (
-                        method.initial_delay or method.interval):
-                    method.im_func.initial_delay = None
-                    method.im_func.last_called = event.time
-                    name = u'%s.%s' % (self.__class__.__name__, method.__name__)
-                    try:
-                        self.__log.debug(u'Running periodic event: %s', name)
-                        method(event)
-                        if method.failing:
-                            self.__log.info(u'No longer failing: %s', name)
-                            method.im_func.failing = False
-                    except:
-                        if not method.failing:
-                            self.__log.exception(u'Periodic method failing: %s',
-                                                 name)
-                            method.im_func.failing = True
-                        else:
-                            self.__log.debug(u'Still failing: %s', name)
-
-            finally:
-                method.lock.release()
-
 # This is a bit yucky, but necessary since ibid.config imports Processor
 from ibid.config import BoolOption, IntOption
 options = {
@@ -220,6 +189,16 @@ def match(regex, version='clean'):
         return function
     return wrap
 
+def asynchronous(function):
+    """Wrapper: Run this handler in the reactor thread, instead of a
+    dispatcher thread.
+    It must not block, but can return a Deferred, or be a generator that
+    yields Deferreds (like twisted's inlineCallbacks). The event is only
+    passed on to later processors once it fires.
+    """
+    function.asynchronous = True
+    return function
+
 def auth_responses(event, permission):
     """Mark an event as having required authorisation, and return True if the
     event sender has permission.
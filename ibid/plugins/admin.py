@@ -10,6 +10,9 @@ from ibid.utils import human_join
 from ibid.config import FileConfig
 from ibid.plugins import Processor, match, authorise, auth_responses
 from ibid.utils import ibid_version
+from ibid.utils.cache import response_cache
+from ibid.utils.http import http_client
+from ibid.utils.process import process_pool
 
 log = logging.getLogger('plugins.admin')
 
@@ -33,7 +36,8 @@ class ListPLugins(Processor):
         event.addresponse(u'Plugins: %s', human_join(sorted(plugins)) or u'none')
 
 features['core'] = {
-    'description': u'Reloads core modules.',
+    'description': u'Reloads core modules and shows dispatch and service '
+                   u'statistics.',
     'categories': ('admin',),
 }
 class ReloadCoreModules(Processor):
@@ -54,6 +58,77 @@ class ReloadCoreModules(Processor):
 
         event.addresponse(result and u'%s reloaded' or u"Couldn't reload %s", module)
 
+class DispatchStats(Processor):
+    usage = u'dispatch stats'
+    feature = ('core',)
+
+    permission = u'core'
+
+    @match(r'^dispatch\s+stat(?:istic)?s$')
+    @authorise()
+    def stats(self, event):
+        stats = ibid.dispatch_index and ibid.dispatch_index.stats() or {}
+        if stats:
+            event.addresponse(u'Candidates per event: %s', human_join(
+                u'%s: %i events, %.1f processors, %.1f regexes tested '
+                u'(%.1f skipped)' % (type, s['events'], s['processors'],
+                                     s['regexes'], s['skipped'])
+                for type, s in sorted(stats.iteritems())))
+        else:
+            event.addresponse(u"I haven't indexed any events")
+
+        queues = ibid.dispatcher.queues.stats()
+        event.addresponse(u'Queues: %(queued)i queued, %(dropped)i dropped, '
+                u'%(coalesced)i coalesced, %(waiting)i waiting in '
+                u'%(queues)i queues (max depth %(max_depth)i), '
+                u'wait %(wait_avg).3fs average, %(wait_max).3fs max', queues)
+
+class ServiceStats(Processor):
+    usage = u"""cache stats
+    http stats
+    process stats"""
+    feature = ('core',)
+
+    permission = u'core'
+
+    @match(r'^cache\s+stat(?:istic)?s$')
+    @authorise()
+    def cache(self, event):
+        stats = response_cache.stats()
+        stats['hit_rate'] *= 100
+        event.addresponse(u'Response cache: %(size)i responses, %(hits)i '
+                u'hits, %(stale_hits)i stale hits, %(misses)i misses '
+                u'(%(hit_rate).1f%% hit rate), %(stores)i stored', stats)
+
+    @match(r'^http\s+stat(?:istic)?s$')
+    @authorise()
+    def http(self, event):
+        stats = http_client.stats()
+        if stats:
+            event.addresponse(u'HTTP latency: %s', human_join(
+                u'%s: %i requests (%i errors, %i reused), %.3fs average, '
+                u'%.3fs max' % (host, s['requests'], s['errors'],
+                                s['reused'], s['mean_time'], s['max_time'])
+                for host, s in sorted(stats.iteritems(),
+                                      key=lambda (host, s): -s['requests'])))
+        else:
+            event.addresponse(u"I haven't made any HTTP requests")
+
+    @match(r'^process\s+stat(?:istic)?s$')
+    @authorise()
+    def process(self, event):
+        stats = process_pool.stats()
+        if stats:
+            event.addresponse(u'Processes: %s', human_join(
+                u'%s: %i runs (%i errors, %i timeouts, %i by a helper), '
+                u'%.3fs average, %.3fs max' % (name, s['runs'], s['errors'],
+                        s['timeouts'], s['helper_runs'], s['mean_time'],
+                        s['max_time'])
+                for name, s in sorted(stats.iteritems(),
+                                      key=lambda (name, s): -s['runs'])))
+        else:
+            event.addresponse(u"I haven't run any processes")
+
 class LoadModules(Processor):
     usage = u'(load|unload|reload) <plugin|processor>'
     feature = ('plugins',)
@@ -8,7 +8,6 @@ import Image
 from os import listdir, remove
 import os.path
 from random import choice
-import subprocess
 from tempfile import mkstemp
 from urllib2 import HTTPError, URLError, urlopen
 from urlparse import urlparse
@@ -20,6 +19,7 @@ from pyfiglet import Figlet, FontNotFound
 from ibid.config import Option, IntOption, ListOption
 from ibid.plugins import Processor, match
 from ibid.utils import file_in_path, url_to_bytestring
+from ibid.utils.process import process_pool
 
 """
 Dependencies:
@@ -138,11 +138,8 @@ class DrawImage(Processor):
         event.addresponse(unicode(screen.render()), address=False, conflate=False)
 
     def draw_caca(self, event, image, width, height):
-        process = subprocess.Popen(
-            [self.img2txt_bin, '-f', 'irc', '-W', str(width), '-H', str(height), image],
-            shell=False, stdout=subprocess.PIPE)
-        response, error = process.communicate()
-        code = process.wait()
+        response, error, code = process_pool.run(
+            [self.img2txt_bin, '-f', 'irc', '-W', str(width), '-H', str(height), image])
         if code == 0:
             event.addresponse(unicode(response.replace('\r', '')), address=False, conflate=False)
         else:
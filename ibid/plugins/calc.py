@@ -3,16 +3,14 @@
 
 from __future__ import division
 import logging
-from os import kill
 from random import random, randint
-from signal import SIGTERM
-from subprocess import Popen, PIPE
-from time import time, sleep
+import re
 
 from ibid.compat import all, factorial
 from ibid.config import Option, FloatOption
-from ibid.plugins import Processor, match
+from ibid.plugins import Processor, match, asynchronous
 from ibid.utils import file_in_path, unicode_output
+from ibid.utils.process import process_pool, ProcessFailed, ProcessTimeout
 
 try:
     from ast import NodeTransformer, Pow, Name, Load, Call, copy_location, parse
@@ -46,40 +44,46 @@ class BC(Processor):
         if not file_in_path(self.bc):
             raise Exception("Cannot locate bc executable")
 
+    # Input that could change or read state kept between requests
+    # (variables, arrays, functions, the last result), or that leaves bc
+    # waiting for more, is run in a bc of its own
+    stateful_re = re.compile(r'define|=|[{"\\]|\+\+|--|/\*'
+                             r'|\b(?:quit|halt|read|last)\b'
+                             r'|(?<![\w.])\.(?![\w.])')
+
     @match(r'^bc\s+(.+)$')
+    @asynchronous
     def calculate(self, event, expression):
-        bc = Popen([self.bc, '-l'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        start_time = time()
-        bc.stdin.write(expression.encode('utf-8') + '\n')
-        bc.stdin.close()
-
-        while bc.poll() is None and time() - start_time < self.bc_timeout:
-            sleep(0.1)
-
-        if bc.poll() is None:
-            kill(bc.pid, SIGTERM)
+        try:
+            if self.stateful_re.search(expression):
+                output, error, code = yield process_pool.spawn(
+                        [self.bc, '-l'], expression.encode('utf-8') + '\n',
+                        timeout=self.bc_timeout)
+            else:
+                # bc is kept running between requests, so reset its scale
+                # and bases first
+                output, error = yield process_pool.helper('bc',
+                        [self.bc, '-l'], 'print "\\n%s\\n"\n',
+                        'scale=20; ibase=A; obase=A\n'
+                        + expression.encode('utf-8') + '\n',
+                        timeout=self.bc_timeout)
+        except ProcessTimeout:
             event.addresponse(u'Sorry, that took too long. I stopped waiting')
             return
+        except ProcessFailed:
+            event.addresponse(u"Error running bc")
+            raise
 
-        output = bc.stdout.read()
-        error = bc.stderr.read()
-
-        code = bc.wait()
-
-        if code == 0:
-            if output:
-                output = unicode_output(output.strip())
-                output = output.replace('\\\n', '')
-                event.addresponse(output)
-            else:
-                error = unicode_output(error.strip())
-                error = error.split(":", 1)[1].strip()
-                error = error[0].lower() + error[1:].split('\n')[0]
-                event.addresponse(u"I'm sorry, I couldn't deal with the %s", error)
+        output = output.strip()
+        if output:
+            output = unicode_output(output)
+            output = output.replace('\\\n', '')
+            event.addresponse(output)
         else:
-            event.addresponse(u"Error running bc")
             error = unicode_output(error.strip())
-            raise Exception("BC Error: %s" % error)
+            error = error.split(":", 1)[1].strip()
+            error = error[0].lower() + error[1:].split('\n')[0]
+            event.addresponse(u"I'm sorry, I couldn't deal with the %s", error)
 
 features['calc'] = {
     'description': u'Returns the anwser to mathematical expressions. '
@@ -1,18 +1,24 @@
 # Copyright (c) 2009-2010, Michael Gorven, Stefano Rivera, Max Rabkin
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
-from subprocess import Popen, PIPE
+from bisect import bisect_left
+from heapq import nsmallest
+import marshal
+import os
+import sys
+from threading import Lock
 from urllib import urlencode
 import logging
 import re
 import unicodedata
 
 import ibid
-from ibid.plugins import Processor, handler, match
-from ibid.config import Option
+from ibid.plugins import Processor, handler, match, asynchronous
+from ibid.config import Option, IntOption
 from ibid.utils import file_in_path, get_country_codes, human_join, \
-                       unicode_output, generic_webservice
+                       unicode_output, generic_webservice, cache_path
 from ibid.utils.html import get_html_parse_tree
+from ibid.utils.process import process_pool
 
 features = {}
 log = logging.getLogger('plugins.conversions')
@@ -256,6 +262,7 @@ class Units(Processor):
         return unit
 
     @match(r'^convert\s+(-?[0-9.]+)?\s*(.+)\s+(?:in)?to\s+(.+)$')
+    @asynchronous
     def convert(self, event, value, frm, to):
 
         # We have to special-case temperatures because GNU units uses function notation
@@ -271,9 +278,8 @@ class Units(Processor):
             else:
                 frm = '%s %s' % (value, frm)
 
-        units = Popen([self.units, '--verbose', '--', frm, to], stdout=PIPE, stderr=PIPE)
-        output, error = units.communicate()
-        code = units.wait()
+        output, error, code = yield process_pool.spawn(
+                [self.units, '--verbose', '--', frm, to])
 
         output = unicode_output(output)
         result = output.splitlines()[0].strip()
@@ -305,6 +311,8 @@ class Currency(Processor):
 
     feature = ('currency',)
 
+    cache_ttl = IntOption('cache_ttl', 'Seconds to cache exchange rates for', 5*60)
+
     currencies = {}
     country_codes = {}
 
@@ -397,7 +405,7 @@ class Currency(Processor):
                     'f': 'l1ba',
                     'e': '.csv',
                     's': canonical_frm + canonical_to + '=X',
-                })
+                }, ttl=self.cache_ttl)
         last_trade_rate, bid, ask = data.strip().split(',')
         if last_trade_rate == 0:
             event.addresponse(
@@ -441,6 +449,95 @@ class Currency(Processor):
 
 class UnassignedCharacter(Exception): pass
 
+class UnicodeNameIndex(object):
+    """An inverted index of the words in Unicode character names, built from
+    unicodedata and cached in a marshal file."""
+
+    version = 1
+    word_re = re.compile(r'[A-Z0-9]+')
+
+    def __init__(self, words):
+        self.words = words
+        self.vocabulary = sorted(words)
+
+    @classmethod
+    def build(cls):
+        words = {}
+        for code in xrange(sys.maxunicode + 1):
+            name = unicodedata.name(unichr(code), None)
+            if name is None:
+                continue
+            for word in set(cls.word_re.findall(name)):
+                words.setdefault(word, []).append(code)
+        return cls(words)
+
+    @classmethod
+    def load(cls, filename):
+        """Load the index from filename, building and saving it if it's
+        missing or out of date"""
+        key = (cls.version, unicodedata.unidata_version, sys.maxunicode)
+        try:
+            f = file(filename, 'rb')
+            try:
+                cached_key, words = marshal.load(f)
+            finally:
+                f.close()
+            if cached_key == key:
+                return cls(words)
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+
+        index = cls.build()
+        tmp = filename + '.tmp'
+        f = file(tmp, 'wb')
+        try:
+            marshal.dump((key, index.words), f)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+        return index
+
+    def _matches(self, word):
+        """Return a dict of codepoints with a name word matching word, scored
+        3 for the whole word, 2 for a prefix, 1 for a substring"""
+        scores = {}
+        if len(word) >= 3:
+            for candidate in self.vocabulary:
+                if word in candidate[1:]:
+                    for code in self.words[candidate]:
+                        scores[code] = 1
+        i = bisect_left(self.vocabulary, word)
+        while i < len(self.vocabulary) \
+                and self.vocabulary[i].startswith(word):
+            score = self.vocabulary[i] == word and 3 or 2
+            for code in self.words[self.vocabulary[i]]:
+                scores[code] = max(score, scores.get(code, 0))
+            i += 1
+        return scores
+
+    def search(self, query, limit=None):
+        """Return (count, codepoints) of the characters whose names contain
+        every word of query, as a word, prefix, or substring, best first"""
+        scores = None
+        for word in self.word_re.findall(query.upper()):
+            matches = self._matches(word)
+            if scores is None:
+                scores = matches
+            else:
+                scores = dict((code, score + matches[code])
+                              for code, score in scores.iteritems()
+                              if code in matches)
+            if not scores:
+                return 0, []
+
+        if not scores:
+            return 0, []
+        rank = lambda code: (-scores[code], len(unicodedata.name(unichr(code))),
+                             code)
+        if limit is None:
+            return len(scores), sorted(scores, key=rank)
+        return len(scores), nsmallest(limit, scores, key=rank)
+
 features['unicode'] = {
     'description': u'Look up characters in the Unicode database.',
     'categories': ('lookup', 'convert',),
@@ -451,6 +548,11 @@ class UnicodeData(Processor):
 
     feature = ('unicode',)
 
+    name_results = IntOption('name_results', 'Maximum number of characters to list for a name search', 5)
+
+    name_index = None
+    name_index_lock = Lock()
+
     bidis = {'AL': u'right-to-left Arabic', 'AN': u'Arabic number',
              'B': u'paragraph separator', 'BN': u'boundary neutral',
              'CS': u'common number separator', 'EN': u'European number',
@@ -523,8 +625,25 @@ class UnicodeData(Processor):
     @match(r'^unicode\s+([a-z][a-z0-9 -]+)$')
     def fromname (self, event, name):
         try:
-            char = eval(ur'u"\N{%s}"' % name.upper())
-        except (SyntaxError, UnicodeError):
+            char = unicodedata.lookup(name.upper())
+        except KeyError:
+            char = None
+
+        if char is None:
+            count, codes = self.get_name_index().search(name, self.name_results)
+            if count == 1:
+                char = unichr(codes[0])
+            elif count:
+                event.addresponse(u'Found %(count)i characters, '
+                                  u'best %(listing)i: %(results)s', {
+                    'count': count,
+                    'listing': len(codes),
+                    'results': human_join(u'U+%(code)s %(name)s' % self.info(unichr(code))
+                                          for code in codes),
+                })
+                return
+
+        if char is None:
             event.addresponse(u"I couldn't find a character with that name")
         else:
             info = self.info(char)
@@ -534,6 +653,18 @@ class UnicodeData(Processor):
                               u"%(category)s with %(bidi)s directionality",
                               info)
 
+    def get_name_index(self):
+        "Load the name index, the first time it's needed"
+        if self.name_index is None:
+            self.name_index_lock.acquire()
+            try:
+                if self.name_index is None:
+                    UnicodeData.name_index = UnicodeNameIndex.load(
+                            cache_path('unicode/names.marshal'))
+            finally:
+                self.name_index_lock.release()
+        return self.name_index
+
     # Match any string that can't be a character name or a number.
     @match(r'^unicode\s+(.*[^0-9a-z#+\s-].+|.+[^0-9a-z#+\s-].*)$', 'deaddressed')
     def characters (self, event, string):
@@ -5,19 +5,23 @@ from datetime import datetime
 import logging
 from random import choice
 import re
+from threading import Lock
 
 from dateutil.tz import tzlocal, tzutc
 
 from ibid.plugins import Processor, match, handler, authorise, auth_responses, \
-                         RPC
-from ibid.config import Option, IntOption, ListOption
+                         periodic, RPC
+from ibid.config import Option, BoolOption, IntOption, ListOption
 from ibid.db import IbidUnicode, IbidUnicodeText, Boolean, Integer, DateTime, \
                     Table, Column, ForeignKey, server_default, \
-                    relation, synonym, func, or_, \
+                    relation, synonym, func, desc, or_, and_, \
+                    MapperExtension, EXT_CONTINUE, \
                     Base, VersionedSchema, \
-                    get_regexp_op
+                    get_regexp_op, RegexpTimeout
+from ibid.db.regexp import sql_regexp
 from ibid.plugins.identity import get_identities
 from ibid.utils import format_date
+from ibid.utils.cache import LRUCache
 
 features = {'factoid': {
     'description': u'Factoids are arbitrary pieces of information stored by a '
@@ -45,6 +49,64 @@ def unescape_name(name):
     "Turn a _% factoid name to $arg"
     return name.replace('_%', '$arg').replace('\\%', '%').replace('\\_', '_')
 
+term_re = re.compile(r'\w+', re.UNICODE)
+
+def search_terms(text):
+    "Split text into a dict of lower-case search terms and their frequencies"
+    terms = {}
+    for term in term_re.findall(text.lower()):
+        term = term[:32]
+        terms[term] = terms.get(term, 0) + 1
+    return terms
+
+def term_rows(factoid_id, name_id, value_id, text):
+    "Rows for factoid_terms, indexing a name or value"
+    if name_id is not None:
+        text = text.replace(u'$arg', u' ')
+    else:
+        text = reply_re.sub(u'', action_re.sub(u'', text))
+    return [{
+        'term': term,
+        'factoid_id': factoid_id,
+        'name_id': name_id,
+        'value_id': value_id,
+        'frequency': frequency,
+    } for term, frequency in search_terms(text).iteritems()]
+
+class FactoidTermIndexer(MapperExtension):
+    "Keep factoid_terms up to date as FactoidNames and FactoidValues change"
+
+    def _where(self, instance):
+        table = FactoidTerm.__table__
+        if isinstance(instance, FactoidName):
+            return table.c.name_id == instance.id
+        return table.c.value_id == instance.id
+
+    def _index(self, connection, instance):
+        if isinstance(instance, FactoidName):
+            rows = term_rows(instance.factoid_id, instance.id, None,
+                              instance.name)
+        else:
+            rows = term_rows(instance.factoid_id, None, instance.id,
+                              instance.value)
+        if rows:
+            connection.execute(FactoidTerm.__table__.insert(), rows)
+
+    def after_insert(self, mapper, connection, instance):
+        self._index(connection, instance)
+        return EXT_CONTINUE
+
+    def after_update(self, mapper, connection, instance):
+        connection.execute(FactoidTerm.__table__.delete()
+                           .where(self._where(instance)))
+        self._index(connection, instance)
+        return EXT_CONTINUE
+
+    def before_delete(self, mapper, connection, instance):
+        connection.execute(FactoidTerm.__table__.delete()
+                           .where(self._where(instance)))
+        return EXT_CONTINUE
+
 class FactoidName(Base):
     __table__ = Table('factoid_names', Base.metadata,
     Column('id', Integer, primary_key=True),
@@ -58,6 +120,8 @@ class FactoidName(Base):
     Column('wild', Boolean, nullable=False, default=False, index=True),
     useexisting=True)
 
+    __mapper_args__ = {'extension': FactoidTermIndexer()}
+
     class FactoidNameSchema(VersionedSchema):
         def upgrade_1_to_2(self):
             self.add_column(Column('factpack', Integer,
@@ -123,6 +187,8 @@ class FactoidValue(Base):
     Column('factpack', Integer, ForeignKey('factpacks.id'), index=True),
     useexisting=True)
 
+    __mapper_args__ = {'extension': FactoidTermIndexer()}
+
     class FactoidValueSchema(VersionedSchema):
         def upgrade_1_to_2(self):
             self.add_column(Column('factpack', Integer, ForeignKey('factpacks.id')))
@@ -198,10 +264,208 @@ class Factpack(Base):
     def __repr__(self):
         return u'<Factpack %s>' % (self.name,)
 
+class FactoidTerm(Base):
+    "Inverted index of the words in factoid names and values, for Search"
+    __table__ = Table('factoid_terms', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('term', IbidUnicode(32), nullable=False, index=True),
+    Column('factoid_id', Integer, ForeignKey('factoids.id'), nullable=False,
+           index=True),
+    Column('name_id', Integer, ForeignKey('factoid_names.id'), index=True),
+    Column('value_id', Integer, ForeignKey('factoid_values.id'), index=True),
+    Column('frequency', Integer, nullable=False),
+    useexisting=True)
+
+    class FactoidTermSchema(VersionedSchema):
+        def _create_table(self):
+            super(FactoidTerm.FactoidTermSchema, self)._create_table()
+            index_factoid_terms(self.upgrade_session)
+
+    __table__.versioned_schema = FactoidTermSchema(__table__, 1)
+
+    def __repr__(self):
+        return u'<FactoidTerm %s %s>' % (self.term, self.factoid_id)
+
+def index_factoid_terms(session):
+    "Rebuild factoid_terms from all the existing factoids"
+    table = FactoidTerm.__table__
+    session.execute(table.delete())
+    rows = []
+    for id, factoid_id, name in session.query(FactoidName.id,
+            FactoidName.factoid_id, FactoidName._name).all():
+        rows.extend(term_rows(factoid_id, id, None, unescape_name(name)))
+    for id, factoid_id, value in session.query(FactoidValue.id,
+            FactoidValue.factoid_id, FactoidValue.value).all():
+        rows.extend(term_rows(factoid_id, None, id, value))
+    for i in xrange(0, len(rows), 1000):
+        session.execute(table.insert(), rows[i:i+1000])
+    log.info(u'Indexed %i factoid search terms', len(rows))
+
 action_re = re.compile(r'^\s*<action>\s*')
 reply_re = re.compile(r'^\s*<reply>\s*')
 escape_like_re = re.compile(r'([%_#])')
 
+class WildcardMatcher(object):
+    """In-memory index of wildcard ($arg) factoid names.
+
+    Names are split into literal segments around each $arg (which matches
+    one or more characters). Names are indexed in a character trie by their
+    leading segment, or by their trailing segment (reversed) if they start
+    with $arg, so a query only has to walk the trie along its own text, and
+    then check the few candidates found.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.loaded = False
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.loaded = False
+            self.names = {}
+            self.prefixes = {}
+            self.suffixes = {}
+            self.floating = set()
+        finally:
+            self.lock.release()
+
+    def load(self, session):
+        "Index all the wildcard names in the database, if not loaded yet"
+        if self.loaded:
+            return
+        names = session.query(FactoidName.id, FactoidName._name,
+                              FactoidName.factoid_id) \
+                       .filter(FactoidName.wild == True).all()
+        self.lock.acquire()
+        try:
+            if not self.loaded:
+                for id, name, factoid_id in names:
+                    self._add(id, unescape_name(name), factoid_id)
+                self.loaded = True
+        finally:
+            self.lock.release()
+        log.debug(u'Indexed %i wildcard factoid names', len(names))
+
+    def add(self, id, name, factoid_id):
+        "Index FactoidName id, if it's a wildcard name"
+        if u'$arg' not in name:
+            return
+        self.lock.acquire()
+        try:
+            if self.loaded:
+                self._add(id, name, factoid_id)
+        finally:
+            self.lock.release()
+
+    def _add(self, id, name, factoid_id):
+        segments = name.lower().split(u'$arg')
+        self.names[id] = (segments, factoid_id)
+        if segments[0]:
+            self._insert(self.prefixes, segments[0], id)
+        elif segments[-1]:
+            self._insert(self.suffixes, segments[-1][::-1], id)
+        else:
+            self.floating.add(id)
+
+    def _insert(self, trie, key, id):
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node.setdefault(None, set()).add(id)
+
+    def remove(self, ids=(), factoid_ids=()):
+        "Remove FactoidName ids, and all the names of factoid_ids"
+        self.lock.acquire()
+        try:
+            ids = set(ids)
+            if factoid_ids:
+                factoid_ids = set(factoid_ids)
+                ids.update(id for id, (_, factoid_id) in self.names.iteritems()
+                           if factoid_id in factoid_ids)
+            for id in ids:
+                if id not in self.names:
+                    continue
+                segments = self.names.pop(id)[0]
+                if segments[0]:
+                    self._delete(self.prefixes, segments[0], id)
+                elif segments[-1]:
+                    self._delete(self.suffixes, segments[-1][::-1], id)
+                else:
+                    self.floating.discard(id)
+        finally:
+            self.lock.release()
+
+    def _delete(self, trie, key, id):
+        path = []
+        node = trie
+        for char in key:
+            path.append((node, char))
+            node = node[char]
+        node[None].discard(id)
+        if not node[None]:
+            del node[None]
+        for parent, char in reversed(path):
+            if parent[char]:
+                break
+            del parent[char]
+
+    def _walk(self, trie, text, candidates):
+        node = trie
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                return
+            if None in node:
+                candidates.update(node[None])
+
+    def match(self, name):
+        "Return the ids of the wildcard FactoidNames that match name"
+        text = name.lower()
+        self.lock.acquire()
+        try:
+            candidates = set(self.floating)
+            self._walk(self.prefixes, text, candidates)
+            self._walk(self.suffixes, text[::-1], candidates)
+            return [id for id in candidates
+                    if self._matches(self.names[id][0], text)]
+        finally:
+            self.lock.release()
+
+    def _matches(self, segments, text):
+        "Does text match segments, with at least one character between each?"
+        first, last = segments[0], segments[-1]
+        if not text.startswith(first) or not text.endswith(last):
+            return False
+        position = len(first)
+        end = len(text) - len(last)
+        for segment in segments[1:-1]:
+            # The leftmost match of each segment leaves the most room
+            index = text.find(segment, position + 1, end - 1)
+            if index == -1:
+                return False
+            position = index + len(segment)
+        return end - position >= 1
+
+wild_matcher = WildcardMatcher()
+
+def _name_query(session, name, wild):
+    "Query (factoid, name, value) rows for exact or wildcard name matches"
+    query = session.query(Factoid)\
+            .add_entity(FactoidName).join(Factoid.names)\
+            .add_entity(FactoidValue).join(Factoid.values)
+    if wild:
+        wild_matcher.load(session)
+        ids = wild_matcher.match(name)
+        if ids:
+            query = query.filter(FactoidName.id.in_(ids))
+        else:
+            query = query.filter(FactoidName.id == None)
+    else:
+        query = query.filter(FactoidName.name == escape_name(name))
+    return query
+
 def get_factoid(session, name, number, pattern, is_regex, all=False,
                 literal=False):
     """session: SQLAlchemy session
@@ -213,7 +477,15 @@ def get_factoid(session, name, number, pattern, is_regex, all=False,
     literal: Match factoid name literally (implies all)
     if all or literal, a list is returned; otherwise a single factoid is returned
     if nothing is found, either an empty list or None is returned
+    RegexpTimeout is raised if a regex pattern takes too long
     """
+    if pattern and is_regex:
+        return sql_regexp.limit(_get_factoid, session, name, number, pattern,
+                                is_regex, all, literal)
+    return _get_factoid(session, name, number, pattern, is_regex, all,
+                        literal)
+
+def _get_factoid(session, name, number, pattern, is_regex, all, literal):
     assert not (number and pattern), u'number and pattern cannot be used together'
     if literal:
         all = True # as mentioned in the docstring
@@ -224,17 +496,7 @@ def get_factoid(session, name, number, pattern, is_regex, all=False,
         passes = (False, True)
     for wild in passes:
         factoid = None
-        query = session.query(Factoid)\
-                .add_entity(FactoidName).join(Factoid.names)\
-                .add_entity(FactoidValue).join(Factoid.values)
-        if wild:
-            # Reversed LIKE because factoid name contains SQL wildcards if
-            # factoid supports arguments
-            query = query.filter(
-                    'lower(:fact) LIKE lower(name) ESCAPE :escape'
-                ).params(fact=name, escape='\\')
-        else:
-            query = query.filter(FactoidName.name == escape_name(name))
+        query = _name_query(session, name, wild)
         # For normal matches, restrict to the subset applicable
         if not literal:
             query = query.filter(FactoidName.wild == wild)
@@ -272,8 +534,128 @@ def get_factoid(session, name, number, pattern, is_regex, all=False,
         return []
     return None
 
+class FactoidCache(object):
+    """Cache of the (name, value, factoid id) rows that Get finds for a name.
+
+    Exact and wildcard matches are cached per name, and names that match
+    nothing are kept in a separate negative cache.
+    Anything that modifies factoids must call invalidate().
+    """
+
+    def __init__(self, size=10000, negative_size=10000):
+        self.positive = LRUCache(size)
+        self.negative = LRUCache(negative_size)
+        self.generation = 0
+        self.factpacks = None
+
+    def resize(self, size, negative_size):
+        self.positive.size = size
+        self.negative.size = negative_size
+
+    def _rows(self, session, name, wild):
+        if wild:
+            wild_matcher.load(session)
+            if not wild_matcher.match(name):
+                return []
+        query = _name_query(session, name, wild) \
+                .filter(FactoidName.wild == wild).order_by(FactoidValue.id)
+        return [(fname.name, fvalue.value, factoid.id)
+                for factoid, fname, fvalue in query.all()]
+
+    def lookup(self, session, name, number=None):
+        """Return the (name, value) of factoid[number] or a random factoid
+        matching name, or None.
+        """
+        key = name
+        if self.negative.get(key):
+            return None
+
+        generation = self.generation
+        entry = self.positive.get(key)
+        if entry is None:
+            entry = [self._rows(session, name, False), None]
+
+        result = None
+        for i, wild in enumerate((False, True)):
+            if entry[i] is None:
+                entry[i] = self._rows(session, name, wild)
+            rows = entry[i]
+            if number is not None:
+                index = max(0, int(number) - 1)
+                if index < len(rows):
+                    result = rows[index]
+                    break
+            elif rows:
+                result = choice(rows)
+                break
+
+        if generation == self.generation:
+            if entry[0] or entry[1]:
+                self.positive[key] = entry
+            else:
+                self.negative[key] = True
+
+        return result and result[:2] or None
+
+    def invalidate(self, factoid_ids=(), names=()):
+        """Forget cached lookups involving factoid_ids, or that could match
+        names (including wildcard names).
+        """
+        self.generation += 1
+        factoid_ids = set(factoid_ids)
+        keys = set(name.lower() for name in names)
+        wild = [re.compile(u'^%s$' % re.escape(name).replace(r'\$arg', '.+'),
+                           re.I | re.U | re.DOTALL)
+                for name in names if u'$arg' in name]
+
+        def matches_wild(key):
+            for pattern in wild:
+                if pattern.match(key):
+                    return True
+            return False
+
+        stale = []
+        for key, entry in self.positive.items():
+            if key.lower() in keys \
+                    or (entry[1] is not None and matches_wild(key)):
+                stale.append(key)
+            elif factoid_ids:
+                for rows in entry:
+                    if rows and [row for row in rows
+                                 if row[2] in factoid_ids]:
+                        stale.append(key)
+                        break
+        self.positive.discard(stale)
+
+        self.negative.discard([key for key, _ in self.negative.items()
+                               if key.lower() in keys or matches_wild(key)])
+
+    def clear(self):
+        self.generation += 1
+        self.positive.clear()
+        self.negative.clear()
+
+    def check_factpacks(self, session):
+        "Clear the cache if factpacks have been imported or removed"
+        state = tuple(session.query(func.count(Factpack.id),
+                                    func.max(Factpack.id)).one())
+        if self.factpacks is not None and state != self.factpacks:
+            log.info(u'Factpacks changed, clearing factoid cache')
+            wild_matcher.clear()
+            self.clear()
+        self.factpacks = state
+
+    def stats(self):
+        return {
+            'positive': self.positive.stats(),
+            'negative': self.negative.stats(),
+        }
+
+factoid_cache = FactoidCache()
+
 class Utils(Processor):
-    usage = u'literal <name> [( #<from number> | /<pattern>/[r] )]'
+    usage = u"""literal <name> [( #<from number> | /<pattern>/[r] )]
+    factoid cache stats"""
     feature = ('factoid',)
 
     @match(r'^literal\s+(.+?)(?:\s+#(\d+)|\s+(?:/(.+?)/(r?)))?$')
@@ -294,6 +676,13 @@ class Utils(Processor):
                     u'name': name,
                 })
 
+    @match(r'^factoid\s+cache\s+stat(?:istic)?s$')
+    def cache_stats(self, event):
+        stats = factoid_cache.stats()
+        event.addresponse(u'Factoid cache: %(size)i names, %(hits)i hits, '
+                          u'%(misses)i misses', stats['positive'])
+        event.addresponse(u'Negative cache: %(size)i names, %(hits)i hits, '
+                          u'%(misses)i misses', stats['negative'])
 
 class Forget(Processor):
     usage = u"""forget <name> [( #<number> | /<pattern>/[r] )]
@@ -312,6 +701,7 @@ class Forget(Processor):
             factoidadmin = auth_responses(event, u'factoidadmin')
             identities = get_identities(event)
             factoid = event.session.query(Factoid).get(factoids[0][0].id)
+            factoid_id = factoid.id
 
             if len(factoids) > 1 and pattern is not None:
                 event.addresponse(u'Pattern matches multiple factoids, please be more specific')
@@ -327,6 +717,7 @@ class Forget(Processor):
                     id = factoid.id
                     event.session.delete(factoid)
                     event.session.commit()
+                    event.session.after_commit(wild_matcher.remove, (), (id,))
                     log.info(u"Deleted factoid %s (%s) by %s/%s (%s)",
                             id, name, event.account, event.identity, event.sender['connection'])
                 else:
@@ -347,6 +738,7 @@ class Forget(Processor):
                     id = factoid.id
                     event.session.delete(factoid)
                     event.session.commit()
+                    event.session.after_commit(wild_matcher.remove, (), (id,))
                     log.info(u"Deleted factoid %s (%s) by %s/%s (%s)",
                             id, name, event.account, event.identity,
                             event.sender['connection'])
@@ -354,10 +746,13 @@ class Forget(Processor):
                     id = factoids[0][1].id
                     event.session.delete(factoids[0][1])
                     event.session.commit()
+                    event.session.after_commit(wild_matcher.remove, (id,))
                     log.info(u"Deleted name %s (%s) of factoid %s (%s) by %s/%s (%s)",
                             id, factoids[0][1].name, factoid.id, factoids[0][0].names[0].name,
                             event.account, event.identity, event.sender['connection'])
 
+            event.session.after_commit(factoid_cache.invalidate,
+                                       (factoid_id,))
             event.addresponse(True)
         else:
             factoids = get_factoid(event.session, name, None, pattern, is_regex, all=True, literal=True)
@@ -396,6 +791,10 @@ class Forget(Processor):
             factoid.names.append(name)
             event.session.save_or_update(factoid)
             event.session.commit()
+            event.session.after_commit(wild_matcher.add,
+                                       name.id, name.name, factoid.id)
+            event.session.after_commit(factoid_cache.invalidate,
+                                       (factoid.id,), (name.name,))
             event.addresponse(True)
             log.info(u"Added name '%s' to factoid %s (%s) by %s/%s (%s)",
                     name.name, factoid.id, factoid.names[0].name,
@@ -409,6 +808,9 @@ class Search(Processor):
 
     limit = IntOption('search_limit', u'Maximum number of results to return', 30)
     default = IntOption('search_default', u'Default number of results to return', 10)
+    use_index = BoolOption('search_index',
+            u'Search for words with the full-text index, rather than for '
+            u'substrings, unless the pattern is a regex', True)
 
     regex_re = re.compile(r'^/(.*)/(r?)$')
 
@@ -427,43 +829,116 @@ class Search(Processor):
             pattern = m.group(1)
             is_regex = bool(m.group(2))
 
+        terms = None
+        if self.use_index and not is_regex:
+            terms = search_terms(pattern).keys()
+
+        if terms:
+            query = self._index_query(event.session, terms, search_type)
+            matches = self._index_results(event.session, query
+                    .order_by(desc('score'), FactoidTerm.factoid_id)
+                    .offset(start).limit(limit).all())
+        else:
+            query = self._scan_query(event.session, pattern, is_regex,
+                                     search_type)
+            try:
+                matches = [(fname.name, len(factoid.values))
+                           for factoid, fname in sql_regexp.limit(
+                               query.offset(start).limit(limit).all)]
+            except RegexpTimeout:
+                event.addresponse(u'That pattern took too long to search for')
+                return
+
+        if matches:
+            event.addresponse(u'; '.join(u'%s [%s]' % match
+                                         for match in matches))
+        else:
+            try:
+                count = start and sql_regexp.limit(query.count) or 0
+            except RegexpTimeout:
+                count = 0
+            if count:
+                event.addresponse(u"I could only find %(number)d things that matched '%(pattern)s'", {
+                    u'number': count,
+                    u'pattern': origpattern,
+                })
+            else:
+                event.addresponse(u"I couldn't find anything that matched '%s'" % origpattern)
+
+    def _index_query(self, session, terms, search_type):
+        "Query (factoid_id, score) for factoids containing all of terms"
+        def term_query(query, terms):
+            query = query.filter(or_(*[and_(FactoidTerm.term >= term,
+                                            FactoidTerm.term < term + u'\uffff')
+                                       for term in terms]))
+            if search_type.startswith('fact'):
+                query = query.filter(FactoidTerm.name_id != None)
+            elif search_type.startswith('value'):
+                query = query.filter(FactoidTerm.value_id != None)
+            return query
+
+        query = term_query(session.query(FactoidTerm.factoid_id,
+                func.sum(FactoidTerm.frequency).label('score')), terms)
+        if len(terms) > 1:
+            for term in terms:
+                subquery = term_query(session.query(FactoidTerm.factoid_id),
+                                      [term])
+                query = query.filter(
+                        FactoidTerm.factoid_id.in_(subquery.subquery()))
+        return query.group_by(FactoidTerm.factoid_id)
+
+    def _index_results(self, session, rows):
+        "Return (name, number of values) for each factoid in rows"
+        ids = [row[0] for row in rows]
+        if not ids:
+            return []
+        names = {}
+        for factoid_id, name in session.query(FactoidName.factoid_id,
+                    FactoidName._name) \
+                .filter(FactoidName.factoid_id.in_(ids)) \
+                .order_by(FactoidName.id).all():
+            names.setdefault(factoid_id, unescape_name(name))
+        counts = dict(session.query(FactoidValue.factoid_id,
+                    func.count(FactoidValue.id)) \
+                .filter(FactoidValue.factoid_id.in_(ids)) \
+                .group_by(FactoidValue.factoid_id).all())
+        return [(names[id], counts.get(id, 0)) for id in ids if id in names]
+
+    def _scan_query(self, session, pattern, is_regex, search_type):
+        """Query (factoid, name) rows with a LIKE or regex pattern.
+        Matching names are found in a subquery, so that a factoid with many
+        matching values is only counted, and paginated, once per name.
+        """
         # Hack: We replace $arg with _%, but this won't match a partial
         # "$arg" string
         if is_regex:
-            filter_op = get_regexp_op(event.session)
+            filter_op = get_regexp_op(session)
             name_pattern = pattern.replace(r'\$arg', '_%')
         else:
             filter_op = lambda x, y: x.like(y, escape='#')
             pattern = '%%%s%%' % escape_like_re.sub(r'#\1', pattern)
             name_pattern = pattern.replace('$arg', '#_#%')
 
-        query = event.session.query(Factoid)\
-                             .join(Factoid.names).add_entity(FactoidName)\
-                             .join(Factoid.values)
-
+        name_ids = session.query(FactoidName.id)
         if search_type.startswith('fact'):
-            query = query.filter(filter_op(FactoidName.name, name_pattern))
-        elif search_type.startswith('value'):
-            query = query.filter(filter_op(FactoidValue.value, pattern))
+            name_ids = name_ids.filter(
+                    filter_op(FactoidName.name, name_pattern))
         else:
-            query = query.filter(or_(filter_op(FactoidName.name, name_pattern),
-                                     filter_op(FactoidValue.value, pattern)))
-
-        # Pre-evalute the iterable or the if statement will be True in SQLAlchemy 0.4. LP: #383286
-        matches = [match for match in query.all()]
-
-        bounded_matches = matches[start:start+limit]
-        if bounded_matches:
-            event.addresponse(u'; '.join(
-                u'%s [%s]' % (fname.name, len(factoid.values))
-                for factoid, fname in bounded_matches))
-        elif len(matches):
-            event.addresponse(u"I could only find %(number)d things that matched '%(pattern)s'", {
-                u'number': len(matches),
-                u'pattern': origpattern,
-            })
-        else:
-            event.addresponse(u"I couldn't find anything that matched '%s'" % origpattern)
+            name_ids = name_ids.filter(
+                    FactoidValue.factoid_id == FactoidName.factoid_id)
+            if search_type.startswith('value'):
+                name_ids = name_ids.filter(
+                        filter_op(FactoidValue.value, pattern))
+            else:
+                name_ids = name_ids.filter(or_(
+                        filter_op(FactoidName.name, name_pattern),
+                        filter_op(FactoidValue.value, pattern)))
+
+        return session.query(Factoid)\
+                      .join(Factoid.names).add_entity(FactoidName)\
+                      .filter(FactoidName.id.in_(
+                              name_ids.distinct().subquery()))\
+                      .order_by(FactoidName.id)
 
 def _interpolate(message, event):
     "Expand factoid variables"
@@ -492,12 +967,19 @@ class Get(Processor, RPC):
 
     interrogatives = ListOption('interrogatives', 'Question words to strip', default_interrogatives)
     verbs = ListOption('verbs', 'Verbs that split name from value', default_verbs)
+    cache_size = IntOption('cache_size', 'Number of factoid names to cache', 10000)
+    negative_cache_size = IntOption('negative_cache_size',
+            'Number of unknown factoid names to cache', 10000)
+    factpack_check = IntOption('factpack_check',
+            'Interval between checks for factpack changes, in seconds', 60)
 
     def __init__(self, name):
         super(Get, self).__init__(name)
         RPC.__init__(self)
 
     def setup(self):
+        super(Get, self).setup()
+        factoid_cache.resize(self.cache_size, self.negative_cache_size)
         self.get.im_func.pattern = re.compile(
                 r'^(?:(?:%s)\s+(?:(?:%s)\s+)?)?(.+?)(?:\s+#(\d+))?(?:\s+/(.+?)/(r?))?$'
                   % ('|'.join(self.interrogatives),
@@ -505,18 +987,30 @@ class Get(Processor, RPC):
 
     @handler
     def get(self, event, name, number, pattern, is_regex):
-        response = self.remote_get(name, number, pattern, is_regex, event)
+        try:
+            response = self.remote_get(name, number, pattern, is_regex, event)
+        except RegexpTimeout:
+            event.addresponse(u'That pattern took too long to search for')
+            return
         if response:
             event.addresponse(response)
 
+    @periodic(config_key='factpack_check')
+    def check_factpacks(self, event):
+        factoid_cache.check_factpacks(event.session)
+
     def remote_get(self, name, number=None, pattern=None, is_regex=None, event={}):
-        factoid = get_factoid(event.session, name, number, pattern, is_regex)
+        if pattern:
+            factoid = get_factoid(event.session, name, number, pattern, is_regex)
+            if factoid:
+                factoid = (factoid[1].name, factoid[2].value)
+        else:
+            factoid = factoid_cache.lookup(event.session, name, number)
 
         if factoid:
-            (factoid, fname, fvalue) = factoid
-            reply = fvalue.value
-            oname = fname.name
-            pattern = re.escape(fname.name).replace(r'\$arg', '(.*)')
+            (fname, reply) = factoid
+            oname = fname
+            pattern = re.escape(fname).replace(r'\$arg', '(.*)')
             args = re.match(pattern, name, re.I | re.U).groups()
 
             for i, capture in enumerate(args):
@@ -600,6 +1094,11 @@ class Set(Processor):
         factoid.values.append(fvalue)
         event.session.save_or_update(factoid)
         event.session.commit()
+        for fname in factoid.names:
+            event.session.after_commit(wild_matcher.add,
+                                       fname.id, fname.name, factoid.id)
+        event.session.after_commit(factoid_cache.invalidate,
+                                   (factoid.id,), (name,))
         self.last_set_factoid=factoid.names[0].name
         log.info(u"Added value '%s' to factoid %s (%s) by %s/%s (%s)",
                 fvalue.value, factoid.id, factoid.names[0].name,
@@ -661,6 +1160,8 @@ class Modify(Processor):
             factoid[2].value += suffix
             event.session.save_or_update(factoid[2])
             event.session.commit()
+            event.session.after_commit(factoid_cache.invalidate,
+                                       (factoid[0].id,))
 
             log.info(u"Appended '%s' to value %s of factoid %s (%s) by %s/%s (%s)",
                     suffix, factoid[2].id, factoid[0].id, oldvalue, event.account,
@@ -754,6 +1255,8 @@ class Modify(Processor):
 
             event.session.save_or_update(factoid[2])
             event.session.commit()
+            event.session.after_commit(factoid_cache.invalidate,
+                                       (factoid[0].id,))
 
             log.info(u"Applying '%s' to value %s of factoid %s (%s) by %s/%s (%s)",
                     operation, factoid[2].id, factoid[0].id, oldvalue, event.account, event.identity, event.sender['connection'])
@@ -2,20 +2,26 @@
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 from urllib2 import URLError
 from urlparse import urljoin
 
 import feedparser
 from html2text import html2text_file
+from twisted.internet import defer, reactor, threads
 
+import ibid
+from ibid.compat import hashlib
 from ibid.config import IntOption
 from ibid.db import IbidUnicode, IbidUnicodeText, Integer, DateTime, \
-                    Table, Column, ForeignKey, Base, VersionedSchema
+                    Table, Column, ForeignKey, UniqueConstraint, Base, \
+                    VersionedSchema
+from ibid.event import Event
 from ibid.plugins import Processor, match, authorise, periodic
-from ibid.utils import cacheable_download, human_join
+from ibid.utils import cacheable_download, generic_webservice, human_join
 from ibid.utils.html import get_html_parse_tree
+from ibid.utils.http import http_client
 
 features = {'feeds': {
     'description': u'Displays articles from RSS and Atom feeds',
@@ -35,6 +41,10 @@ class Feed(Base):
     Column('time', DateTime, nullable=False),
     Column('source', IbidUnicode(32, case_insensitive=True), index=True),
     Column('target', IbidUnicode(32, case_insensitive=True), index=True),
+    Column('etag', IbidUnicode(255)),
+    Column('modified', IbidUnicode(64)),
+    Column('interval', Integer),
+    Column('polled', DateTime),
     useexisting=True)
 
     class FeedSchema(VersionedSchema):
@@ -64,8 +74,13 @@ class Feed(Base):
             self.add_index(self.table.c.name)
             self.add_index(self.table.c.source)
             self.add_index(self.table.c.target)
+        def upgrade_4_to_5(self):
+            self.add_column(Column('etag', IbidUnicode(255)))
+            self.add_column(Column('modified', IbidUnicode(64)))
+            self.add_column(Column('interval', Integer))
+            self.add_column(Column('polled', DateTime))
 
-    __table__.versioned_schema = FeedSchema(__table__, 4)
+    __table__.versioned_schema = FeedSchema(__table__, 5)
 
     feed = None
     entries = None
@@ -96,6 +111,173 @@ class Feed(Base):
         else:
             return self.name
 
+class FeedEntry(Base):
+    __table__ = Table('feed_entries', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('feed_id', Integer, ForeignKey('feeds.id'), nullable=False,
+           index=True),
+    Column('entry', IbidUnicode(40), nullable=False),
+    Column('updated', IbidUnicode(40), nullable=False),
+    Column('time', DateTime, nullable=False),
+    UniqueConstraint('feed_id', 'entry'),
+    useexisting=True)
+
+    __table__.versioned_schema = VersionedSchema(__table__, 1)
+
+    def __init__(self, feed_id, entry, updated):
+        self.feed_id = feed_id
+        self.entry = entry
+        self.updated = updated
+        self.time = datetime.utcnow()
+
+def entry_hash(value):
+    "Return a short, fixed-length identifier for an entry's id or timestamp"
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return unicode(hashlib.sha1(value or '').hexdigest())
+
+class FeedPoller(object):
+    """Fetches feeds concurrently from the reactor, with conditional GETs.
+    Each feed is parsed and compared with the entries seen last time in a
+    thread of its own, so a slow feed doesn't hold up the others.
+    Feeds that change rarely are polled less often.
+    """
+
+    def __init__(self):
+        self.semaphore = defer.DeferredSemaphore(8)
+        self.polling = set()
+        self.min_interval = 300
+        self.max_interval = 3600
+        self.timeout = 60
+
+    def configure(self, concurrency, min_interval, max_interval, timeout):
+        if concurrency != self.semaphore.limit:
+            self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.timeout = timeout
+
+    def due(self, feed, now):
+        "Is feed due to be polled at now?"
+        if feed.polled is None:
+            return True
+        return feed.polled + timedelta(seconds=feed.interval
+                                       or self.min_interval) <= now
+
+    def poll(self, feed):
+        "Start polling feed, unless it is already being polled"
+        reactor.callFromThread(self._start, feed.id, feed.url,
+                               feed.etag, feed.modified)
+
+    def _start(self, feed_id, url, etag, modified):
+        if feed_id in self.polling:
+            return
+        self.polling.add(feed_id)
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag.encode('utf-8')
+        if modified:
+            headers['If-Modified-Since'] = modified.encode('utf-8')
+
+        def failed(failure):
+            log.warning(u'Exception "%s" occured while polling feed %s',
+                        failure.getErrorMessage(), url)
+            return None
+        d = self.semaphore.run(http_client.fetch, url, headers=headers,
+                               timeout=self.timeout)
+        d.addErrback(failed)
+        d.addCallback(lambda response: threads.deferToThread(self.update,
+                                                             feed_id, response))
+        d.addErrback(lambda failure: log.error(
+                u'Exception occured while updating feed %s:\n%s',
+                url, failure.getTraceback()))
+        d.addBoth(lambda result: self.polling.discard(feed_id))
+        return d
+
+    def update(self, feed_id, response):
+        """Record the result of polling a feed, and announce any new or
+        updated entries. response is None if the feed couldn't be fetched.
+        """
+        session = ibid.databases.ibid()
+        try:
+            feed = session.query(Feed).get(feed_id)
+            if feed is None or feed.source is None or feed.target is None:
+                return
+
+            changes = []
+            if response is not None and response.status == 200:
+                headers = response.headers
+                feed.etag = headers.get('etag') \
+                        and unicode(headers['etag'], 'latin-1')[:255]
+                feed.modified = headers.get('last-modified') \
+                        and unicode(headers['last-modified'], 'latin-1')[:64]
+                entries = feedparser.parse(response.data)['entries']
+                changes = self._compare(session, feed, entries)
+
+            interval = feed.interval or self.min_interval
+            if changes:
+                interval /= 2
+            else:
+                interval = interval * 3 / 2
+            feed.interval = max(self.min_interval,
+                                min(self.max_interval, interval))
+            feed.polled = datetime.utcnow()
+            session.commit()
+            name, source, target = feed.name, feed.source, feed.target
+        finally:
+            session.close()
+
+        if changes:
+            event = Event(source, u'delayed')
+            ibid.dispatcher.delayed_call(self._announce, event, name, source,
+                                         target, changes)
+
+    def _compare(self, session, feed, entries):
+        """Update the stored entries of feed, and return (status, title) for
+        each new or updated entry. Nothing is announced until some entries
+        have been stored, so a feed's backlog isn't announced after failed
+        or empty polls.
+        """
+        stored = dict((entry.entry, entry) for entry
+                      in session.query(FeedEntry).filter_by(feed_id=feed.id))
+        first = not stored
+
+        changes = []
+        current = set()
+        for entry in reversed(entries):
+            id = entry_hash(entry.get('id', entry.get('title')))
+            if id in current:
+                continue
+            current.add(id)
+            updated = entry_hash(entry.get('updated'))
+            title = entry.get('title', u'')
+            if id not in stored:
+                session.save_or_update(FeedEntry(feed.id, id, updated))
+                changes.append((u'New', title))
+            elif stored[id].updated != updated:
+                stored[id].updated = updated
+                stored[id].time = datetime.utcnow()
+                session.save_or_update(stored[id])
+                changes.append((u'Updated', title))
+
+        for id, entry in stored.iteritems():
+            if id not in current:
+                session.delete(entry)
+
+        if first:
+            return []
+        return changes
+
+    def _announce(self, event, name, source, target, changes):
+        for status, title in changes:
+            event.addresponse(u'%(status)s item in %(feed)s: %(title)s', {
+                    'status': status,
+                    'feed': name,
+                    'title': title,
+                }, source=source, target=target, address=False)
+
+feed_poller = FeedPoller()
+
 class Manage(Processor):
     usage = u"""
     add feed <url> as <name>
@@ -117,7 +299,10 @@ class Manage(Processor):
             event.addresponse(u"I already have the %s feed", name)
             return
 
-        valid = bool(feedparser.parse(url)["version"])
+        try:
+            valid = bool(feedparser.parse(generic_webservice(url))["version"])
+        except URLError:
+            valid = False
 
         if not valid:
             try:
@@ -126,7 +311,8 @@ class Manage(Processor):
                         'type': re.compile(r'^application/(atom|rss)\+xml$'),
                         'href': re.compile(r'.+')}):
                     newurl = urljoin(url, alternate["href"])
-                    valid = bool(feedparser.parse(newurl)["version"])
+                    valid = bool(feedparser.parse(
+                            generic_webservice(newurl))["version"])
 
                     if valid:
                         url = newurl
@@ -167,6 +353,8 @@ class Manage(Processor):
         if not feed:
             event.addresponse(u"I don't have the %s feed anyway", name)
         else:
+            event.session.query(FeedEntry).filter_by(feed_id=feed.id) \
+                    .delete()
             event.session.delete(feed)
             event.session.commit()
             log.info(u"Deleted feed '%s' by %s/%s (%s): %s", name,
@@ -184,6 +372,10 @@ class Manage(Processor):
         else:
             feed.source = None
             feed.target = None
+            # Start afresh if polling is enabled again
+            feed.polled = None
+            event.session.query(FeedEntry).filter_by(feed_id=feed.id) \
+                    .delete()
             event.session.commit()
             log.info(u"Disabled polling on feed '%s' by %s/%s (%s)",
                     name, event.account, event.identity,
@@ -211,7 +403,20 @@ class Retrieve(Processor):
     article ( <number> | /<pattern>/ ) from <name>"""
     feature = ('feeds',)
 
-    interval = IntOption('interval', 'Feed Poll interval (in seconds)', 300)
+    interval = IntOption('interval',
+            'Minimum feed poll interval (in seconds)', 300)
+    max_interval = IntOption('max_interval',
+            'Poll interval (in seconds) for feeds that rarely change', 3600)
+    check_interval = IntOption('check_interval',
+            'How often to check for feeds due to be polled (in seconds)', 60)
+    concurrency = IntOption('concurrency',
+            'Maximum number of feeds to fetch at once', 8)
+    timeout = IntOption('timeout', 'Feed fetch timeout (in seconds)', 60)
+
+    def setup(self):
+        super(Retrieve, self).setup()
+        feed_poller.configure(self.concurrency, self.interval,
+                              self.max_interval, self.timeout)
 
     @match(r'^(?:latest|last)\s+(?:(\d+)\s+)?articles\s+from\s+(.+?)'
            r'(?:\s+start(?:ing)?\s+(?:at\s+|from\s+)?(\d+))?$')
@@ -282,49 +487,15 @@ class Retrieve(Processor):
             'summary': summary,
         })
 
-    last_seen = {}
-    @periodic(config_key='interval')
+    @periodic(config_key='check_interval')
     def poll(self, event):
         feeds = event.session.query(Feed) \
                 .filter(Feed.source != None) \
                 .filter(Feed.target != None).all()
 
+        now = datetime.utcnow()
         for feed in feeds:
-            try:
-                feed.update(max_age=self.interval)
-            except Exception, e:
-                if isinstance(e, URLError):
-                    log.warning(u'Exception "%s" occured while polling '
-                                u'feed %s from %s', e, feed, feed.url)
-                else:
-                    log.exception(u'Exception "%s" occured while polling '
-                                  u'feed %s from %s', e, feed, feed.url)
-                continue
-
-            if not feed.entries:
-                continue
-
-            if feed.name not in self.last_seen:
-                seen = {}
-                for entry in feed.entries:
-                    id = entry.get('id', entry.title)
-                    seen[id] = entry.updated_parsed
-                self.last_seen[feed.name] = seen
-                continue
-
-            old_seen = self.last_seen[feed.name]
-            seen = {}
-            for entry in reversed(feed.entries):
-                id = entry.get('id', entry.title)
-                seen[id] = entry.updated_parsed
-                if entry.updated_parsed != old_seen.get(id):
-                    event.addresponse(
-                        u"%(status)s item in %(feed)s: %(title)s", {
-                            'status': id in old_seen and u'Updated' or u'New',
-                            'feed': feed.name,
-                            'title': entry.title,
-                        },
-                        source=feed.source, target=feed.target, adress=False)
-            self.last_seen[feed.name] = seen
+            if feed_poller.due(feed, now):
+                feed_poller.poll(feed)
 
 # vi: set et sta sw=4 ts=4:
@@ -1,7 +1,6 @@
 # Copyright (c) 2008-2010, Stefano Rivera, JJ Williams
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
-from urllib2 import urlopen
 from urllib import urlencode
 from time import strptime, strftime
 import logging
@@ -12,8 +11,8 @@ except ImportError:
 
 from ibid.compat import defaultdict
 from ibid.plugins import Processor, match
-from ibid.utils import human_join
-from ibid.config import Option, BoolOption
+from ibid.utils import generic_webservice, human_join
+from ibid.config import Option, BoolOption, IntOption
 
 log = logging.getLogger('plugins.film')
 
@@ -28,12 +27,14 @@ class TVShow(Processor):
 
     feature = ('tvshow',)
 
+    cache_ttl = IntOption('cache_ttl', 'Seconds to cache show information for', 60*60)
+
     def remote_tvrage(self, show):
         info_url = 'http://services.tvrage.com/tools/quickinfo.php?%s'
 
-        info = urlopen(info_url % urlencode({'show': show.encode('utf-8')}))
-
-        info = info.read()
+        info = generic_webservice(info_url
+                % urlencode({'show': show.encode('utf-8')}),
+                ttl=self.cache_ttl)
         info = info.decode('utf-8')
         if info.startswith('No Show Results Were Found'):
             return
@@ -16,7 +16,7 @@ from dateutil.tz import gettz, tzlocal, tzoffset
 from ibid.plugins import Processor, match
 from ibid.utils import json_webservice, human_join, format_date
 from ibid.utils.html import get_html_parse_tree
-from ibid.config import Option, DictOption
+from ibid.config import Option, DictOption, IntOption
 from ibid.compat import defaultdict
 
 log = logging.getLogger('plugins.geography')
@@ -48,9 +48,10 @@ class Distance(Processor):
 
     unit_names = DictOption('unit_names', 'Names of units in which to specify distances', default_unit_names)
     radius_values = DictOption('radius_values', 'Radius of the earth in the units in which to specify distances', default_radius_values)
+    cache_ttl = IntOption('cache_ttl', 'Seconds to cache place lookups for', 7*24*60*60)
 
     def get_place_data(self, place, num):
-        return json_webservice('http://ws.geonames.org/searchJSON', {'q': place, 'maxRows': num, 'username': 'ibid'})
+        return json_webservice('http://ws.geonames.org/searchJSON', {'q': place, 'maxRows': num, 'username': 'ibid'}, ttl=self.cache_ttl)
 
     def get_place(self, place):
         js = self.get_place_data(place, 1)
@@ -238,6 +239,7 @@ class TimeZone(Processor):
 
     zoneinfo = Option('zoneinfo', 'Timezone info directory', '/usr/share/zoneinfo')
     custom_zones = DictOption('timezones', 'Custom timezone names', CUSTOM_ZONES)
+    cache_ttl = IntOption('cache_ttl', 'Seconds to cache place lookups for', 7*24*60*60)
 
     countries = {}
     timezones = {}
@@ -317,12 +319,12 @@ class TimeZone(Processor):
         raise TimezoneException(u"I don't know about the %s timezone" % (string,))
 
     def _geonames_lookup(self, place):
-        search = json_webservice('http://ws.geonames.org/searchJSON', {'q': place, 'maxRows': 1, 'username': 'ibid'})
+        search = json_webservice('http://ws.geonames.org/searchJSON', {'q': place, 'maxRows': 1, 'username': 'ibid'}, ttl=self.cache_ttl)
         if search['totalResultsCount'] == 0:
             return None
 
         city = search['geonames'][0]
-        timezone = json_webservice('http://ws.geonames.org/timezoneJSON', {'lat': city['lat'], 'lng': city['lng'], 'username': 'ibid'})
+        timezone = json_webservice('http://ws.geonames.org/timezoneJSON', {'lat': city['lat'], 'lng': city['lng'], 'username': 'ibid'}, ttl=self.cache_ttl)
 
         if 'timezoneId' in timezone:
             return gettz(timezone['timezoneId'])
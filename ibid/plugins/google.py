@@ -1,15 +1,17 @@
 # Copyright (c) 2008-2011, Michael Gorven, Stefano Rivera
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
-from httplib import BadStatusLine
 import re
 from urllib import urlencode
 
-from ibid.compat import ElementTree
+from twisted.internet.defer import DeferredList
+
+from ibid.compat import ElementTree, json
 from ibid.config import Option
-from ibid.plugins import Processor, match
-from ibid.utils import decode_htmlentities, json_webservice
+from ibid.plugins import Processor, match, asynchronous
+from ibid.utils import decode_htmlentities, JSONException
 from ibid.utils.html import get_html_parse_tree
+from ibid.utils.http import http_client
 
 features = {'google': {
     'description': u'Retrieves results from Google and Google Calculator.',
@@ -29,9 +31,10 @@ class GoogleAPISearch(Processor):
     referer = Option('referer', 'The referer string to use (API searches)', default_referer)
 
     def _google_api_search(self, query, resultsize="large", country=None):
+        "Returns a Deferred that fires with the decoded results"
         params = {
             'v': '1.0',
-            'q': query,
+            'q': query.encode('utf-8'),
             'rsz': resultsize,
         }
         if country is not None:
@@ -40,15 +43,21 @@ class GoogleAPISearch(Processor):
             params['key'] = self.api_key
 
         headers = {'referer': self.referer}
-        return json_webservice('http://ajax.googleapis.com/ajax/services/search/web', params, headers)
+        return http_client.fetch(
+                'http://ajax.googleapis.com/ajax/services/search/web?'
+                + urlencode(params), headers=headers) \
+                .addCallback(self._decode)
+
+    def _decode(self, response):
+        try:
+            return json.loads(response.data)
+        except ValueError, e:
+            raise JSONException(e)
 
     @match(r'^google(?:\.com?)?(?:\.([a-z]{2}))?\s+(?:for\s+)?(.+?)$')
+    @asynchronous
     def search(self, event, country, query):
-        try:
-            items = self._google_api_search(query, country=country)
-        except BadStatusLine:
-            event.addresponse(u"Google appears to be broken (or more likely, my connection to it)")
-            return
+        items = yield self._google_api_search(query, country=country)
 
         results = []
         for item in items["responseData"]["results"]:
@@ -61,13 +70,16 @@ class GoogleAPISearch(Processor):
             event.addresponse(u"Wow! Google couldn't find anything")
 
     @match(r'^(?:rank|(?:google(?:fight|compare|cmp)))\s+(?:for\s+)?(.+?)\s+and\s+(.+?)$')
+    @asynchronous
     def googlefight(self, event, term1, term2):
-        try:
-            count1 = int(self._google_api_search(term1, "small")["responseData"]["cursor"].get("estimatedResultCount", 0))
-            count2 = int(self._google_api_search(term2, "small")["responseData"]["cursor"].get("estimatedResultCount", 0))
-        except BadStatusLine:
-            event.addresponse(u"Google appears to be broken (or more likely, my connection to it)")
-            return
+        results = yield DeferredList([
+                self._google_api_search(term1, "small"),
+                self._google_api_search(term2, "small"),
+            ], fireOnOneErrback=True, consumeErrors=True) \
+            .addErrback(lambda failure: failure.value.subFailure)
+        count1, count2 = [int(items["responseData"]["cursor"]
+                              .get("estimatedResultCount", 0))
+                          for success, items in results]
 
         event.addresponse(u'%(firstterm)s wins with %(firsthits)i hits, %(secondterm)s had %(secondhits)i hits',
             (count1 > count2 and {
@@ -1,24 +1,148 @@
 # Copyright (c) 2008-2010, Michael Gorven, Stefano Rivera
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
+from datetime import datetime, timedelta
 import string
 from random import choice
 import logging
 
 import ibid
-from ibid.config import Option
+from ibid.config import Option, IntOption
 from ibid.compat import any
-from ibid.db import eagerload, IntegrityError, and_, or_
+from ibid.db import eagerload, IntegrityError, and_, or_, func, \
+                    Table, Column, Integer, DateTime, Base, VersionedSchema
 from ibid.db.models import Account, Identity, Attribute, Credential, Permission
-from ibid.plugins import Processor, match, handler, auth_responses, authorise
+from ibid.plugins import Processor, match, handler, periodic, auth_responses, \
+                         authorise
 from ibid.utils import human_join
+from ibid.utils.cache import LRUCache
 from ibid.auth import hash
 
 features = {}
-identify_cache = {}
 
 log = logging.getLogger('plugins.identity')
 
+class IdentityInvalidation(Base):
+    """Accounts and identities whose cached details are out of date.
+    Polled by bot processes that share the database.
+    """
+    __table__ = Table('identity_invalidations', Base.metadata,
+        Column('id', Integer, primary_key=True),
+        Column('account_id', Integer),
+        Column('identity_id', Integer),
+        Column('time', DateTime, nullable=False, index=True),
+        extend_existing=True)
+
+    __table__.versioned_schema = VersionedSchema(__table__, 1)
+
+    def __init__(self, account_id=None, identity_id=None):
+        self.account_id = account_id
+        self.identity_id = identity_id
+        self.time = datetime.utcnow()
+
+class IdentityCache(object):
+    """Cache of who connections are, identity ids, and account identities.
+
+    Anything that attaches identities to or detaches them from accounts must
+    call invalidate(). If broadcast is set, invalidations are also written
+    to the database, for other bot processes to poll().
+    """
+
+    def __init__(self, size=10000, ttl=3600):
+        self.connections = LRUCache(size, ttl)
+        self.identities = LRUCache(size, ttl)
+        self.accounts = LRUCache(size, ttl)
+        self.generation = 0
+        self.broadcast = False
+        self.last_invalidation = None
+
+    def resize(self, size, ttl):
+        for cache in (self.connections, self.identities, self.accounts):
+            cache.size = size
+            cache.ttl = ttl
+
+    def invalidate(self, account_ids=(), identity_ids=(), session=None):
+        """Forget cached details involving account_ids or identity_ids.
+        If session (an event's session) is given, they are forgotten once
+        the changes made in it are committed.
+        """
+        if session is None:
+            self._forget(account_ids, identity_ids)
+            return
+
+        if self.broadcast:
+            for account_id in account_ids:
+                if account_id is not None:
+                    session.save_or_update(
+                            IdentityInvalidation(account_id=account_id))
+            for identity_id in identity_ids:
+                session.save_or_update(
+                        IdentityInvalidation(identity_id=identity_id))
+        session.after_commit(self._forget, account_ids, identity_ids)
+        if self.broadcast:
+            session.commit()
+
+    def _forget(self, account_ids, identity_ids):
+        self.generation += 1
+        account_ids = set(account_id for account_id in account_ids
+                          if account_id is not None)
+        identity_ids = set(identity_ids)
+
+        self.connections.discard([key for key, (identity_id, account_id)
+                                  in self.connections.items()
+                                  if identity_id in identity_ids
+                                  or account_id in account_ids])
+        self.identities.discard([key for key, identity_id
+                                 in self.identities.items()
+                                 if identity_id in identity_ids])
+        self.accounts.discard([account_id for account_id, identities
+                               in self.accounts.items()
+                               if account_id in account_ids
+                               or identity_ids.intersection(identities)])
+
+    def remember(self, key, identity_id, account_id, generation):
+        "Cache who connection key is, unless invalidated since generation"
+        if generation == self.generation:
+            self.connections[key] = (identity_id, account_id)
+
+    def poll(self, session, expire=timedelta(days=1)):
+        "Apply the invalidations other processes have written since last poll"
+        if self.last_invalidation is None:
+            self.last_invalidation = session.query(
+                    func.max(IdentityInvalidation.id)).scalar() or 0
+            return
+
+        rows = session.query(IdentityInvalidation) \
+                .filter(IdentityInvalidation.id > self.last_invalidation) \
+                .order_by(IdentityInvalidation.id).all()
+        if rows:
+            self.invalidate(
+                    account_ids=[row.account_id for row in rows
+                                 if row.account_id is not None],
+                    identity_ids=[row.identity_id for row in rows
+                                  if row.identity_id is not None])
+            self.last_invalidation = rows[-1].id
+
+        session.query(IdentityInvalidation) \
+                .filter(IdentityInvalidation.time < datetime.utcnow() - expire) \
+                .delete()
+        session.commit()
+
+    def clear(self):
+        self.generation += 1
+        self.connections.clear()
+        self.identities.clear()
+        self.accounts.clear()
+
+    def stats(self):
+        return {
+            'connections': self.connections.stats(),
+            'identities': self.identities.stats(),
+            'accounts': self.accounts.stats(),
+        }
+
+identity_cache = IdentityCache()
+
 features['accounts'] = {
     'description': u'Manage users accounts with the bot. An account represents '
                    u'a person. An account has one or more identities, which is '
@@ -76,7 +200,9 @@ class Accounts(Processor):
             log.info(u"Attached identity %s (%s on %s) to account %s (%s)",
                     identity.id, identity.identity, identity.source, account.id, account.username)
 
-        identify_cache.clear()
+        identity_cache.invalidate(account_ids=(account.id,),
+                identity_ids=identity and (identity.id,) or (),
+                session=event.session)
         event.addresponse(True)
 
     @match(r'^delete\s+(?:(my)\s+account|account\s+(.+))$')
@@ -102,7 +228,8 @@ class Accounts(Processor):
 
         event.session.delete(account)
         event.session.commit()
-        identify_cache.clear()
+        identity_cache.invalidate(account_ids=(account.id,),
+                                  session=event.session)
 
         log.info(u"Deleted account %s (%s) by %s/%s (%s)",
                 account.id, account.username, event.account, event.identity, event.sender['connection'])
@@ -134,7 +261,6 @@ class Accounts(Processor):
 
         event.session.save_or_update(account)
         event.session.commit()
-        identify_cache.clear()
 
         log.info(u"Renamed account %s (%s) to %s by %s/%s (%s)",
                 account.id, oldname, account.username, event.account, event.identity, event.sender['connection'])
@@ -190,11 +316,12 @@ class Identities(Processor):
                     currentidentity.account_id = account.id
                     event.session.save_or_update(currentidentity)
 
-                    identify_cache.clear()
-
                     event.addresponse(u"I've created the account %s for you", username)
 
                     event.session.commit()
+                    identity_cache.invalidate(account_ids=(account.id,),
+                            identity_ids=(currentidentity.id,),
+                            session=event.session)
                     log.info(u"Created account %s (%s) by %s/%s (%s)",
                             account.id, account.username, event.account, event.identity, event.sender['connection'])
                     log.info(u"Attached identity %s (%s on %s) to account %s (%s)",
@@ -253,7 +380,9 @@ class Identities(Processor):
             event.session.save_or_update(ident)
             event.session.commit()
 
-            identify_cache.clear()
+            identity_cache.invalidate(account_ids=(account.id,),
+                                      identity_ids=(ident.id,),
+                                      session=event.session)
 
             event.addresponse(True)
             log.info(u"Attached identity %s (%s on %s) to account %s (%s) by %s/%s (%s)",
@@ -277,10 +406,12 @@ class Identities(Processor):
                 identity = Identity(source, user)
             identity.account_id = account_id
             event.session.save_or_update(identity)
-            identify_cache.clear()
 
             del self.tokens[token]
             event.session.commit()
+            identity_cache.invalidate(account_ids=(account_id,),
+                                      identity_ids=(identity.id,),
+                                      session=event.session)
 
             event.addresponse(u'Identity added')
 
@@ -311,7 +442,9 @@ class Identities(Processor):
             event.session.save_or_update(identity)
             event.session.commit()
 
-            identify_cache.clear()
+            identity_cache.invalidate(account_ids=(account.id,),
+                                      identity_ids=(identity.id,),
+                                      session=event.session)
 
             event.addresponse(True)
             log.info(u"Removed identity %s (%s on %s) from account %s (%s) by %s/%s (%s)",
@@ -453,28 +586,47 @@ class Identify(Processor):
     processed = True
     event_types = (u'message', u'state', u'action', u'notice')
 
+    cache_size = IntOption('cache_size',
+            u'Maximum number of connections, identities and accounts to cache',
+            10000)
+    cache_ttl = IntOption('cache_ttl', u'Seconds to cache identities for',
+            3600)
+    invalidation_poll = IntOption('invalidation_poll',
+            u'Share identity cache invalidations with other bot processes '
+            u'using this database, polling every so many seconds (0 to '
+            u'disable)', 0)
+
+    def setup(self):
+        super(Identify, self).setup()
+        identity_cache.resize(self.cache_size, self.cache_ttl)
+        identity_cache.broadcast = bool(self.invalidation_poll)
+
     @handler
     def handle(self, event):
         if event.sender:
-            if (event.source, event.sender['connection']) in identify_cache:
-                (event.identity, event.account) = identify_cache[(event.source, event.sender['connection'])]
+            key = (event.source, event.sender['connection'])
+            cached = identity_cache.connections.get(key)
+            if cached is not None:
+                (event.identity, event.account) = cached
+                event.identities = get_identities(event)
                 return
 
+            generation = identity_cache.generation
             identity = event.session.query(Identity) \
                     .options(eagerload('account')) \
                     .filter_by(source=event.source,
                                identity=event.sender['id']) \
                     .first()
+            created = False
             if not identity:
                 identity = Identity(event.source, event.sender['id'])
                 event.session.save_or_update(identity)
                 try:
                     event.session.commit()
+                    created = True
                     log.info(u'Created identity %s for %s on %s', identity.id, identity.identity, identity.source)
                 except IntegrityError:
                     event.session.rollback()
-                    event.session.close()
-                    del event['session']
                     log.debug(u'Race encountered creating identity for %s on %s', event.sender['id'], event.source)
                     identity = event.session.query(Identity) \
                             .options(eagerload('account')) \
@@ -487,19 +639,45 @@ class Identify(Processor):
                 event.account = identity.account.id
             else:
                 event.account = None
-            identify_cache[(event.source, event.sender['connection'])] = (event.identity, event.account)
+            if created:
+                # Not cached until it exists for other threads, too
+                event.session.after_commit(identity_cache.remember, key,
+                        event.identity, event.account, generation)
+            else:
+                identity_cache.remember(key, event.identity, event.account,
+                                        generation)
+            event.identities = get_identities(event)
+
+    @periodic(config_key='invalidation_poll')
+    def poll_invalidations(self, event):
+        identity_cache.poll(event.session)
 
 def get_identities(event):
+    "Return the ids of all the sender's identities"
+    if 'identities' in event:
+        return event.identities
     if event.account:
-        account = event.session.query(Account).get(event.account)
-        return [identity.id for identity in account.identities]
+        identities = identity_cache.accounts.get(event.account)
+        if identities is None:
+            generation = identity_cache.generation
+            account = event.session.query(Account).get(event.account)
+            identities = tuple(identity.id for identity in account.identities)
+            if generation == identity_cache.generation:
+                identity_cache.accounts[event.account] = identities
+        return identities
     else:
         return (event.identity,)
 
 def identify(session, source, id):
-    identity = session.query(Identity) \
-                      .filter_by(source=source, identity=id).first()
-    return identity and identity.id
+    key = (source, id)
+    identity_id = identity_cache.identities.get(key)
+    if identity_id is None:
+        identity = session.query(Identity) \
+                          .filter_by(source=source, identity=id).first()
+        if not identity:
+            return None
+        identity_id = identity_cache.identities[key] = identity.id
+    return identity_id
 
 actions = {'revoke': 'Revoked', 'grant': 'Granted', 'remove': 'Removed'}
 
@@ -1,14 +1,19 @@
 # Copyright (c) 2009-2010, Michael Gorven, Stefano Rivera
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
+from bisect import bisect_left, insort
 from datetime import datetime
 import re
 import logging
+from threading import Lock
 
+from twisted.internet import reactor
+
+import ibid
 from ibid.config import BoolOption, IntOption, ListOption
 from ibid.db import IbidUnicode, DateTime, Integer, Table, Column, Base, \
-                    VersionedSchema
-from ibid.plugins import Processor, match, handler, authorise
+                    VersionedSchema, IntegrityError, select, bindparam, and_
+from ibid.plugins import Processor, match, handler, authorise, periodic
 
 features = {'karma': {
     'description': u'Keeps track of karma for people and things.',
@@ -49,6 +54,249 @@ class Karma(Base):
         self.value = 0
         self.time = datetime.utcnow()
 
+class KarmaService(object):
+    """The current karma of every subject looked up so far, including
+    changes that are waiting to be written to the database in a batch.
+
+    Once the ladder has been asked for, every karma is held in memory, in
+    a list sorted by value.
+
+    Pending changes are written through a private session by the periodic
+    flush, at shutdown, or in a reactor pool thread, but never in the middle
+    of an event, whose connection they would share. Only one flush runs at
+    a time.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.karmas = {}
+        self.ladder = None
+        self.pending = {}
+        self.importance = 0
+        self.scheduled = False
+
+    def _load(self, session, key, subject):
+        "Read subject's karma from the database, if it isn't known"
+        if key in self.karmas or self.ladder is not None:
+            return
+        karma = session.query(Karma).filter_by(subject=subject).first()
+        if karma is None:
+            return
+        self.lock.acquire()
+        try:
+            if key not in self.karmas:
+                self._set(key, [karma.subject, karma.value, karma.changes])
+        finally:
+            self.lock.release()
+
+    def _set(self, key, entry):
+        "Replace key's karma. Must be called with the lock held"
+        old = self.karmas.get(key)
+        if self.ladder is not None:
+            if old is not None:
+                del self.ladder[bisect_left(self.ladder, (old[1], key))]
+            if entry is not None:
+                insort(self.ladder, (entry[1], key))
+        self.karmas[key] = entry
+
+    def get(self, session, subject):
+        "Return [subject, value, changes] for subject, or None"
+        key = subject.lower()
+        self._load(session, key, subject)
+        self.lock.acquire()
+        try:
+            entry = self.karmas.get(key)
+            return entry and list(entry)
+        finally:
+            self.lock.release()
+
+    def change(self, session, subject, value, changes):
+        """Adjust subject's karma. Returns [subject, value, changes] as it
+        now is, and the number of subjects with changes pending.
+        A karma that returns to 0 without becoming important is forgotten.
+        """
+        key = subject.lower()
+        self._load(session, key, subject)
+        now = datetime.utcnow()
+        self.lock.acquire()
+        try:
+            entry = list(self.karmas.get(key) or (subject, 0, 0))
+            entry[1] += value
+            entry[2] += changes
+            if entry[1] == 0 and entry[2] <= self.importance:
+                self._set(key, None)
+            else:
+                self._set(key, entry)
+
+            pending = self.pending.setdefault(key,
+                    {'subject': entry[0], 'value': 0, 'changes': 0})
+            pending['value'] += value
+            pending['changes'] += changes
+            pending['time'] = now
+            return entry, len(self.pending)
+        finally:
+            self.lock.release()
+
+    def top(self, count, reverse=False):
+        """Return up to count [subject, value] pairs with the highest (or
+        lowest) karma. Returns None if the ladder isn't loaded.
+        """
+        self.lock.acquire()
+        try:
+            if self.ladder is None:
+                return None
+            if reverse:
+                keys = self.ladder[:count]
+            else:
+                keys = self.ladder[-count:]
+                keys.reverse()
+            return [(self.karmas[key][0], value) for value, key in keys]
+        finally:
+            self.lock.release()
+
+    def load_ladder(self, session):
+        "Read every karma from the database, so that top() can answer"
+        if self.ladder is not None:
+            return
+        table = Karma.__table__
+        rows = session.execute(select([table.c.subject, table.c.value,
+                                       table.c.changes])).fetchall()
+        self.lock.acquire()
+        try:
+            if self.ladder is not None:
+                return
+            for subject, value, changes in rows:
+                self.karmas.setdefault(subject.lower(),
+                                       [subject, value, changes])
+            self.ladder = sorted((entry[1], key) for key, entry
+                                 in self.karmas.iteritems()
+                                 if entry is not None)
+        finally:
+            self.lock.release()
+
+    def drop_pending(self, subject):
+        """Drop any changes to subject that are pending, once any flush that
+        is writing them has finished"""
+        self.flush_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                self.pending.pop(subject.lower(), None)
+            finally:
+                self.lock.release()
+        finally:
+            self.flush_lock.release()
+
+    def forget(self, subject):
+        "Forget subject's karma, and any changes to it that are pending"
+        self.lock.acquire()
+        try:
+            self.pending.pop(subject.lower(), None)
+            self._set(subject.lower(), None)
+        finally:
+            self.lock.release()
+
+    def flush_later(self):
+        "Flush in a thread of the reactor's pool, unless already scheduled"
+        self.lock.acquire()
+        try:
+            if self.scheduled:
+                return
+            self.scheduled = True
+        finally:
+            self.lock.release()
+        reactor.callFromThread(reactor.callInThread, self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self.scheduled = False
+        self.flush()
+
+    def flush(self):
+        "Write the pending changes to the database"
+        self.flush_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                pending, self.pending = self.pending, {}
+            finally:
+                self.lock.release()
+
+            if not pending:
+                return
+
+            session = ibid.databases.ibid.session_factory()
+            try:
+                try:
+                    self._write(session, pending)
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()
+                    self._requeue(pending)
+                    log.debug(u'Race encountered writing karma, will retry')
+                except:
+                    session.rollback()
+                    self._requeue(pending)
+                    raise
+            finally:
+                session.close()
+        finally:
+            self.flush_lock.release()
+
+    def _write(self, session, pending):
+        table = Karma.__table__
+        subjects = [entry['subject'] for entry in pending.itervalues()]
+        existing = set()
+        for i in xrange(0, len(subjects), 500):
+            existing.update(row[0].lower() for row in session.execute(
+                    select([table.c.subject],
+                           table.c.subject.in_(subjects[i:i+500]))))
+
+        inserts = []
+        updates = []
+        for key, entry in pending.iteritems():
+            if key in existing:
+                updates.append({
+                    'b_subject': entry['subject'],
+                    'b_value': entry['value'],
+                    'b_changes': entry['changes'],
+                    'b_time': entry['time'],
+                })
+            else:
+                inserts.append(entry)
+
+        if inserts:
+            session.execute(table.insert(), inserts)
+        if updates:
+            session.execute(table.update()
+                    .where(table.c.subject == bindparam('b_subject'))
+                    .values({
+                        'value': table.c.value + bindparam('b_value'),
+                        'changes': table.c.changes + bindparam('b_changes'),
+                        'time': bindparam('b_time'),
+                    }), updates)
+        for i in xrange(0, len(subjects), 500):
+            session.execute(table.delete().where(and_(
+                    table.c.subject.in_(subjects[i:i+500]),
+                    table.c.value == 0,
+                    table.c.changes <= self.importance)))
+
+    def _requeue(self, pending):
+        "Put back changes that couldn't be written, under newer ones"
+        self.lock.acquire()
+        try:
+            for key, old in pending.iteritems():
+                entry = self.pending.get(key)
+                if entry is None:
+                    self.pending[key] = old
+                    continue
+                entry['value'] += old['value']
+                entry['changes'] += old['changes']
+        finally:
+            self.lock.release()
+
+karma_service = KarmaService()
+
 class Set(Processor):
     usage = u'<subject> (++|--|==|ftw|ftl) [[reason]]'
     feature = ('karma',)
@@ -70,8 +318,24 @@ class Set(Processor):
     ignore = ListOption('ignore', 'Karma subjects to silently ignore', ())
     importance = IntOption('importance', 'Threshold for number of changes after'
                            " which a karma won't be forgotten", 0)
+    flush_interval = IntOption('flush_interval',
+            u'Seconds between writing karma changes to the database', 10)
+    flush_events = IntOption('flush_events',
+            u'Write karma changes to the database when this many subjects '
+            u'have changed', 100)
+
+    def __init__(self, name):
+        super(Set, self).__init__(name)
+        self._trigger = reactor.addSystemEventTrigger('before', 'shutdown',
+                                                      karma_service.flush)
+
+    def shutdown(self):
+        reactor.removeSystemEventTrigger(self._trigger)
+        # We're handling the unloading event, so don't write in its thread
+        karma_service.flush_later()
 
     def setup(self):
+        karma_service.importance = self.importance
         self.set.im_func.pattern = re.compile(
                 r'^(.+?)\s*(%s)\s*(?:[[{(]+\s*(.+?)\s*[\]})]+)?$' % '|'.join(
                     re.escape(token) for token
@@ -88,32 +352,25 @@ class Set(Processor):
         if subject.lower() in self.ignore:
             return
 
-        karma = event.session.query(Karma).filter_by(subject=subject).first()
-        if not karma:
-            karma = Karma(subject)
-
         if adjust.lower() in self.increase:
             if subject.lower() == event.sender['nick'].lower():
                 event.addresponse(u"You can't karma yourself!")
                 return
-            karma.changes += 1
-            karma.value += 1
+            value, changes = 1, 1
             change = u'Increased'
         elif adjust.lower() in self.decrease:
-            karma.changes += 1
-            karma.value -= 1
+            value, changes = -1, 1
             change = u'Decreased'
         else:
-            karma.changes += 2
+            value, changes = 0, 2
             change = u'Increased and decreased'
 
-        if karma.value == 0 and karma.changes <= self.importance:
+        karma, pending = karma_service.change(event.session, subject, value,
+                                              changes)
+        if karma[1] == 0 and karma[2] <= self.importance:
             change = u'Forgotten (unimportant)'
-
-            event.session.delete(karma)
-        else:
-            event.session.save_or_update(karma)
-        event.session.commit()
+        if pending >= self.flush_events:
+            karma_service.flush_later()
 
         log.info(u"%s karma for '%s' by %s/%s (%s) because: %s",
                 change, subject, event.account, event.identity, event.sender['connection'], reason)
@@ -123,6 +380,10 @@ class Set(Processor):
         else:
             event.processed = True
 
+    @periodic(config_key='flush_interval', initial_delay=0)
+    def flush(self, event):
+        karma_service.flush()
+
 class Get(Processor):
     usage = u"""karma for <subject>
     [reverse] karmaladder"""
@@ -130,24 +391,24 @@ class Get(Processor):
 
     @match(r'^karma\s+(?:for\s+)?(.+)$')
     def handle_karma(self, event, subject):
-        karma = event.session.query(Karma).filter_by(subject=subject).first()
+        karma = karma_service.get(event.session, subject)
         if not karma:
             event.addresponse(u'nobody cares, dude')
-        elif karma.value == 0:
+        elif karma[1] == 0:
             event.addresponse(u'%s has neutral karma', subject)
         else:
             event.addresponse(u'%(subject)s has karma of %(value)s', {
                 'subject': subject,
-                'value': karma.value,
+                'value': karma[1],
             })
 
     @match(r'^(reverse\s+)?karmaladder$')
     def ladder(self, event, reverse):
-        karmas = event.session.query(Karma) \
-                .order_by(reverse and Karma.value.asc() or Karma.value.desc()) \
-                .limit(30).all()
+        karma_service.load_ladder(event.session)
+        karmas = karma_service.top(30, bool(reverse))
         if karmas:
-            event.addresponse(', '.join(['%s: %s (%s)' % (karmas.index(karma), karma.subject, karma.value) for karma in karmas]))
+            event.addresponse(', '.join(['%s: %s (%s)' % (i, subject, value)
+                for i, (subject, value) in enumerate(karmas)]))
         else:
             event.addresponse(u"I don't really care about anything")
 
@@ -163,13 +424,16 @@ class Forget(Processor):
     @match(r'^forget\s+karma\s+for\s+(.+?)(?:\s*[[{(]+\s*(.+?)\s*[\]})]+)?$')
     @authorise(fallthrough=False)
     def forget(self, event, subject, reason):
+        # A flush writing subject's changes could bring back its row
+        karma_service.drop_pending(subject)
+        known = karma_service.get(event.session, subject)
         karma = event.session.query(Karma).filter_by(subject=subject).first()
-        if not karma:
-            karma = Karma(subject)
+        if not karma and not known:
             event.addresponse(u"I was pretty ambivalent about %s, anyway", subject)
-
-        event.session.delete(karma)
-        event.session.commit()
+        elif karma:
+            event.session.delete(karma)
+            event.session.commit()
+        event.session.after_commit(karma_service.forget, subject)
 
         log.info(u"Forgot karma for '%s' by %s/%s (%s) because: %s",
                 subject, event.account, event.identity, event.sender['connection'], reason)
@@ -148,6 +148,7 @@ class Translate(Processor):
     dest_lang = Option('dest_lang', 'Destination language when none is specified', 'english')
 
     chain_length = IntOption('chain_length', 'Maximum length of translation chains', 10)
+    cache_ttl = IntOption('cache_ttl', 'Seconds to cache translations for', 24*60*60)
 
     lang_names = {'afrikaans':'af', 'albanian':'sq', 'arabic':'ar',
                   'belarusian':'be', 'bulgarian':'bg', 'catalan':'ca',
@@ -243,7 +244,7 @@ class Translate(Processor):
 
         response = json_webservice(
             'http://ajax.googleapis.com/ajax/services/language/translate',
-            params, headers)
+            params, headers, ttl=self.cache_ttl)
 
         if response['responseStatus'] == 200:
             translated = unicode(decode_htmlentities(
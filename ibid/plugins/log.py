@@ -7,20 +7,308 @@ from datetime import datetime
 from errno import EEXIST
 import fnmatch
 import logging
-from os.path import dirname, join, expanduser
-from os import chmod, makedirs
-from threading import Lock
-from weakref import WeakValueDictionary
+from os.path import dirname, join, expanduser, exists
+from os import chmod, makedirs, fsync
+from Queue import Queue, Empty
+import re
+from threading import Lock, Thread
+from time import time
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
 
 from dateutil.tz import tzlocal, tzutc
+from twisted.internet import reactor
 
 import ibid
-from ibid.plugins import Processor, handler
-from ibid.config import Option, BoolOption, IntOption, ListOption
+from ibid.plugins import Processor, handler, match
+from ibid.compat import dt_strptime
+from ibid.config import Option, BoolOption, IntOption, FloatOption, ListOption
 from ibid.event import Event
+from ibid.utils import format_date
+
+features = {'logsearch': {
+    'description': u'Searches the archive of public channel logs.',
+    'categories': ('lookup',),
+}}
 
 log = logging.getLogger('plugins.log')
 
+token_re = re.compile(r'\w+', re.UNICODE)
+
+class LogArchive(object):
+    """SQLite store of public log lines, indexed by channel and time, and by
+    the words in them.
+
+    Connections can only be used in the thread that made them, so writes
+    are made by the LogWriter thread, and search() opens its own.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS lines (id INTEGER PRIMARY KEY, '
+            'time TEXT NOT NULL, source TEXT NOT NULL, channel TEXT NOT NULL, '
+            'nick TEXT NOT NULL, type TEXT NOT NULL, message TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS lines_channel_time '
+            'ON lines (source, channel, time)',
+        'CREATE INDEX IF NOT EXISTS lines_time ON lines (time)',
+        'CREATE TABLE IF NOT EXISTS tokens (token TEXT NOT NULL, '
+            'line_id INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS tokens_token ON tokens (token, line_id)',
+    )
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = None
+
+    def _connect(self):
+        if self.db is None:
+            try:
+                makedirs(dirname(self.filename))
+            except OSError, e:
+                if e.errno != EEXIST:
+                    raise e
+            self.db = sqlite3.connect(self.filename)
+            for statement in self.schema:
+                self.db.execute(statement)
+        return self.db
+
+    @staticmethod
+    def tokens(text):
+        return set(token[:32] for token in token_re.findall(text.lower()))
+
+    def add(self, time, source, channel, nick, type, message):
+        "Store a line. time is a UTC datetime"
+        db = self._connect()
+        cursor = db.execute('INSERT INTO lines (time, source, channel, nick, '
+                            'type, message) VALUES (?, ?, ?, ?, ?, ?)',
+                (time.strftime('%Y-%m-%d %H:%M:%S'), source, channel, nick,
+                 type, message))
+        line_id = cursor.lastrowid
+        db.executemany('INSERT INTO tokens (token, line_id) VALUES (?, ?)',
+                       [(token, line_id) for token in self.tokens(message)])
+
+    def flush(self):
+        if self.db is not None:
+            self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def search(self, pattern, source=None, channel=None, nick=None,
+               since=None, limit=10):
+        """Return the latest (time, source, channel, nick, type, message)
+        lines containing pattern, newest first. since is a UTC datetime.
+        """
+        where = []
+        params = []
+        for token in self.tokens(pattern):
+            where.append('id IN (SELECT line_id FROM tokens WHERE token = ?)')
+            params.append(token)
+        where.append("message LIKE ? ESCAPE '\\'")
+        params.append(u'%%%s%%' % re.sub(r'([%_\\])', r'\\\1', pattern))
+        for column, value in (('source', source), ('channel', channel),
+                              ('nick', nick)):
+            if value is not None:
+                where.append('%s = ? COLLATE NOCASE' % column)
+                params.append(value)
+        if since is not None:
+            where.append('time >= ?')
+            params.append(since.strftime('%Y-%m-%d %H:%M:%S'))
+        params.append(limit)
+
+        db = sqlite3.connect(self.filename)
+        try:
+            for statement in self.schema:
+                db.execute(statement)
+            return [(dt_strptime(row[0], '%Y-%m-%d %H:%M:%S'),) + row[1:]
+                    for row in db.execute('SELECT time, source, channel, '
+                        'nick, type, message FROM lines WHERE %s '
+                        'ORDER BY time DESC LIMIT ?' % ' AND '.join(where),
+                        params)]
+        finally:
+            db.close()
+
+class LogWriter(object):
+    """Writes log lines from a queue, in its own thread, so that slow log
+    storage doesn't hold up event processing.
+
+    Keeps up to fd_cache files open. When a channel's log moves to a new
+    file (e.g. a new month), the old file is closed.
+    Files are flushed once flush_interval seconds have passed since their
+    first unflushed write, or flush_size bytes are buffered, and are
+    optionally fsync()ed.
+    """
+
+    def __init__(self):
+        self.queue = Queue()
+        self.lock = Lock()
+        self.thread = None
+        self.fd_cache = 5
+        self.flush_interval = 1.0
+        self.flush_size = 65536
+        self.fsync = False
+        self.dir_mode = 0755
+        self.archive_file = None
+
+        # Only touched by the writer thread:
+        self.files = {}
+        self.used = {}
+        self.current = {}
+        self.dirty = {}
+        self.buffered = 0
+        self.archive = None
+
+    def configure(self, fd_cache, flush_interval, flush_size, fsync, dir_mode,
+                  archive_file=None):
+        self.fd_cache = max(fd_cache, 1)
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.fsync = fsync
+        self.dir_mode = dir_mode
+        self.archive_file = archive_file
+
+    def write(self, key, filename, mode, line):
+        """Queue line to be appended to filename, the current log for key.
+        mode is the permission to create filename with.
+        """
+        if self.thread is None:
+            self.start()
+        self.queue.put((self._write, (key, filename, mode, line)))
+
+    def archive_line(self, *line):
+        "Queue a line for the LogArchive, with the arguments of add()"
+        if self.archive_file is None:
+            return
+        if self.thread is None:
+            self.start()
+        self.queue.put((self._archive, line))
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name='log writer')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        "Write everything queued, close all files, and stop the thread"
+        self.lock.acquire()
+        try:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+        finally:
+            self.lock.release()
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self.dirty:
+                timeout = max(0, min(self.dirty.itervalues())
+                                 + self.flush_interval - time())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Empty:
+                item = False
+
+            try:
+                if item is None:
+                    self._close_all()
+                    return
+                if item:
+                    item[0](*item[1])
+                if self.buffered >= self.flush_size:
+                    self._flush(self.dirty.keys())
+                elif self.dirty:
+                    due = time() - self.flush_interval
+                    self._flush([filename for filename, since
+                                 in self.dirty.iteritems() if since <= due])
+            except Exception:
+                log.exception(u'Error writing logs')
+
+    def _write(self, key, filename, mode, line):
+        if self.current.get(key, filename) != filename:
+            self._close(self.current[key])
+        self.current[key] = filename
+
+        file = self.files.get(filename)
+        if file is None:
+            file = self._open(filename, mode)
+        self.used[filename] = time()
+
+        file.write(line)
+        self.dirty.setdefault(filename, time())
+        self.buffered += len(line)
+
+    def _archive(self, *line):
+        if self.archive is None or self.archive.filename != self.archive_file:
+            if self.archive is not None:
+                self._close(self.archive.filename)
+            if self.archive_file is None:
+                return
+            self.archive = LogArchive(self.archive_file)
+
+        self.archive.add(*line)
+        self.dirty.setdefault(self.archive.filename, time())
+
+    def _open(self, filename, mode):
+        while len(self.files) >= self.fd_cache:
+            self._close(min(self.used, key=self.used.get))
+
+        try:
+            makedirs(dirname(filename), self.dir_mode)
+        except OSError, e:
+            if e.errno != EEXIST:
+                raise e
+
+        file = open(filename, 'a')
+        chmod(filename, mode)
+        self.files[filename] = file
+        return file
+
+    def _flush(self, filenames):
+        for filename in filenames:
+            file = self.files.get(filename)
+            if self.archive is not None and filename == self.archive.filename:
+                self.archive.flush()
+            elif file is not None:
+                file.flush()
+                if self.fsync:
+                    fsync(file.fileno())
+            self.dirty.pop(filename, None)
+        if not self.dirty:
+            self.buffered = 0
+
+    def _close(self, filename):
+        self._flush([filename])
+        if self.archive is not None and filename == self.archive.filename:
+            self.archive.close()
+            self.archive = None
+        file = self.files.pop(filename, None)
+        if file is not None:
+            file.close()
+        self.used.pop(filename, None)
+        for key, current in self.current.items():
+            if current == filename:
+                del self.current[key]
+
+    def _close_all(self):
+        for filename in self.files.keys():
+            self._close(filename)
+        if self.archive is not None:
+            self._close(self.archive.filename)
+
+log_writer = LogWriter()
+
 class Log(Processor):
 
     addressed = False
@@ -56,13 +344,34 @@ class Log(Processor):
             u'Directory Permissions mode, in octal', '755')
 
     fd_cache = IntOption('fd_cache', 'Number of log files to keep open.', 5)
+    flush_interval = FloatOption('flush_interval',
+            u'Maximum number of seconds to buffer log lines for', 1.0)
+    flush_size = IntOption('flush_size',
+            u'Flush logs when this many bytes are buffered', 65536)
+    fsync = BoolOption('fsync', u'fsync() log files after flushing them',
+            False)
+
+    archive = BoolOption('archive',
+            u'Also store public channel messages in a searchable archive',
+            False)
+    archive_file = Option('archive_file', u'SQLite file for the archive',
+            'logs/archive.db')
+
+    def __init__(self, name):
+        super(Log, self).__init__(name)
+        self._trigger = reactor.addSystemEventTrigger('during', 'shutdown',
+                                                      log_writer.stop)
 
-    lock = Lock()
-    logs = WeakValueDictionary()
-    # Ensures that recently used FDs are still available in logs:
-    recent_logs = []
+    def shutdown(self):
+        reactor.removeSystemEventTrigger(self._trigger)
+        log_writer.stop()
 
     def setup(self):
+        super(Log, self).setup()
+        log_writer.configure(self.fd_cache, self.flush_interval,
+                             self.flush_size, self.fsync,
+                             int(self.dir_mode, 8),
+                             self.archive and self.get_archive_file() or None)
         sources = list(set(ibid.config.sources.keys())
                        | set(ibid.sources.keys()))
         for glob in self.public_logs:
@@ -77,61 +386,44 @@ class Log(Processor):
                             u'configured source matching "%s"',
                             glob, source_glob)
 
+    def get_archive_file(self):
+        return join(ibid.options['base'], expanduser(self.archive_file))
+
+    def is_public(self, source, channel):
+        for glob in self.public_logs:
+            if u':' not in glob:
+                continue
+            source_glob, channel_glob = glob.split(u':', 1)
+            if (fnmatch.fnmatch(source, source_glob)
+                    and fnmatch.fnmatch(channel, channel_glob)):
+                return True
+        return False
+
     def get_logfile(self, event):
-        self.lock.acquire()
-        try:
-            when = event.time
-            if not self.date_utc:
-                when = when.replace(tzinfo=tzutc()).astimezone(tzlocal())
+        "Return the (source, channel), log file name and permissions for event"
+        when = event.time
+        if not self.date_utc:
+            when = when.replace(tzinfo=tzutc()).astimezone(tzlocal())
 
-            if event.channel is not None:
-                channel = ibid.sources[event.source].logging_name(event.channel)
-            else:
-                channel = ibid.sources[event.source].logging_name(event.sender['id'])
-            filename = self.log % {
-                    'source': event.source.replace('/', '-'),
-                    'channel': channel.replace('/', '-'),
-                    'year': when.year,
-                    'month': when.month,
-                    'day': when.day,
-                    'hour': when.hour,
-                    'minute': when.minute,
-                    'second': when.second,
-            }
-            filename = join(ibid.options['base'], expanduser(filename))
-            log = self.logs.get(filename, None)
-            if log is None:
-                try:
-                    makedirs(dirname(filename), int(self.dir_mode, 8))
-                except OSError as e:
-                    if e.errno != EEXIST:
-                        raise e
-
-                log = open(filename, 'a')
-                self.logs[filename] = log
-
-                for glob in self.public_logs:
-                    if u':' not in glob:
-                        continue
-                    source_glob, channel_glob = glob.split(u':', 1)
-                    if (fnmatch.fnmatch(event.source, source_glob)
-                            and fnmatch.fnmatch(channel, channel_glob)):
-                        chmod(filename, int(self.public_mode, 8))
-                        break
-                else:
-                    chmod(filename, int(self.private_mode, 8))
-            else:
-                # recent_logs is an LRU cache, we'll be moving log to the
-                # front of the queue, if it's in the queue.
-                # It might not be, GCs are fickle LP: 655645
-                try:
-                    self.recent_logs.remove(log)
-                except ValueError:
-                    pass
-            self.recent_logs = [log] + self.recent_logs[:self.fd_cache - 1]
-            return log
-        finally:
-            self.lock.release()
+        if event.channel is not None:
+            channel = ibid.sources[event.source].logging_name(event.channel)
+        else:
+            channel = ibid.sources[event.source].logging_name(event.sender['id'])
+        filename = self.log % {
+                'source': event.source.replace('/', '-'),
+                'channel': channel.replace('/', '-'),
+                'year': when.year,
+                'month': when.month,
+                'day': when.day,
+                'hour': when.hour,
+                'minute': when.minute,
+                'second': when.second,
+        }
+        filename = join(ibid.options['base'], expanduser(filename))
+
+        if self.is_public(event.source, channel):
+            return (event.source, channel), filename, int(self.public_mode, 8)
+        return (event.source, channel), filename, int(self.private_mode, 8)
 
     def log_event(self, event):
         when = event.time
@@ -172,10 +464,16 @@ class Log(Processor):
         else:
             fields['message'] = event.message
 
-        file = self.get_logfile(event)
+        key, filename, mode = self.get_logfile(event)
+        log_writer.write(key, filename, mode,
+                         (format % fields).encode('utf-8') + '\n')
 
-        file.write((format % fields).encode('utf-8') + '\n')
-        file.flush()
+        if (self.archive and event.type != 'state'
+                and event.channel is not None and event.get('public', True)
+                and self.is_public(*key)):
+            log_writer.archive_line(event.time, key[0], key[1],
+                                    event.sender['nick'], event.type,
+                                    fields['message'])
 
     @handler
     def log_handler(self, event):
@@ -200,4 +498,38 @@ class Log(Processor):
                 e.message = response['reply']
                 self.log_event(e)
 
+class LogSearch(Processor):
+    usage = u'grep logs for <text> [from <nick>] [in <channel>] [since <YYYY-MM-DD>]'
+    feature = ('logsearch',)
+
+    archive_file = Option('archive_file', u'SQLite file for the archive',
+            'logs/archive.db')
+    limit = IntOption('limit', u'Maximum number of lines to return', 5)
+
+    @match(r'^grep\s+logs\s+for\s+(.+?)(?:\s+from\s+(\S+))?'
+           r'(?:\s+in\s+(\S+))?(?:\s+since\s+(\d{4}-\d{2}-\d{2}))?$')
+    def search(self, event, pattern, nick, channel, since):
+        filename = join(ibid.options['base'], expanduser(self.archive_file))
+        if not exists(filename):
+            event.addresponse(u"I don't have a log archive")
+            return
+
+        if since is not None:
+            try:
+                since = dt_strptime(since, '%Y-%m-%d')
+            except ValueError:
+                event.addresponse(u"That isn't a date I understand")
+                return
+
+        lines = LogArchive(filename).search(pattern, nick=nick,
+                channel=channel, since=since, limit=self.limit)
+        if not lines:
+            event.addresponse(u"I couldn't find anything")
+            return
+
+        event.addresponse(u'; '.join(
+            u'%s %s: <%s> %s' % (format_date(line[0]), line[2], line[3],
+                                 line[5])
+            for line in lines))
+
 # vi: set et sta sw=4 ts=4:
@@ -2,10 +2,10 @@
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
 import re
-from urllib2 import urlopen
 import logging
 
 from ibid.plugins import Processor, match
+from ibid.utils import generic_webservice
 
 log = logging.getLogger('plugins.lotto')
 
@@ -25,14 +25,11 @@ class Lotto(Processor):
     @match(r'^lotto(\s+for\s+south\s+africa)?$')
     def za(self, event, za):
         try:
-            f = urlopen(self.za_url)
+            s = generic_webservice(self.za_url)
         except Exception:
             event.addresponse(u'Something went wrong getting to the Lotto site')
             return
 
-        s = "".join(f)
-        f.close()
-
         balls = self.za_re.findall(s)
 
         if len(balls) != 20:
@@ -5,13 +5,15 @@ from datetime import datetime
 import logging
 from random import choice
 import re
+from threading import Lock
 
 import ibid
 from ibid.plugins import Processor, handler, match, authorise
 from ibid.compat import any
 from ibid.config import IntOption
 from ibid.db import IbidUnicodeText, Boolean, Integer, DateTime, \
-                    Table, Column, ForeignKey, relation, Base, VersionedSchema
+                    Table, Column, ForeignKey, relation, func, \
+                    Base, VersionedSchema
 from ibid.db.models import Identity, Account
 from ibid.auth import permission
 from ibid.plugins.identity import get_identities
@@ -22,7 +24,6 @@ features = {'memo': {
     'categories': ('remember', 'message',),
 }}
 
-nomemos_cache = set()
 notified_overlimit_cache = set()
 
 log = logging.getLogger('plugins.memo')
@@ -59,6 +60,58 @@ class Memo(Base):
         self.delivered = False
         self.time = datetime.utcnow()
 
+class PendingMemos(object):
+    """Number of undelivered memos for each identity.
+
+    Loaded from the database on first use, and then kept up to date by
+    the memo processors, so finding out that someone has no memos doesn't
+    need a query.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = None
+
+    def load(self, session):
+        "Count the undelivered memos in the database, if not loaded yet"
+        if self.counts is not None:
+            return
+        counts = dict(session.query(Memo.to_id, func.count(Memo.id))
+                             .filter_by(delivered=False)
+                             .group_by(Memo.to_id).all())
+        self.lock.acquire()
+        try:
+            if self.counts is None:
+                self.counts = counts
+        finally:
+            self.lock.release()
+        log.debug(u'Loaded pending memo counts for %i identities',
+                  len(counts))
+
+    def count(self, event):
+        "Return the number of undelivered memos for the sender of event"
+        if self.counts is None:
+            self.load(event.session)
+        return sum([self.counts.get(identity, 0)
+                    for identity in get_identities(event)])
+
+    def add(self, identity, number=1):
+        self.lock.acquire()
+        try:
+            if self.counts is not None:
+                count = self.counts.get(identity, 0) + number
+                if count > 0:
+                    self.counts[identity] = count
+                else:
+                    self.counts.pop(identity, None)
+        finally:
+            self.lock.release()
+
+    def remove(self, identity, number=1):
+        self.add(identity, -number)
+
+pending_memos = PendingMemos()
+
 Identity.memos_sent = relation(Memo, primaryjoin=Identity.id==Memo.from_id,
                                backref='sender')
 Identity.memos_recvd = relation(Memo, primaryjoin=Identity.id==Memo.to_id,
@@ -140,7 +193,7 @@ class Tell(Processor):
                 memo.id, to.id, who, event.identity, event.sender['connection'],
                 memo.memo)
         event.memo = memo.id
-        nomemos_cache.clear()
+        event.session.after_commit(pending_memos.add, to.id)
         notified_overlimit_cache.discard(to.id)
 
         event.addresponse(u"%(acknowledgement)s, I'll %(action)s "
@@ -214,6 +267,7 @@ class Tell(Processor):
 
         event.session.delete(memo)
         event.session.commit()
+        event.session.after_commit(pending_memos.remove, memo.to_id)
         log.info(u'Cancelled memo %s for %s (%s) from %s (%s): %s',
                  memo.id, memo.to_id, who, event.identity,
                  event.sender['connection'], memo.memo)
@@ -248,7 +302,11 @@ class Deliver(Processor):
 
     @handler
     def deliver(self, event):
-        if event.identity in nomemos_cache:
+        pending = pending_memos.count(event)
+        if not pending:
+            return
+        if pending > self.public_limit and event.public \
+                and event.identity in notified_overlimit_cache:
             return
 
         memos = get_memos(event)
@@ -292,12 +350,10 @@ class Deliver(Processor):
             memo.delivered = True
             event.session.save_or_update(memo)
             event.session.commit()
+            event.session.after_commit(pending_memos.remove, memo.to_id)
             log.info(u"Delivered memo %s to %s (%s)",
                     memo.id, event.identity, event.sender['connection'])
 
-        if 'memo' not in event:
-            nomemos_cache.add(event.identity)
-
 class Notify(Processor):
     feature = ('memo',)
 
@@ -313,7 +369,7 @@ class Notify(Processor):
         if event.state != 'online':
             return
 
-        if event.identity in nomemos_cache:
+        if not pending_memos.count(event):
             return
 
         memos = get_memos(event)
@@ -333,8 +389,6 @@ class Notify(Processor):
                     u'Would you like to read them now?'),
                 { 'memo_count' : len(memos) },
                 target=event.sender['connection'])
-        else:
-            nomemos_cache.add(event.identity)
 
 class Messages(Processor):
     usage = u"""my messages
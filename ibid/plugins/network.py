@@ -4,12 +4,9 @@
 import re
 import socket
 from ibid.compat import defaultdict
-from httplib import HTTPConnection, HTTPSConnection
 from os.path import exists
 from socket import gethostbyname, gaierror
-from subprocess import Popen, PIPE
-from sys import version_info
-from urllib import getproxies_environment
+from urllib2 import URLError
 from urlparse import urlparse
 
 from chardet import detect
@@ -20,10 +17,12 @@ except ImportError:
     Resolver = None
 
 import ibid
-from ibid.plugins import Processor, match, authorise
+from ibid.plugins import Processor, match, authorise, asynchronous
 from ibid.config import Option, IntOption, FloatOption, DictOption
-from ibid.utils import file_in_path, get_country_codes, get_process_output, \
-                       human_join, unicode_output, url_to_bytestring
+from ibid.utils import file_in_path, get_country_codes, human_join, \
+                       unicode_output
+from ibid.utils.http import http_client
+from ibid.utils.process import process_pool, ProcessTimeout
 
 features = {}
 
@@ -92,14 +91,14 @@ class Ping(Processor):
             raise Exception("Cannot locate ping executable")
 
     @match(r'^ping\s+(\S+)$')
+    @asynchronous
     def handle_ping(self, event, host):
         if host.strip().startswith("-"):
             event.addresponse(False)
             return
 
-        ping = Popen([self.ping, '-q', '-c5', host], stdout=PIPE, stderr=PIPE)
-        output, error = ping.communicate()
-        ping.wait()
+        output, error, code = yield process_pool.spawn(
+                [self.ping, '-q', '-c5', host])
 
         if not error:
             output = unicode_output(output)
@@ -125,11 +124,15 @@ class Tracepath(Processor):
             raise Exception("Cannot locate tracepath executable")
 
     @match(r'^tracepath\s+(\S+)$')
+    @asynchronous
     def handle_tracepath(self, event, host):
 
-        tracepath = Popen([self.tracepath, host], stdout=PIPE, stderr=PIPE)
-        output, error = tracepath.communicate()
-        code = tracepath.wait()
+        try:
+            output, error, code = yield process_pool.spawn(
+                    [self.tracepath, host])
+        except ProcessTimeout:
+            event.addresponse(u'Sorry, that took too long. I stopped waiting')
+            return
 
         if code == 0:
             output = unicode_output(output)
@@ -154,21 +157,20 @@ class IPCalc(Processor):
             raise Exception("Cannot locate ipcalc executable")
 
     def call_ipcalc(self, parameters):
-        ipcalc = Popen([self.ipcalc, '-n', '-b'] + parameters,
-                       stdout=PIPE, stderr=PIPE)
-        output, error = ipcalc.communicate()
-        code = ipcalc.wait()
-        output = unicode_output(output)
-
-        return (code, output, error)
+        "Return a Deferred that fires with (code, output, error)"
+        def decode((output, error, code)):
+            return (code, unicode_output(output), error)
+        return process_pool.spawn([self.ipcalc, '-n', '-b'] + parameters) \
+                .addCallback(decode)
 
     @match(r'^ipcalc\s+((?:\d{1,3}\.){3}\d{1,3}|(?:0x)?[0-9A-F]{8})'
            r'(?:(?:/|\s+)((?:\d{1,3}\.){3}\d{1,3}|\d{1,2}))?$')
+    @asynchronous
     def ipcalc_netmask(self, event, address, netmask):
         address = address
         if netmask:
             address += u'/' + netmask
-        code, output, error = self.call_ipcalc([address])
+        code, output, error = yield self.call_ipcalc([address])
 
         if code == 0:
             if output.startswith(u'INVALID ADDRESS'):
@@ -197,8 +199,9 @@ class IPCalc(Processor):
 
     @match(r'^ipcalc\s+((?:\d{1,3}\.){3}\d{1,3}|(?:0x)?[0-9A-F]{8})\s*-\s*'
            r'((?:\d{1,3}\.){3}\d{1,3}|(?:0x)?[0-9A-F]{8})$')
+    @asynchronous
     def ipcalc_deggregate(self, event, frm, to):
-        code, output, error = self.call_ipcalc([frm, '-', to])
+        code, output, error = yield self.call_ipcalc([frm, '-', to])
 
         if code == 0:
             if output.startswith(u'INVALID ADDRESS'):
@@ -383,40 +386,20 @@ class HTTP(Processor):
         event.addresponse(u"I'll let you know when %s is up", url)
 
     def _request(self, url, method):
-        scheme, host = urlparse(url)[:2]
-        scheme = scheme.lower()
-        proxies = getproxies_environment()
-        if scheme in proxies:
-            scheme, host = urlparse(proxies[scheme])[:2]
-            scheme = scheme.lower()
-
-        kwargs = {}
-        if version_info[1] >= 6:
-            kwargs['timeout'] = self.timeout
-        else:
-            socket.setdefaulttimeout(self.timeout)
-
-        if scheme == "https":
-            conn = HTTPSConnection(host, **kwargs)
-        else:
-            conn = HTTPConnection(host, **kwargs)
-
         headers={}
         if method == 'GET':
             headers['Range'] = 'bytes=0-%s' % self.max_size
 
         try:
-            try:
-                conn.request(method.upper(), url_to_bytestring(url),
-                             headers=headers)
-                response = conn.getresponse()
-                data = response.read(self.max_size)
-                conn.close()
-            except socket.error, e:
-                raise HTTPException(e.message or e.args[1])
-        finally:
-            if version_info[1] < 6:
-                socket.setdefaulttimeout(None)
+            response = http_client.request(url, headers=headers,
+                    method=method, timeout=self.timeout,
+                    max_size=self.max_size, redirects=0, raise_errors=False)
+        except URLError, e:
+            reason = e.reason
+            if isinstance(reason, socket.error):
+                reason = reason.message or reason.args[-1]
+            raise HTTPException(reason)
+        data = response.data
 
         contenttype = response.getheader('Content-Type', None)
         if contenttype:
@@ -564,6 +547,7 @@ class Nmap(Processor):
     feature = ('nmap',)
     permission = 'nmap'
     min_prefix = IntOption('min_prefix', 'Minimum network prefix that may be scanned', 24)
+    timeout = IntOption('timeout', 'Maximum time to spend on a scan', 300)
 
     def setup(self):
         if not file_in_path('nmap'):
@@ -582,7 +566,8 @@ class Nmap(Processor):
             event.addresponse(u"I'm not allowed to inspect my host's internal interface.")
             return
 
-        output, error, code = get_process_output(['nmap', '--open', '-n', host])
+        output, error, code = process_pool.run(['nmap', '--open', '-n', host],
+                                               timeout=self.timeout)
 
         ports = []
         gotports = False
@@ -611,7 +596,8 @@ class Nmap(Processor):
             event.addresponse(u"Sorry, I can't scan networks with a prefix less than %s", self.min_prefix)
             return
 
-        output, error, code = get_process_output(['nmap', '-sP', '-n', '%s/%s' % (network, prefix)])
+        output, error, code = process_pool.run(['nmap', '-sP', '-n', '%s/%s' % (network, prefix)],
+                                               timeout=self.timeout)
 
         hosts = []
         for line in output.splitlines():
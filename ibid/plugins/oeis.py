@@ -1,13 +1,13 @@
 # Copyright (c) 2009-2010, Max Rabkin
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
-from urllib3 import urlopen
+from StringIO import StringIO
 import re
 import logging
 
 from ibid.compat import defaultdict
 from ibid.plugins import Processor, match
-from ibid.utils import plural
+from ibid.utils import generic_webservice, plural
 
 log = logging.getLogger('plugins.oeis')
 
@@ -24,8 +24,8 @@ class OEIS(Processor):
     @match(r'^oeis\s+([AMN]\d+|-?\d(?:\d|-|,|\s)*)$')
     def oeis (self, event, query):
         query = re.sub(r'(,|\s)+', ',', query)
-        f = urlopen('http://oeis.org/search?n=1&fmt=text&q='
-                    + query)
+        f = StringIO(generic_webservice('http://oeis.org/search?n=1&fmt=text&q='
+                                        + query))
 
         for i in range(3):
             f.next() # the first lines are uninteresting
@@ -1,13 +1,13 @@
 # Copyright (c) 2008-2010, Michael Gorven, Stefano Rivera, Max Rabkin
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
-from urllib3 import urlopen, HTTPError
+from urllib2 import HTTPError
 from urllib import urlencode, quote
 from httplib import BadStatusLine
 from urlparse import urljoin
 from random import choice, shuffle, randint
+from StringIO import StringIO
 from sys import exc_info
-from subprocess import Popen, PIPE
 import logging
 import re
 
@@ -15,7 +15,8 @@ from ibid.compat import ElementTree
 from ibid.config import Option, BoolOption
 from ibid.plugins import Processor, match, RPC
 from ibid.utils.html import get_html_parse_tree
-from ibid.utils import file_in_path, unicode_output
+from ibid.utils import file_in_path, generic_webservice, unicode_output
+from ibid.utils.process import process_pool
 
 log = logging.getLogger('plugins.quotes')
 
@@ -48,9 +49,7 @@ class Fortune(Processor, RPC):
             event.addresponse(u"Couldn't execute fortune")
 
     def remote_fortune(self):
-        fortune = Popen(self.fortune, stdout=PIPE, stderr=PIPE)
-        output, error = fortune.communicate()
-        code = fortune.wait()
+        output, error, code = process_pool.run([self.fortune])
 
         output = unicode_output(output.strip(), 'replace')
 
@@ -123,7 +122,7 @@ class FMyLife(Processor):
             id.isalnum() and id + '/nocomment' or quote(id),
             urlencode({'language': self.fml_lang, 'key': self.api_key}))
         )
-        f = urlopen(url)
+        f = StringIO(generic_webservice(url))
         try:
             tree = ElementTree.parse(f)
         except SyntaxError:
@@ -371,7 +370,7 @@ class Bible(Processor):
         if version:
             params['version'] = version.lower().encode('utf-8')
 
-        f = urlopen(self.api_url + '?' + urlencode(params))
+        f = StringIO(generic_webservice(self.api_url, params))
         tree = ElementTree.parse(f)
 
         message = self.formatPassage(tree)
@@ -1,13 +1,17 @@
 # Copyright (c) 2009-2010, Stefano Rivera
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
+from bisect import bisect_left
+import cPickle
 import logging
+import os
 import re
+from threading import Lock
 import time
 
 from ibid.config import Option, IntOption
 from ibid.plugins import Processor, match
-from ibid.utils import cacheable_download
+from ibid.utils import cacheable_download, cache_path
 
 features = {'rfc': {
     'description': u'Looks up RFCs by number or title.',
@@ -17,6 +21,120 @@ features = {'rfc': {
 cachetime = 60*60
 log = logging.getLogger("plugin.rfc")
 
+class RFCIndex(object):
+    """The records of the RFC index, with an inverted index of the words in
+    them. Pickled, so that it only has to be rebuilt when the RFC index
+    changes."""
+
+    version = 1
+    word_re = re.compile(r'\w+', re.U)
+
+    def __init__(self, mtime, records):
+        self.mtime = mtime
+        self.records = records
+        words = {}
+        for number, record in records.iteritems():
+            for word in set(self.word_re.findall(record.lower())):
+                words.setdefault(word, []).append(number)
+        for numbers in words.itervalues():
+            numbers.sort()
+        self.words = words
+        self.vocabulary = sorted(words)
+
+    @classmethod
+    def parse(cls, filename):
+        "Parse the RFC index text file"
+        f = file(filename, "rU")
+        lines = f.readlines()
+        f.close()
+
+        breaks = 0
+        strip = -1
+        for lineno, line in enumerate(lines):
+            if line.startswith(20 * "~"):
+                breaks += 1
+            elif breaks == 2 and line.startswith("000"):
+                strip = lineno
+                break
+        lines = lines[strip:]
+
+        records = {}
+        buf = ""
+        # So there's nothing left in buf:
+        lines.append("")
+        for line in lines:
+            line = line.strip()
+            if line:
+                buf += " " + line
+            elif buf:
+                number, desc = buf.strip().split(None, 1)
+                records[int(number)] = unicode(desc, encoding="ASCII")
+                buf = ""
+
+        return cls(os.path.getmtime(filename), records)
+
+    @classmethod
+    def load(cls, filename):
+        "Load a pickled index, or return None"
+        try:
+            f = file(filename, 'rb')
+            try:
+                version, index = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            log.debug(u"Couldn't load RFC index cache: %s", e)
+            return None
+        if version != cls.version:
+            return None
+        return index
+
+    def save(self, filename):
+        tmp = filename + '.tmp'
+        f = file(tmp, 'wb')
+        try:
+            cPickle.dump((self.version, self), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+    def _containing(self, word):
+        """Return the numbers of RFCs containing a word that word is part of.
+        Prefixes are found in the sorted vocabulary, other substrings by
+        scanning it."""
+        numbers = set()
+        for candidate in self.vocabulary:
+            if word in candidate[1:]:
+                numbers.update(self.words[candidate])
+        i = bisect_left(self.vocabulary, word)
+        while i < len(self.vocabulary) \
+                and self.vocabulary[i].startswith(word):
+            numbers.update(self.words[self.vocabulary[i]])
+            i += 1
+        return numbers
+
+    def search(self, terms):
+        """Return the numbers of RFCs whose records contain all the terms, as
+        substrings. Candidates are found in the word index, and only checked
+        against the records when a term isn't a single word."""
+        pool = None
+        for term in terms:
+            term = term.lower()
+            words = self.word_re.findall(term)
+            for word in words:
+                numbers = self._containing(word)
+                if pool is None:
+                    pool = numbers
+                else:
+                    pool.intersection_update(numbers)
+            if words != [term]:
+                pool = set(number for number
+                           in (pool is None and self.records or pool)
+                           if term in self.records[number].lower())
+            if not pool:
+                return []
+        return sorted(pool or ())
+
 class RFCLookup(Processor):
     usage = u"""rfc <number>
     rfc [for] <search terms>
@@ -27,12 +145,42 @@ class RFCLookup(Processor):
     cachetime = IntOption("cachetime", "Time to cache RFC index for", cachetime)
     indexfile = None
     last_checked = 0
+    index = None
+
+    def setup(self):
+        super(RFCLookup, self).setup()
+        self.lock = Lock()
 
     def _update_list(self):
         if not self.indexfile or time.time() - self.last_checked > self.cachetime:
             self.indexfile = cacheable_download(self.indexurl, "rfc/rfc-index.txt")
             self.last_checked = time.time()
 
+    def _get_index(self):
+        "Return the RFCIndex, rebuilding it if the RFC index has changed"
+        self._update_list()
+        mtime = os.path.getmtime(self.indexfile)
+        index = self.index
+        if index is not None and index.mtime == mtime:
+            return index
+
+        self.lock.acquire()
+        try:
+            if self.index is not None and self.index.mtime == mtime:
+                return self.index
+            cachefile = cache_path("rfc/rfc-index.pickle")
+            index = RFCIndex.load(cachefile)
+            if index is None or index.mtime != mtime:
+                start = time.time()
+                index = RFCIndex.parse(self.indexfile)
+                index.save(cachefile)
+                log.info(u'Indexed %i RFCs in %.2fs', len(index.records),
+                         time.time() - start)
+            self.index = index
+            return index
+        finally:
+            self.lock.release()
+
     class RFC(object):
 
         special_authors = (
@@ -72,7 +220,7 @@ class RFCLookup(Processor):
 
         def __init__(self, number, record):
             self.number = number
-            self.record = unicode(record, encoding="ASCII")
+            self.record = record
 
             self.issued = not self.record == "Not Issued."
             self.summary = self.record
@@ -123,47 +271,14 @@ class RFCLookup(Processor):
                     if self.obsoleted:
                         self.summary += u" Obsoleted by " + u", ".join(self.obsoleted)
 
-    def _parse_rfcs(self):
-        self._update_list()
-
-        f = filter(self.indexfile, "rU")
-        lines = f.readlines()
-        f.close()
-
-        breaks = 0
-        strip = -1
-        for lineno, line in enumerate(lines):
-            if line.startswith(20 * "~"):
-                breaks += 1
-            elif breaks == 2 and line.startswith("000"):
-                strip = lineno
-                break
-        lines = lines[strip:]
-
-        rfcs = {}
-        buf = ""
-        # So there's nothing left in buf:
-        lines.append("")
-        for line in lines:
-            line = line.strip()
-            if line:
-                buf += " " + line
-            elif buf:
-                number, desc = buf.strip().split(None, 1)
-                number = int(number)
-                rfcs[number] = self.RFC(number, desc)
-                buf = ""
-
-        return rfcs
-
     @match(r'^rfc\s+#?(\d+)$')
     def lookup(self, event, number):
-        rfcs = self._parse_rfcs()
+        index = self._get_index()
 
         number = int(number)
-        if number in rfcs:
+        if number in index.records:
             event.addresponse(u"%(record)s http://www.rfc-editor.org/rfc/rfc%(number)i.txt", {
-                'record': rfcs[number].record,
+                'record': index.records[number],
                 'number': number,
             })
         else:
@@ -175,29 +290,28 @@ class RFCLookup(Processor):
         if terms.isdigit():
             return
 
-        rfcs = self._parse_rfcs()
+        index = self._get_index()
 
         # Search engines:
-        pool = rfcs.itervalues()
         if len(terms) > 2 and terms[0] == terms[-1] == "/":
             try:
                 term_re = re.compile(terms[1:-1], re.I)
-            except re.error:
-                event.addresponse(u"Couldn't search. Invalid regex: %s", re.message)
+            except re.error, e:
+                event.addresponse(u"Couldn't search. Invalid regex: %s", e.message)
                 return
-            pool = [rfc for rfc in pool if term_re.search(rfc.record)]
+            pool = [number for number, record in sorted(index.records.iteritems())
+                    if term_re.search(record)]
 
         else:
-            terms = set(terms.split())
-            for term in terms:
-                pool = [rfc for rfc in pool if term.lower() in rfc.record.lower()]
+            pool = index.search(set(terms.split()))
 
         # Newer RFCs matter more:
         pool.reverse()
 
         if pool:
             results = []
-            for result in pool[:5]:
+            for number in pool[:5]:
+                result = self.RFC(number, index.records[number])
                 result.parse()
                 results.append("%04i: %s" % (result.number, result.summary))
             event.addresponse(u'Found %(found)i matching RFCs. Listing %(listing)i: %(results)s', {
@@ -3,12 +3,18 @@
 
 from datetime import datetime
 import logging
+from threading import Lock
 
+from twisted.internet import reactor
+
+import ibid
+from ibid.config import IntOption
 from ibid.db import IbidUnicode, IbidUnicodeText, Integer, DateTime, \
                     Table, Column, ForeignKey, UniqueConstraint, \
-                    relation, IntegrityError, Base, VersionedSchema
+                    relation, IntegrityError, Base, VersionedSchema, \
+                    select, bindparam, and_
 from ibid.db.models import Identity, Account
-from ibid.plugins import Processor, match, handler
+from ibid.plugins import Processor, match, handler, periodic
 from ibid.utils import ago, format_date
 
 log = logging.getLogger('plugins.seen')
@@ -62,6 +68,178 @@ class Sighting(Base):
         return u'<Sighting %s %s in %s at %s: %s>' % (
                self.type, self.identity_id, self.channel, self.time, self.value)
 
+class SightingBuffer(object):
+    """The latest sighting of each (identity, type), and the number of times
+    it has been seen, waiting to be written to the database in a batch.
+
+    Sightings are written through a session of their own, and never while
+    an event is being processed in the same thread, so that an event's
+    changes are never committed or rolled back with them.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = {}
+        self.scheduled = False
+
+    def add(self, identity_id, type, time, value, **channel):
+        """Record a sighting. Only updates the channel if one is given.
+        Returns the number of sightings pending.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.pending.setdefault((identity_id, type), {'count': 0})
+            entry['time'] = time
+            entry['value'] = value
+            entry.update(channel)
+            entry['count'] += 1
+            return len(self.pending)
+        finally:
+            self.lock.release()
+
+    def sightings(self, session, identity_ids):
+        """Return the sightings of identity_ids, with the pending ones merged
+        in, as dicts of identity_id, type, channel, value, time and count.
+        """
+        identity_ids = set(identity_ids)
+        sightings = {}
+        for sighting in session.query(Sighting) \
+                .filter(Sighting.identity_id.in_(list(identity_ids))).all():
+            sightings[(sighting.identity_id, sighting.type)] = {
+                'identity_id': sighting.identity_id,
+                'type': sighting.type,
+                'channel': sighting.channel,
+                'value': sighting.value,
+                'time': sighting.time,
+                'count': sighting.count,
+            }
+
+        self.lock.acquire()
+        try:
+            for key, entry in self.pending.iteritems():
+                if key[0] not in identity_ids:
+                    continue
+                sighting = sightings.setdefault(key, {
+                    'identity_id': key[0],
+                    'type': key[1],
+                    'channel': None,
+                    'count': 0,
+                })
+                sighting['value'] = entry['value']
+                sighting['time'] = entry['time']
+                sighting['count'] += entry['count']
+                if 'channel' in entry:
+                    sighting['channel'] = entry['channel']
+        finally:
+            self.lock.release()
+        return sightings.values()
+
+    def flush_later(self):
+        "Flush in a thread of the reactor's pool, unless already scheduled"
+        self.lock.acquire()
+        try:
+            if self.scheduled:
+                return
+            self.scheduled = True
+        finally:
+            self.lock.release()
+        reactor.callFromThread(reactor.callInThread, self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self.scheduled = False
+        self.flush()
+
+    def flush(self):
+        "Write the pending sightings to the database"
+        self.lock.acquire()
+        try:
+            pending, self.pending = self.pending, {}
+        finally:
+            self.lock.release()
+
+        if not pending:
+            return
+
+        session = ibid.databases.ibid.session_factory()
+        try:
+            try:
+                self._write(session, pending)
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                self._requeue(pending)
+                log.debug(u'Race encountered writing sightings, will retry')
+            except:
+                session.rollback()
+                self._requeue(pending)
+                raise
+        finally:
+            session.close()
+
+    def _write(self, session, pending):
+        table = Sighting.__table__
+        identity_ids = list(set(key[0] for key in pending))
+        existing = set()
+        for i in xrange(0, len(identity_ids), 500):
+            existing.update((row[0], row[1]) for row in session.execute(
+                    select([table.c.identity_id, table.c.type],
+                           table.c.identity_id.in_(identity_ids[i:i+500]))))
+
+        inserts = []
+        updates = {True: [], False: []}
+        for (identity_id, type), entry in pending.iteritems():
+            if (identity_id, type) in existing:
+                updates['channel' in entry].append({
+                    'b_identity_id': identity_id,
+                    'b_type': type,
+                    'b_channel': entry.get('channel'),
+                    'b_value': entry['value'],
+                    'b_time': entry['time'],
+                    'b_count': entry['count'],
+                })
+            else:
+                inserts.append({
+                    'identity_id': identity_id,
+                    'type': type,
+                    'channel': entry.get('channel'),
+                    'value': entry['value'],
+                    'time': entry['time'],
+                    'count': entry['count'],
+                })
+
+        if inserts:
+            session.execute(table.insert(), inserts)
+        for channel, rows in updates.iteritems():
+            if not rows:
+                continue
+            values = {
+                'value': bindparam('b_value'),
+                'time': bindparam('b_time'),
+                'count': table.c.count + bindparam('b_count'),
+            }
+            if channel:
+                values['channel'] = bindparam('b_channel')
+            where = and_(table.c.identity_id == bindparam('b_identity_id'),
+                         table.c.type == bindparam('b_type'))
+            session.execute(table.update().where(where).values(values), rows)
+
+    def _requeue(self, pending):
+        "Put back sightings that couldn't be written, under newer ones"
+        self.lock.acquire()
+        try:
+            for key, old in pending.iteritems():
+                entry = self.pending.get(key)
+                if entry is None:
+                    self.pending[key] = old
+                    continue
+                entry['count'] += old['count']
+                if 'channel' not in entry and 'channel' in old:
+                    entry['channel'] = old['channel']
+        finally:
+            self.lock.release()
+
+sighting_buffer = SightingBuffer()
+
 class See(Processor):
     feature = ('seen',)
 
@@ -70,31 +248,40 @@ class See(Processor):
     addressed = False
     processed = True
 
+    flush_interval = IntOption('flush_interval',
+            u'Seconds between writing sightings to the database', 10)
+    flush_events = IntOption('flush_events',
+            u'Write sightings to the database when this many are pending',
+            1000)
+
+    def __init__(self, name):
+        super(See, self).__init__(name)
+        self._trigger = reactor.addSystemEventTrigger('before', 'shutdown',
+                                                      sighting_buffer.flush)
+
+    def shutdown(self):
+        reactor.removeSystemEventTrigger(self._trigger)
+        # We're handling the unloading event, so don't write in its thread
+        sighting_buffer.flush_later()
+
     @handler
     def see(self, event):
-        sighting = event.session.query(Sighting) \
-                .filter_by(identity_id=event.identity, type=event.type).first()
-        if not sighting:
-            sighting = Sighting(event.identity, event.type)
-
+        channel = {}
         if 'channel' in event:
-            sighting.channel = 'public' in event and event.public and event.channel or None
+            channel['channel'] = 'public' in event and event.public and event.channel or None
         if event.type == 'message':
-            sighting.value = event.public and event.message['raw'] or None
-        elif event.type == 'state':
-            sighting.value = event.state
-        sighting.time = event.time
-        sighting.count = sighting.count + 1
+            value = event.public and event.message['raw'] or None
+        else:
+            value = event.state
 
-        event.session.save_or_update(sighting)
-        try:
-            event.session.commit()
-        except IntegrityError:
-            event.session.rollback()
-            event.session.close()
-            del event['session']
-            log.debug(u'Race encountered updating seen for %s on %s',
-                    event.sender['id'], event.source)
+        pending = sighting_buffer.add(event.identity, event.type, event.time,
+                                      value, **channel)
+        if pending >= self.flush_events:
+            sighting_buffer.flush_later()
+
+    @periodic(config_key='flush_interval', initial_delay=0)
+    def flush(self, event):
+        sighting_buffer.flush()
 
 class Seen(Processor):
     usage = u'seen <who>'
@@ -118,38 +305,36 @@ class Seen(Processor):
             event.addresponse(u"I don't know who %s is", who)
             return
 
-        messages = []
-        states = []
         if account:
-            for identity in account.identities:
-                for sighting in event.session.query(Sighting) \
-                        .filter_by(identity_id=identity.id).all():
-                    if sighting.type == 'message':
-                        messages.append(sighting)
-                    else:
-                        states.append(sighting)
+            identities = account.identities
         else:
-            for sighting in event.session.query(Sighting) \
-                    .filter_by(identity_id=identity.id).all():
-                if sighting.type == 'message':
-                    messages.append(sighting)
-                else:
-                    states.append(sighting)
+            identities = [identity]
+        sources = dict((identity.id, identity.source)
+                       for identity in identities)
+
+        messages = []
+        states = []
+        for sighting in sighting_buffer.sightings(event.session, sources):
+            if sighting['type'] == 'message':
+                messages.append(sighting)
+            else:
+                states.append(sighting)
 
         if len(messages) == 0 and len(states) == 0:
             event.addresponse(u"I haven't seen %s", who)
             return
 
-        messages.sort(key=lambda x: x.time, reverse=True)
-        states.sort(key=lambda x: x.time, reverse=True)
+        messages.sort(key=lambda x: x['time'], reverse=True)
+        states.sort(key=lambda x: x['time'], reverse=True)
 
         reply = u''
         if len(messages) > 0:
             sighting = messages[0]
-            delta = event.time - sighting.time
+            delta = event.time - sighting['time']
             reply = u'%s was last seen %s ago in %s on %s [%s]' %(
-                    who, ago(delta), sighting.channel or 'private',
-                    sighting.identity.source, format_date(sighting.time))
+                    who, ago(delta), sighting['channel'] or 'private',
+                    sources[sighting['identity_id']],
+                    format_date(sighting['time']))
 
         if len(states) > 0:
             sighting = states[0]
@@ -158,8 +343,8 @@ class Seen(Processor):
             else:
                 reply = who
             reply += u' has been %s on %s since %s' % (
-                    sighting.value, sighting.identity.source,
-                    format_date(sighting.time))
+                    sighting['value'], sources[sighting['identity_id']],
+                    format_date(sighting['time']))
 
         event.addresponse(reply)
 
@@ -1,7 +1,7 @@
 # Copyright (c) 2008-2011, Michael Gorven, Stefano Rivera, Jonathan Hitchcock
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
-from urllib3 import HTTPError
+from urllib2 import HTTPError
 from time import time
 from datetime import datetime
 import re
@@ -10,7 +10,7 @@ import logging
 import feedparser
 
 from ibid.compat import ElementTree
-from ibid.config import DictOption
+from ibid.config import DictOption, IntOption
 from ibid.plugins import Processor, match, handler
 from ibid.utils import ago, decode_htmlentities, generic_webservice, \
                        json_webservice, parse_timestamp
@@ -29,7 +29,10 @@ class LastFm(Processor):
 
     @match(r'^last\.?fm\s+for\s+(\S+?)\s*$')
     def listsongs(self, event, username):
-        songs = feedparser.parse('http://ws.audioscrobbler.com/1.0/user/%s/recenttracks.rss?%s' % (username, time()))
+        try:
+            songs = feedparser.parse(generic_webservice('http://ws.audioscrobbler.com/1.0/user/%s/recenttracks.rss?%s' % (username, time())))
+        except HTTPError:
+            songs = {'bozo': True}
         if songs['bozo']:
             event.addresponse(u'No such user')
         else:
@@ -57,6 +60,8 @@ class Twitter(Processor):
         'dent':      {'endpoint': 'http://identi.ca/api/', 'api': 'laconica', 'name': 'dent',  'user': 'denter'},
     }
     services = DictOption('services', 'Micro blogging services', default)
+    cache_ttl = IntOption('cache_ttl', 'Seconds to cache updates for', 24*60*60)
+    latest_ttl = IntOption('latest_ttl', 'Seconds to cache latest updates for', 60)
 
     class NoTweetsException(Exception):
         pass
@@ -67,7 +72,8 @@ class Twitter(Processor):
                 % '|'.join(self.services.keys()), re.I)
 
     def remote_update(self, service, id):
-        status = json_webservice('%sstatuses/show/%s.json' % (service['endpoint'], id))
+        status = json_webservice('%sstatuses/show/%s.json' % (service['endpoint'], id),
+                                 ttl=self.cache_ttl)
 
         return {'screen_name': status['user']['screen_name'], 'text': decode_htmlentities(status['text'])}
 
@@ -76,7 +82,7 @@ class Twitter(Processor):
             # Twitter ommits retweets in the JSON and XML results:
             statuses = generic_webservice('%sstatuses/user_timeline/%s.atom'
                     % (service['endpoint'], user.encode('utf-8')),
-                    {'count': 1})
+                    {'count': 1}, ttl=self.latest_ttl)
             tree = ElementTree.fromstring(statuses)
             latest = tree.find('{http://www.w3.org/2005/Atom}entry')
             if latest is None:
@@ -94,7 +100,7 @@ class Twitter(Processor):
         elif service['api'] == 'laconica':
             statuses = json_webservice('%sstatuses/user_timeline/%s.json'
                     % (service['endpoint'], user.encode('utf-8')),
-                    {'count': 1})
+                    {'count': 1}, ttl=self.latest_ttl)
             if not statuses:
                 raise self.NoTweetsException(user)
             latest = statuses[0]
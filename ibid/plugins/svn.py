@@ -22,13 +22,10 @@ Configuration:
 from datetime import datetime, timedelta
 import logging
 import os.path
-from os import kill
-from signal import SIGTERM
 import textwrap
 import ibid
 from ibid.compat import ElementTree as ET, dt_strptime
-from subprocess import Popen, PIPE
-from time import time, sleep, mktime
+from time import mktime
 
 # Can use either pysvn or command-line svn
 try:
@@ -39,6 +36,7 @@ except:
 from ibid.plugins import Processor, match, RPC, authorise
 from ibid.config import DictOption, FloatOption, Option, BoolOption
 from ibid.utils import ago, format_date, human_join
+from ibid.utils.process import process_pool, ProcessTimeout
 
 features = {'svn': {
     'description': u'Retrieves commit logs from a Subversion repository.',
@@ -280,19 +278,12 @@ class CommandLineBranch(Branch):
 
         logging.getLogger('plugins.svn').info(str(cmd))
 
-        svnlog = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        svnlog.stdin.close()
-
-        start_time = time()
-
-        while svnlog.poll() is None and time() - start_time < self.svn_timeout:
-            sleep(0.1)
-
-        if svnlog.poll() is None:
-            kill(svnlog.pid, SIGTERM)
+        try:
+            output, error, code = process_pool.run(cmd,
+                                                   timeout=self.svn_timeout)
+        except ProcessTimeout:
             raise TimeoutException()
 
-        output = svnlog.stdout.read()
         return self._xml_to_log_message(output)
 
     def _xmldate_to_timestamp(self, xmldate):
@@ -1,13 +1,20 @@
 # Copyright (c) 2009-2010, Michael Gorven, Stefano Rivera
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
+from bisect import bisect_left
+import logging
+import mmap
 import os
-import re
-from subprocess import Popen, PIPE
+import struct
+from threading import Lock
 
-from ibid.plugins import Processor, match
-from ibid.config import Option
-from ibid.utils import file_in_path, unicode_output, human_join, cacheable_download
+from ibid.plugins import Processor, match, periodic, asynchronous
+from ibid.config import Option, IntOption, ListOption
+from ibid.utils import file_in_path, unicode_output, human_join, \
+                       cacheable_download, cache_path
+from ibid.utils.process import process_pool, ProcessTimeout
+
+log = logging.getLogger('plugins.sysadmin')
 
 features = {}
 
@@ -47,14 +54,18 @@ class Aptitude(Processor):
         return True
 
     @match(r'^(?:apt|aptitude|apt-get|apt-cache)\s+search\s+(.+)$')
+    @asynchronous
     def search(self, event, term):
 
         if not self._check_terms(event, term):
             return
 
-        apt = Popen([self.aptitude, 'search', '-F', '%p', term], stdout=PIPE, stderr=PIPE)
-        output, error = apt.communicate()
-        code = apt.wait()
+        try:
+            output, error, code = yield process_pool.spawn(
+                    [self.aptitude, 'search', '-F', '%p', term])
+        except ProcessTimeout:
+            event.addresponse(u'Sorry, that took too long. I stopped waiting')
+            return
 
         if code == 0:
             if output:
@@ -73,14 +84,18 @@ class Aptitude(Processor):
             event.addresponse(u"Couldn't search: %s", error)
 
     @match(r'^(?:apt|aptitude|apt-get)\s+show\s+(.+)$')
+    @asynchronous
     def show(self, event, term):
 
         if not self._check_terms(event, term):
             return
 
-        apt = Popen([self.aptitude, 'show', term], stdout=PIPE, stderr=PIPE)
-        output, error = apt.communicate()
-        code = apt.wait()
+        try:
+            output, error, code = yield process_pool.spawn(
+                    [self.aptitude, 'show', term])
+        except ProcessTimeout:
+            event.addresponse(u'Sorry, that took too long. I stopped waiting')
+            return
 
         if code == 0:
             description = None
@@ -129,10 +144,14 @@ class AptFile(Processor):
             raise Exception("Cannot locate apt-file executable")
 
     @match(r'^apt-?file\s+(?:search\s+)?(.+)$')
+    @asynchronous
     def search(self, event, term):
-        apt = Popen([self.aptfile, 'search', term], stdout=PIPE, stderr=PIPE)
-        output, error = apt.communicate()
-        code = apt.wait()
+        try:
+            output, error, code = yield process_pool.spawn(
+                    [self.aptfile, 'search', term])
+        except ProcessTimeout:
+            event.addresponse(u'Sorry, that took too long. I stopped waiting')
+            return
 
         if code == 0:
             if output:
@@ -168,6 +187,7 @@ class Man(Processor):
             raise Exception("Cannot locate man executable")
 
     @match(r'^man\s+(?:(\d)\s+)?(\S+)$')
+    @asynchronous
     def handle_man(self, event, section, page):
         command = [self.man, page]
         if section:
@@ -180,9 +200,7 @@ class Man(Processor):
         env = os.environ.copy()
         env["COLUMNS"] = "500"
 
-        man = Popen(command, stdout=PIPE, stderr=PIPE, env=env)
-        output, error = man.communicate()
-        code = man.wait()
+        output, error, code = yield process_pool.spawn(command, env=env)
 
         if code != 0:
             event.addresponse(u'Manpage not found')
@@ -196,6 +214,142 @@ class Man(Processor):
             if index:
                 event.addresponse(output[index+1].strip())
 
+class OUIIndex(object):
+    """A sorted index of IEEE registry prefixes, mmap'd and binary searched.
+    Each record is a prefix of 6, 7 or 9 hex digits, padded to 9, and the
+    offset of the organisation's name, stored NUL-terminated after the
+    records.
+    """
+
+    magic = 'IBIDOUI1'
+    header = struct.Struct('>8sI')
+    record = struct.Struct('>9sI')
+    prefix_lengths = (9, 7, 6)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self.map = None
+        self.count = 0
+
+    @classmethod
+    def parse(cls, registry):
+        "Yield (prefix, name) for each assignment in an IEEE registry file"
+        base = None
+        for line in registry:
+            if '(hex)' in line:
+                base = line.split(None, 1)[0].replace('-', '').upper()
+            elif '(base 16)' in line and base:
+                assigned, name = line.split('(base 16)', 1)
+                assigned = assigned.strip().upper()
+                if '-' in assigned:
+                    start, end = assigned.split('-', 1)
+                    common = os.path.commonprefix((start, end))
+                    prefix = base + common
+                else:
+                    prefix = base
+                name = name.strip()
+                if name:
+                    yield prefix, name
+                base = None
+
+    def build(self, registries):
+        "Compile the registry files into the index, atomically"
+        prefixes = {}
+        for registry in registries:
+            f = open(registry)
+            try:
+                for prefix, name in self.parse(f):
+                    if len(prefix) in self.prefix_lengths:
+                        prefixes[prefix.ljust(9)] = name
+            finally:
+                f.close()
+
+        names = {}
+        records = []
+        data = []
+        offset = 0
+        for prefix in sorted(prefixes):
+            name = prefixes[prefix]
+            if name not in names:
+                names[name] = offset
+                data.append(name + '\0')
+                offset += len(name) + 1
+            records.append(self.record.pack(prefix, names[name]))
+
+        tmp = self.filename + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(self.header.pack(self.magic, len(records)))
+            f.write(''.join(records))
+            f.write(''.join(data))
+        finally:
+            f.close()
+        os.rename(tmp, self.filename)
+        log.info(u'Indexed %i MAC address prefixes', len(records))
+        self.open()
+
+    def open(self):
+        "(Re)load the index file"
+        f = open(self.filename, 'rb')
+        try:
+            new = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, count = self.header.unpack(new[:self.header.size])
+        if magic != self.magic:
+            new.close()
+            raise ValueError(u'%s is not an OUI index' % self.filename)
+
+        self.lock.acquire()
+        try:
+            old = self.map
+            self.map, self.count = new, count
+        finally:
+            self.lock.release()
+        if old is not None:
+            old.close()
+
+    def _key(self, i):
+        start = self.header.size + i * self.record.size
+        return self.map[start:start + 9]
+
+    def lookup(self, mac):
+        "Return the name of the longest registered prefix of hex string mac"
+        mac = mac.upper()
+        self.lock.acquire()
+        try:
+            if self.map is None:
+                return None
+            keys = _IndexKeys(self)
+            for length in self.prefix_lengths:
+                if len(mac) < length:
+                    continue
+                key = mac[:length].ljust(9)
+                i = bisect_left(keys, key)
+                if i < self.count and self._key(i) == key:
+                    start = self.header.size + i * self.record.size
+                    offset = self.record.unpack(
+                            self.map[start:start + self.record.size])[1]
+                    offset += self.header.size \
+                            + self.count * self.record.size
+                    return self.map[offset:self.map.find('\0', offset)]
+            return None
+        finally:
+            self.lock.release()
+
+class _IndexKeys(object):
+    "A sequence view of an OUIIndex's keys, for bisect"
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.count
+
+    def __getitem__(self, i):
+        return self.index._key(i)
+
 features['mac'] = {
     'description': u'Finds the organization owning the specific MAC address.',
     'categories': ('sysadmin', 'lookup',),
@@ -204,15 +358,48 @@ class Mac(Processor):
     usage = u'mac <address>'
     feature = ('mac',)
 
+    registries = ListOption('registries', 'IEEE MA-L, MA-M and MA-S registry URLs', (
+        'http://standards-oui.ieee.org/oui/oui.txt',
+        'http://standards-oui.ieee.org/oui28/mam.txt',
+        'http://standards-oui.ieee.org/oui36/oui36.txt',
+    ))
+    refresh_interval = IntOption('refresh_interval', 'Seconds between checks for registry updates', 7*24*60*60)
+
+    def setup(self):
+        super(Mac, self).setup()
+        self.index = OUIIndex(cache_path('sysadmin/oui.idx'))
+        self.refresh_lock = Lock()
+        if os.path.isfile(self.index.filename):
+            try:
+                self.index.open()
+            except Exception, e:
+                log.warning(u"Couldn't load OUI index: %s", e)
+
+    def refresh(self):
+        "Download the registries, and rebuild the index if any changed"
+        self.refresh_lock.acquire()
+        try:
+            registries = [cacheable_download(url, 'sysadmin/%s' % url.rsplit('/', 1)[-1])
+                          for url in self.registries]
+            filename = self.index.filename
+            if (self.index.map is None or not os.path.isfile(filename)
+                    or max(os.path.getmtime(r) for r in registries)
+                        > os.path.getmtime(filename)):
+                self.index.build(registries)
+        finally:
+            self.refresh_lock.release()
+
+    @periodic(config_key='refresh_interval')
+    def refresh_registries(self, event):
+        self.refresh()
+
     @match(r'^((?:mac|oui|ether(?:net)?(?:\s*code)?)\s+)?((?:(?:[0-9a-f]{2}(?(1)[:-]?|:))){2,5}[0-9a-f]{2})$')
     def lookup_mac(self, event, _, mac):
-        oui = mac.replace('-', '').replace(':', '').upper()[:6]
-        ouis = open(cacheable_download('http://standards.ieee.org/regauth/oui/oui.txt', 'sysadmin/oui.txt'))
-        match = re.search(r'^%s\s+\(base 16\)\s+(.+?)$' % oui, ouis.read(), re.MULTILINE)
-        ouis.close()
-        if match:
-            name = match.group(1).decode('utf8').title()
-            event.addresponse(u"That belongs to %s", name)
+        if self.index.map is None:
+            self.refresh()
+        name = self.index.lookup(mac.replace('-', '').replace(':', ''))
+        if name:
+            event.addresponse(u"That belongs to %s", name.decode('utf8').title())
         else:
             event.addresponse(u"I don't know who that belongs to")
 
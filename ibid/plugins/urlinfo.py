@@ -7,12 +7,14 @@
 
 from cgi import parse_qs
 from urllib import urlencode
-from urllib import urlopen, build_opener, HTTPError, HTTPRedirectHandler
+from urllib2 import HTTPError
 import logging
 import re
 
 from ibid.plugins import Processor, handler, match
 from ibid.config import ListOption
+from ibid.utils import generic_webservice
+from ibid.utils.http import http_client
 
 default_user_agent = 'Mozilla/5.0'
 default_referer = "http://ibid.omnia.za.net/"
@@ -31,17 +33,11 @@ class Shorten(Processor):
 
     @match(r'^shorten\s+(\S+\.\S+)$')
     def shorten(self, event, url):
-        f = urlopen('http://is.gd/api.php?%s' % urlencode({'longurl': url}))
-        shortened = f.read()
-        f.close()
+        shortened = generic_webservice('http://is.gd/api.php',
+                                       {'longurl': url})
 
         event.addresponse(u'That reduces to: %s', shortened)
 
-class NullRedirect(HTTPRedirectHandler):
-
-    def redirect_request(self, req, fp, code, msg, hdrs, newurl):
-        return None
-
 class Lengthen(Processor):
     usage = u"""<url>
     expand <url>"""
@@ -63,10 +59,8 @@ class Lengthen(Processor):
     @handler
     def lengthen(self, event, url1, url2):
         url = url1 or url2
-        opener = build_opener(NullRedirect())
         try:
-            f = opener.open(url)
-            f.close()
+            http_client.request(url, redirects=0)
         except HTTPError, e:
             if e.code in (301, 302, 303, 307):
                 event.addresponse(u'That expands to: %s', e.hdrs['location'])
@@ -98,7 +92,7 @@ class Youtube(Processor):
                 'gl': 'US',
                 'hl': 'en',
             })
-            info = parse_qs(urlopen(url).read())
+            info = parse_qs(generic_webservice(url))
             if info.get('status', [None])[0] == 'ok':
                 break
 
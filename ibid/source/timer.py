@@ -1,30 +1,29 @@
 # Copyright (c) 2008-2009, Michael Gorven
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
-from twisted.application import internet
-
 import ibid
 from ibid.config import IntOption
-from ibid.event import Event
+from ibid.core import PeriodicScheduler
 from ibid.source import IbidSourceFactory
 
 class SourceFactory(IbidSourceFactory):
 
-    step = IntOption('step', 'Timer interval in seconds', 1)
-
-    def tick(self):
-        event = Event(self.name, u'clock')
-        ibid.dispatcher.dispatch(event)
+    threads = IntOption('threads',
+            'Maximum number of periodic handlers to run at once', 4)
+    jitter = IntOption('jitter',
+            'Maximum random delay added to periodic handlers, in seconds', 5)
 
     def setServiceParent(self, service):
-        self.s = internet.TimerService(self.step, self.tick)
-        if service is None:
-            self.s.startService()
-        else:
-            self.s.setServiceParent(service)
+        self.scheduler = PeriodicScheduler(self.name, self.threads,
+                                           self.jitter)
+        ibid.scheduler = self.scheduler
+        self.scheduler.start()
+        return True
 
     def disconnect(self):
-        self.s.stopService()
+        self.scheduler.stop()
+        if ibid.scheduler is self.scheduler:
+            ibid.scheduler = None
         return True
 
 # vi: set et sta sw=4 ts=4:
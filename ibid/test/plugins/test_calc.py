@@ -0,0 +1,24 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from twisted.trial import unittest
+
+from ibid.plugins.calc import BC
+
+class TestBC(unittest.TestCase):
+
+    def test_stateless(self):
+        for expression in (u'1+1', u's(2)/c(2)', u'2^100 % 7', u'a[1] * -3',
+                           u'sqrt(2); length(10)', u'1 < 2 && 3 > 2',
+                           u'.5 + 1.5', u'1. * 2'):
+            self.failIf(BC.stateful_re.search(expression), expression)
+
+    def test_stateful(self):
+        for expression in (u'define s(x) { return 42 }', u'x = 5',
+                           u'scale=100', u'1 <= 2', u'x++', u'--x',
+                           u'print "unterminated', u'{ 1', u'/* comment',
+                           u'1 + \\', u'quit', u'read()', u'last * 2',
+                           u'. * 2', u'(.+1)'):
+            self.failUnless(BC.stateful_re.search(expression), expression)
+
+# vi: set et sta sw=4 ts=4:
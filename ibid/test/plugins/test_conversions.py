@@ -0,0 +1,33 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+import unicodedata
+
+from twisted.trial import unittest
+
+from ibid.plugins.conversions import UnicodeNameIndex
+
+class TestUnicodeNameIndex(unittest.TestCase):
+
+    def setUp(self):
+        words = {}
+        for char in u'\u2603\u26c4\u26c7\u2744aA\xe0':
+            for word in UnicodeNameIndex.word_re.findall(
+                    unicodedata.name(char)):
+                words.setdefault(word, []).append(ord(char))
+        self.index = UnicodeNameIndex(words)
+
+    def test_words(self):
+        self.assertEqual(self.index.search(u'snowman'),
+                         (3, [0x2603, 0x26c7, 0x26c4]))
+        self.assertEqual(self.index.search(u'latin small a'),
+                         (2, [ord(u'a'), 0xe0]))
+
+    def test_prefix(self):
+        self.assertEqual(self.index.search(u'snow', 2), (4, [0x26c4, 0x2603]))
+
+    def test_substring(self):
+        self.assertEqual(self.index.search(u'flake'), (1, [0x2744]))
+        self.assertEqual(self.index.search(u'xyzzy'), (0, []))
+
+# vi: set et sta sw=4 ts=4:
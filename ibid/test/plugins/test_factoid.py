@@ -0,0 +1,120 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from twisted.trial import unittest
+
+import ibid
+import ibid.test
+from ibid.core import sqlite_creator
+from ibid.db import EventSession
+from ibid.event import Event
+from ibid.plugins import factoid
+
+class TestWildcardMatcher(unittest.TestCase):
+
+    names = [
+        (1, u'weather in $arg', 1),
+        (2, u'$arg is $arg', 2),
+        (3, u'$arg++', 3),
+        (4, u'$arg', 4),
+        (5, u'tell $arg about $arg', 5),
+        (6, u'$arg in $arg', 5),
+    ]
+
+    def setUp(self):
+        self.matcher = factoid.WildcardMatcher()
+        self.matcher.loaded = True
+        for id, name, factoid_id in self.names:
+            self.matcher.add(id, name, factoid_id)
+
+    def match(self, name):
+        return sorted(self.matcher.match(name))
+
+    def test_match(self):
+        self.assertEqual(self.match(u'Weather in London'), [1, 4, 6])
+        self.assertEqual(self.match(u'this is cool'), [2, 4])
+        self.assertEqual(self.match(u'ibid++'), [3, 4])
+        self.assertEqual(self.match(u'tell bob about it'), [4, 5])
+
+    def test_arg_not_empty(self):
+        self.assertEqual(self.match(u'weather in '), [4])
+        self.assertEqual(self.match(u'++'), [4])
+        self.assertEqual(self.match(u' is b'), [4])
+
+    def test_remove(self):
+        self.matcher.remove(ids=(1, 4))
+        self.assertEqual(self.match(u'weather in London'), [6])
+        self.matcher.remove(factoid_ids=(5,))
+        self.assertEqual(self.match(u'weather in London'), [])
+        self.assertEqual(self.matcher.prefixes.keys(), [])
+
+    def test_not_loaded(self):
+        self.matcher.clear()
+        self.matcher.add(1, u'weather in $arg', 1)
+        self.assertEqual(self.match(u'weather in London'), [])
+
+class TestSearchTerms(unittest.TestCase):
+
+    def test_terms(self):
+        self.assertEqual(factoid.search_terms(u'The cat, the HAT.'),
+                         {u'the': 2, u'cat': 1, u'hat': 1})
+        self.assertEqual(factoid.search_terms(u'?!'), {})
+
+    def test_rows(self):
+        rows = factoid.term_rows(1, 2, None, u'weather in $arg')
+        self.assertEqual(sorted(row['term'] for row in rows),
+                         [u'in', u'weather'])
+        rows = factoid.term_rows(1, None, 3, u'<reply>Hello')
+        self.assertEqual([(row['term'], row['value_id']) for row in rows],
+                         [(u'hello', 3)])
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.config = ibid.config
+        ibid.test.set_config({u'plugins': {}})
+        engine = create_engine('sqlite:///',
+                               creator=sqlite_creator(':memory:'))
+        for table in (factoid.Factoid, factoid.FactoidName,
+                      factoid.FactoidValue, factoid.FactoidTerm):
+            table.__table__.create(engine)
+        self.session = sessionmaker(bind=engine)()
+        for i in range(5):
+            fact = factoid.Factoid()
+            fact.names.append(factoid.FactoidName(u'foo%i' % i, None))
+            for j in range(4):
+                fact.values.append(
+                        factoid.FactoidValue(u'bar %i %i' % (i, j), None))
+            self.session.add(fact)
+        self.session.commit()
+        self.search = factoid.Search(u'factoid')
+        self.search.use_index = False
+
+    def tearDown(self):
+        self.session.close()
+        ibid.config = self.config
+
+    def results(self, limit, pattern, start=None, search_type=None):
+        event = Event(u'test', u'message')
+        event.session = EventSession(self.session, False)
+        self.search.search(event, limit, search_type, pattern, start)
+        return [response['reply'] for response in event.responses]
+
+    def test_paginate(self):
+        self.assertEqual(self.results(u'3', u'bar'),
+                         [u'foo0 [4]; foo1 [4]; foo2 [4]'])
+        self.assertEqual(self.results(u'3', u'bar', u'4'),
+                         [u'foo3 [4]; foo4 [4]'])
+        self.assertEqual(self.results(u'3', u'/bar \\d [13]/r', u'3',
+                                      u'values'),
+                         [u'foo2 [4]; foo3 [4]; foo4 [4]'])
+        self.assertEqual(self.results(u'3', u'foo', u'2', u'facts'),
+                         [u'foo1 [4]; foo2 [4]; foo3 [4]'])
+
+    def test_count(self):
+        self.assertEqual(self.results(u'3', u'bar', u'7'),
+                         [u"I could only find 5 things that matched 'bar'"])
+
+# vi: set et sta sw=4 ts=4:
@@ -0,0 +1,159 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from datetime import datetime, timedelta
+import sys
+import types
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from twisted.trial import unittest
+
+import ibid
+from ibid.test import FakeConfig
+
+# FeedPoller doesn't render HTML, so it can be tested without html2text
+try:
+    import html2text
+except ImportError:
+    html2text = types.ModuleType('html2text')
+    html2text.html2text_file = lambda html, out: html
+    sys.modules['html2text'] = html2text
+
+from ibid.plugins.feeds import Feed, FeedEntry, FeedPoller, entry_hash
+
+class FakeResponse(object):
+    def __init__(self, status, data='', headers={}):
+        self.status = status
+        self.data = data
+        self.headers = headers
+
+class FakeDispatcher(object):
+    def __init__(self):
+        self.calls = []
+
+    def delayed_call(self, callable, event, *args):
+        self.calls.append(args)
+
+def atom(*entries):
+    return '''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Test</title>%s
+</feed>''' % ''.join('''
+  <entry>
+    <id>urn:%s</id>
+    <title>%s</title>
+    <updated>%s</updated>
+  </entry>''' % (id, id.title(), updated) for id, updated in entries)
+
+class TestFeedPoller(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Feed.__table__.create(engine)
+        FeedEntry.__table__.create(engine)
+        engine.execute(Feed.__table__.insert(), id=1, name=u'test',
+                       url=u'http://example.com/feed', identity_id=1,
+                       time=datetime.utcnow(), source=u'irc',
+                       target=u'#ibid')
+        self.databases = ibid.databases
+        ibid.databases = FakeConfig({
+            'ibid': scoped_session(sessionmaker(bind=engine)),
+        })
+        self.dispatcher = ibid.dispatcher
+        ibid.dispatcher = FakeDispatcher()
+        self.session = ibid.databases.ibid()
+        self.poller = FeedPoller()
+
+    def tearDown(self):
+        self.session.close()
+        ibid.databases = self.databases
+        ibid.dispatcher = self.dispatcher
+
+    def feed(self):
+        self.session.expire_all()
+        return self.session.query(Feed).get(1)
+
+    def stored(self):
+        return sorted((entry.entry, entry.updated) for entry
+                      in self.session.query(FeedEntry).all())
+
+    def poll(self, *entries):
+        self.poller.update(1, FakeResponse(200, atom(*entries),
+                                           {'etag': '"v1"'}))
+        calls, ibid.dispatcher.calls = ibid.dispatcher.calls, []
+        if calls:
+            self.assertEqual(len(calls), 1)
+            return calls[0][3]
+        return []
+
+    def test_first_poll(self):
+        self.assertEqual(self.poll(('a', '2011-01-01T00:00:00Z'),
+                                   ('b', '2011-01-02T00:00:00Z')), [])
+        feed = self.feed()
+        self.assertEqual(feed.etag, u'"v1"')
+        self.assertEqual(feed.interval, 450)
+        self.assertNotEqual(feed.polled, None)
+        self.assertEqual(self.stored(), sorted([
+            (entry_hash(u'urn:a'), entry_hash(u'2011-01-01T00:00:00Z')),
+            (entry_hash(u'urn:b'), entry_hash(u'2011-01-02T00:00:00Z')),
+        ]))
+
+    def test_failed_first_poll(self):
+        self.poller.update(1, None)
+        self.poller.update(1, FakeResponse(500))
+        self.assertNotEqual(self.feed().polled, None)
+        self.assertEqual(self.poll(), [])
+        self.assertEqual(self.poll(('a', '2011-01-01T00:00:00Z'),
+                                   ('b', '2011-01-02T00:00:00Z')), [])
+        self.assertEqual(len(self.stored()), 2)
+        self.assertEqual(self.poll(('c', '2011-01-03T00:00:00Z'),
+                                   ('b', '2011-01-02T00:00:00Z')),
+                         [(u'New', u'C')])
+
+    def test_changes(self):
+        self.poll(('a', '2011-01-01T00:00:00Z'),
+                  ('b', '2011-01-02T00:00:00Z'))
+        self.assertEqual(self.poll(('c', '2011-01-03T00:00:00Z'),
+                                   ('b', '2011-01-02T00:00:00Z'),
+                                   ('a', '2011-01-04T00:00:00Z')),
+                         [(u'Updated', u'A'), (u'New', u'C')])
+        self.assertEqual(self.feed().interval, 300)
+        self.assertEqual(len(self.stored()), 3)
+        self.assertEqual(self.poll(('c', '2011-01-03T00:00:00Z'),
+                                   ('b', '2011-01-02T00:00:00Z'),
+                                   ('a', '2011-01-04T00:00:00Z')), [])
+        self.assertEqual(self.feed().interval, 450)
+
+    def test_prune(self):
+        self.poll(('a', '2011-01-01T00:00:00Z'),
+                  ('b', '2011-01-02T00:00:00Z'))
+        self.assertEqual(self.poll(('b', '2011-01-02T00:00:00Z')), [])
+        self.assertEqual(self.stored(), [
+            (entry_hash(u'urn:b'), entry_hash(u'2011-01-02T00:00:00Z')),
+        ])
+        self.assertEqual(self.poll(('a', '2011-01-01T00:00:00Z'),
+                                   ('b', '2011-01-02T00:00:00Z')),
+                         [(u'New', u'A')])
+
+    def test_not_modified(self):
+        self.poll(('a', '2011-01-01T00:00:00Z'))
+        polled = self.feed().polled
+        self.poller.update(1, FakeResponse(304, headers={'etag': '"v2"'}))
+        self.assertEqual(ibid.dispatcher.calls, [])
+        feed = self.feed()
+        self.assertEqual(feed.etag, u'"v1"')
+        self.assertEqual(feed.interval, 675)
+        self.assert_(feed.polled >= polled)
+        self.assertEqual(len(self.stored()), 1)
+
+    def test_due(self):
+        feed = self.feed()
+        now = datetime.utcnow()
+        self.assert_(self.poller.due(feed, now))
+        feed.polled = now - timedelta(seconds=400)
+        self.assert_(self.poller.due(feed, now))
+        feed.interval = 450
+        self.failIf(self.poller.due(feed, now))
+
+# vi: set et sta sw=4 ts=4:
@@ -0,0 +1,134 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from twisted.trial import unittest
+
+import ibid
+import ibid.test
+from ibid.db import EventSession
+from ibid.db.models import Account, Identity
+from ibid.event import Event
+from ibid.plugins import identity
+
+class TestIdentityCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = identity.IdentityCache()
+        self.cache.connections[(u'irc', u'bob!b@host')] = (1, 10)
+        self.cache.connections[(u'irc', u'joe!j@host')] = (2, None)
+        self.cache.connections[(u'jabber', u'bob@host/x')] = (3, 10)
+        self.cache.identities[(u'irc', u'bob')] = 1
+        self.cache.accounts[10] = (1, 3)
+
+    def test_invalidate_account(self):
+        self.cache.invalidate(account_ids=(10,))
+        self.assertEqual(self.cache.connections.items(),
+                         [((u'irc', u'joe!j@host'), (2, None))])
+        self.assertEqual(self.cache.accounts.items(), [])
+        self.assertEqual(len(self.cache.identities), 1)
+
+    def test_invalidate_identity(self):
+        self.cache.invalidate(identity_ids=(3,))
+        self.assertEqual(len(self.cache.connections), 2)
+        self.assertEqual(self.cache.accounts.items(), [])
+        self.assertEqual(len(self.cache.identities), 1)
+
+    def test_generation(self):
+        generation = self.cache.generation
+        self.cache.invalidate(identity_ids=(2,))
+        self.assertNotEqual(self.cache.generation, generation)
+
+class TestIdentify(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Account.__table__.create(engine)
+        Identity.__table__.create(engine)
+        self.session = sessionmaker(bind=engine)()
+        account = Account(u'bob')
+        self.session.add(account)
+        self.session.flush()
+        jabber = Identity(u'jabber', u'bob@example.com', account.id)
+        self.session.add(jabber)
+        self.session.commit()
+        self.account_id = account.id
+        self.jabber_id = jabber.id
+
+        self.config = ibid.config
+        ibid.test.set_config({u'plugins': {}})
+        self.identity_cache = identity.identity_cache
+        identity.identity_cache = identity.IdentityCache()
+        self.identify = identity.Identify(u'identity')
+        self.identities = identity.Identities(u'identity')
+
+    def tearDown(self):
+        self.session.close()
+        identity.identity_cache = self.identity_cache
+        ibid.config = self.config
+
+    def event(self, source, id, connection):
+        event = Event(source, u'message')
+        event.sender['id'] = id
+        event.sender['connection'] = connection
+        event.session = EventSession(self.session, False)
+        self.identify.handle(event)
+        return event
+
+    def irc(self):
+        return self.event(u'irc', u'bob', u'bob!b@example.com')
+
+    def jabber(self):
+        return self.event(u'jabber', u'bob@example.com',
+                          u'bob@example.com/home')
+
+    def test_identify(self):
+        event = self.irc()
+        self.assertEqual(event.account, None)
+        self.assertEqual(event.identities, (event.identity,))
+        irc_id = event.identity
+
+        event = self.jabber()
+        self.assertEqual(event.identity, self.jabber_id)
+        self.assertEqual(event.account, self.account_id)
+        self.assertEqual(event.identities, (self.jabber_id,))
+
+        # From the cache, this time
+        event = self.irc()
+        self.assertEqual(event.identity, irc_id)
+        self.assertEqual(event.identities, (irc_id,))
+        event = self.jabber()
+        self.assertEqual(event.identities, (self.jabber_id,))
+
+    def test_link(self):
+        irc_id = self.irc().identity
+        self.jabber()
+
+        token = u'a' * 16
+        self.identities.tokens[token] = (self.account_id, u'bob', u'irc')
+        event = self.irc()
+        self.identities.token(event, token)
+        event.session.finish()
+        self.assertEqual(event.responses[0]['reply'], u'Identity added')
+
+        event = self.irc()
+        self.assertEqual(event.account, self.account_id)
+        self.assertEqual(sorted(event.identities),
+                         sorted((irc_id, self.jabber_id)))
+        event = self.jabber()
+        self.assertEqual(sorted(event.identities),
+                         sorted((irc_id, self.jabber_id)))
+
+        event = self.jabber()
+        self.identities.remove(event, u'bob', u'irc', None)
+        event.session.finish()
+
+        event = self.irc()
+        self.assertEqual(event.identity, irc_id)
+        self.assertEqual(event.account, None)
+        self.assertEqual(event.identities, (irc_id,))
+        event = self.jabber()
+        self.assertEqual(event.identities, (self.jabber_id,))
+
+# vi: set et sta sw=4 ts=4:
@@ -0,0 +1,108 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from threading import Event, Thread
+from time import sleep
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from twisted.trial import unittest
+
+import ibid
+from ibid.test import FakeConfig
+from ibid.plugins.karma import Karma, KarmaService
+
+class TestKarmaService(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite:///' + self.mktemp())
+        Karma.__table__.create(engine)
+        self.databases = ibid.databases
+        ibid.databases = FakeConfig({
+            'ibid': scoped_session(sessionmaker(bind=engine)),
+        })
+        self.session = ibid.databases.ibid()
+        self.session.add(Karma(u'Ibid'))
+        self.session.commit()
+        self.service = KarmaService()
+
+    def tearDown(self):
+        self.session.close()
+        ibid.databases = self.databases
+
+    def stored(self):
+        self.session.expire_all()
+        return sorted((karma.subject, karma.value, karma.changes)
+                      for karma in self.session.query(Karma).all())
+
+    def test_coalesce(self):
+        for i in range(5):
+            self.service.change(self.session, u'Ibid', 1, 1)
+        self.service.change(self.session, u'python', -1, 1)
+        self.assertEqual(self.service.get(self.session, u'IBID'),
+                         [u'Ibid', 5, 5])
+        self.assertEqual(self.stored(), [(u'Ibid', 0, 0)])
+        self.service.flush()
+        self.assertEqual(self.stored(),
+                         [(u'Ibid', 5, 5), (u'python', -1, 1)])
+
+    def test_forget_unimportant(self):
+        self.service.change(self.session, u'python', 1, 1)
+        self.service.flush()
+        karma, pending = self.service.change(self.session, u'python', -1, 1)
+        self.assertEqual(karma, [u'python', 0, 2])
+        self.service.importance = 2
+        self.service.flush()
+        self.assertEqual(self.stored(), [(u'Ibid', 0, 0)])
+
+    def test_forget_pending(self):
+        self.service.change(self.session, u'python', 2, 2)
+        self.service.forget(u'python')
+        self.service.flush()
+        self.assertEqual(self.service.get(self.session, u'python'), None)
+        self.assertEqual(self.stored(), [(u'Ibid', 0, 0)])
+
+    def test_drop_pending(self):
+        self.service.change(self.session, u'python', 2, 2)
+        write = self.service._write
+        writing = Event()
+        resume = Event()
+        order = []
+        def slow_write(session, pending):
+            writing.set()
+            resume.wait(5)
+            write(session, pending)
+            order.append('flushed')
+        self.service._write = slow_write
+        def drop():
+            self.service.drop_pending(u'python')
+            order.append('dropped')
+        flusher = Thread(target=self.service.flush)
+        flusher.start()
+        writing.wait(5)
+        dropper = Thread(target=drop)
+        dropper.start()
+        sleep(0.05)
+        self.assertEqual(order, [])
+        resume.set()
+        flusher.join()
+        dropper.join()
+        self.assertEqual(order, ['flushed', 'dropped'])
+
+        self.service.change(self.session, u'python', 1, 1)
+        self.service.drop_pending(u'python')
+        self.service.flush()
+        self.assertEqual(self.stored(), [(u'Ibid', 0, 0), (u'python', 2, 2)])
+
+    def test_ladder(self):
+        self.service.change(self.session, u'python', 3, 3)
+        self.service.load_ladder(self.session)
+        self.service.change(self.session, u'perl', -2, 2)
+        self.service.change(self.session, u'Ibid', 1, 1)
+        self.assertEqual(self.service.top(2),
+                         [(u'python', 3), (u'Ibid', 1)])
+        self.assertEqual(self.service.top(1, reverse=True), [(u'perl', -2)])
+        self.service.forget(u'python')
+        self.assertEqual(self.service.top(1), [(u'Ibid', 1)])
+
+# vi: set et sta sw=4 ts=4:
@@ -0,0 +1,98 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from datetime import datetime
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.trial import unittest
+
+from ibid.plugins import log
+
+class TestLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.writer = log.LogWriter()
+        self.writer.configure(2, 60, 65536, False, 0755)
+
+    def tearDown(self):
+        self.writer.stop()
+        rmtree(self.dir)
+
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+
+    def read(self, *names):
+        return open(self.path(*names)).read()
+
+    def test_write(self):
+        self.writer.write(('irc', '#a'), self.path('1', 'a.log'), 0640, 'one\n')
+        self.writer.write(('irc', '#a'), self.path('1', 'a.log'), 0640, 'two\n')
+        self.writer.stop()
+        self.assertEqual(self.read('1', 'a.log'), 'one\ntwo\n')
+        self.assertEqual(os.stat(self.path('1', 'a.log')).st_mode & 0777,
+                         0640)
+
+    def test_rollover(self):
+        self.writer.write(('irc', '#a'), self.path('1', 'a.log'), 0640, 'one\n')
+        self.writer.write(('irc', '#a'), self.path('2', 'a.log'), 0640, 'two\n')
+        self.writer.stop()
+        self.assertEqual(self.read('1', 'a.log'), 'one\n')
+        self.assertEqual(self.read('2', 'a.log'), 'two\n')
+
+    def test_fd_cache(self):
+        for channel in ('a', 'b', 'c', 'a'):
+            self.writer.write(('irc', channel), self.path(channel + '.log'),
+                              0640, channel + '\n')
+        self.writer.stop()
+        self.assertEqual(self.read('a.log'), 'a\na\n')
+        self.assertEqual(self.read('c.log'), 'c\n')
+        self.assertEqual(self.writer.files, {})
+
+class TestLogArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.archive = log.LogArchive(os.path.join(self.dir, 'archive.db'))
+        for day, channel, nick, message in (
+                (1, u'#a', u'bob', u'The quick brown fox'),
+                (2, u'#a', u'joe', u'a quick-witted reply'),
+                (3, u'#b', u'bob', u'Quick, 50% off!'),
+                (4, u'#a', u'bob', u'slow')):
+            self.archive.add(datetime(2011, 1, day), u'irc', channel, nick,
+                             u'message', message)
+        self.archive.close()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def search(self, pattern, **kwargs):
+        return [line[5] for line in self.archive.search(pattern, **kwargs)]
+
+    def test_search(self):
+        self.assertEqual(self.search(u'QUICK'), [u'Quick, 50% off!',
+                u'a quick-witted reply', u'The quick brown fox'])
+        self.assertEqual(self.search(u'quick brown'), [u'The quick brown fox'])
+        self.assertEqual(self.search(u'brown quick'), [])
+        self.assertEqual(self.search(u'50%'), [u'Quick, 50% off!'])
+        self.assertEqual(self.search(u'%'), [u'Quick, 50% off!'])
+
+    def test_filters(self):
+        self.assertEqual(self.search(u'quick', channel=u'#A', nick=u'bob'),
+                         [u'The quick brown fox'])
+        self.assertEqual(self.search(u'quick', since=datetime(2011, 1, 2)),
+                         [u'Quick, 50% off!', u'a quick-witted reply'])
+        self.assertEqual(self.search(u'quick', limit=1), [u'Quick, 50% off!'])
+
+    def test_writer(self):
+        writer = log.LogWriter()
+        writer.configure(2, 60, 65536, False, 0755, self.archive.filename)
+        writer.archive_line(datetime(2011, 1, 5), u'irc', u'#a', u'joe',
+                            u'action', u'is quick')
+        writer.stop()
+        self.assertEqual(self.search(u'quick', nick=u'joe'),
+                         [u'is quick', u'a quick-witted reply'])
+
+# vi: set et sta sw=4 ts=4:
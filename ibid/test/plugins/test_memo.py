@@ -0,0 +1,82 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from twisted.trial import unittest
+
+import ibid
+import ibid.test
+from ibid.db import EventSession
+from ibid.event import Event
+from ibid.plugins import memo
+
+class TestPendingMemos(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        memo.Memo.__table__.create(engine)
+        self.session = sessionmaker(bind=engine)()
+        for to_id in (1, 1, 2, 3):
+            self.session.add(memo.Memo(10, to_id, u'hello'))
+        delivered = memo.Memo(10, 3, u'old news')
+        delivered.delivered = True
+        self.session.add(delivered)
+        self.session.commit()
+
+        self.config = ibid.config
+        ibid.test.set_config({u'plugins': {}})
+        self.pending_memos = memo.pending_memos
+        memo.pending_memos = self.pending = memo.PendingMemos()
+
+    def tearDown(self):
+        self.session.close()
+        memo.pending_memos = self.pending_memos
+        ibid.config = self.config
+
+    def event(self, identities, type=u'message'):
+        event = Event(u'test', type)
+        event.identities = identities
+        event.session = EventSession(self.session, False)
+        event.sender['connection'] = u'user'
+        event.public = False
+        return event
+
+    def test_load(self):
+        self.assertEqual(self.pending.counts, None)
+        self.assertEqual(self.pending.count(self.event((1,))), 2)
+        self.assertEqual(self.pending.counts, {1: 2, 2: 1, 3: 1})
+        self.assertEqual(self.pending.count(self.event((1, 2, 3))), 4)
+        self.assertEqual(self.pending.count(self.event((4,))), 0)
+
+    def test_add_remove(self):
+        self.pending.add(1)
+        self.assertEqual(self.pending.counts, None)
+        self.pending.load(self.session)
+        self.pending.add(1)
+        self.pending.add(4, 2)
+        self.pending.remove(2)
+        self.pending.remove(3, 5)
+        self.assertEqual(self.pending.counts, {1: 3, 4: 2})
+        self.assertEqual(self.pending.count(self.event((1, 2))), 3)
+        self.assertEqual(self.pending.count(self.event((2, 3, 4))), 2)
+
+    def test_skip(self):
+        self.pending.load(self.session)
+        self.pending.remove(1, 2)
+
+        event = self.event((1,))
+        memo.Deliver(u'memo').deliver(event)
+        self.assertEqual(event.responses, [])
+
+        event = self.event((1,), u'state')
+        event.state = u'online'
+        memo.Notify(u'memo').state(event)
+        self.assertEqual(event.responses, [])
+
+        event = self.event((1, 2), u'state')
+        event.state = u'online'
+        memo.Notify(u'memo').state(event)
+        self.assertEqual(len(event.responses), 1)
+
+# vi: set et sta sw=4 ts=4:
@@ -0,0 +1,68 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.trial import unittest
+
+from ibid.plugins.rfc import RFCIndex
+
+index_text = """\
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+                           RFC INDEX
+                         -------------
+
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+0001 Host Software. S. Crocker. April 1969. (Format: TXT=21088 bytes)
+     (Status: UNKNOWN)
+
+0002 Not Issued.
+
+0793 Transmission Control Protocol. J. Postel. September 1981.
+     (Format: TXT=172710 bytes) (Updated by RFC1122, RFC3168)
+     (Also STD0007) (Status: STANDARD)
+
+1180 TCP/IP tutorial. T.J. Socolofsky, C.J. Kale. January 1991.
+     (Format: TXT=65494 bytes) (Status: INFORMATIONAL)
+"""
+
+class TestRFCIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.filename = os.path.join(self.dir, 'rfc-index.txt')
+        f = open(self.filename, 'w')
+        f.write(index_text)
+        f.close()
+        self.index = RFCIndex.parse(self.filename)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_parse(self):
+        self.assertEqual(sorted(self.index.records), [1, 2, 793, 1180])
+        self.assertEqual(self.index.records[2], u'Not Issued.')
+
+    def test_search(self):
+        self.assertEqual(self.index.search([u'tcp']), [1180])
+        self.assertEqual(self.index.search([u'TRANSMISSION', u'protocol']),
+                         [793])
+        self.assertEqual(self.index.search([u'transmis']), [793])
+        self.assertEqual(self.index.search([u'mission', u'OCOL']), [793])
+        self.assertEqual(self.index.search([u'cp']), [1180])
+        self.assertEqual(self.index.search([u'p/i']), [1180])
+        self.assertEqual(self.index.search([u'tcp/ip']), [1180])
+        self.assertEqual(self.index.search([u'control', u'tcp']), [])
+
+    def test_save(self):
+        cachefile = os.path.join(self.dir, 'rfc-index.pickle')
+        self.index.save(cachefile)
+        index = RFCIndex.load(cachefile)
+        self.assertEqual(index.mtime, self.index.mtime)
+        self.assertEqual(index.search([u'crocker']), [1])
+
+# vi: set et sta sw=4 ts=4:
@@ -0,0 +1,91 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from twisted.trial import unittest
+
+import ibid
+from ibid.db import IntegrityError
+from ibid.test import FakeConfig
+from ibid.plugins.seen import Sighting, SightingBuffer
+
+class TestSightingBuffer(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Sighting.__table__.create(engine)
+        self.databases = ibid.databases
+        ibid.databases = FakeConfig({
+            'ibid': scoped_session(sessionmaker(bind=engine)),
+        })
+        self.session = ibid.databases.ibid()
+        self.buffer = SightingBuffer()
+        self.time = datetime(2011, 1, 1)
+
+    def tearDown(self):
+        self.session.close()
+        ibid.databases = self.databases
+
+    def stored(self):
+        self.session.expire_all()
+        return sorted((s.identity_id, s.type, s.channel, s.value, s.count)
+                      for s in self.session.query(Sighting).all())
+
+    def add(self, identity_id, type=u'message', minutes=0, value=u'hi',
+            **channel):
+        return self.buffer.add(identity_id, type,
+                               self.time + timedelta(minutes=minutes),
+                               value, **channel)
+
+    def test_buffering(self):
+        self.assertEqual(self.add(1, channel=u'#a'), 1)
+        self.assertEqual(self.add(1, minutes=1, value=u'bye'), 1)
+        self.assertEqual(self.add(1, u'state', value=u'online'), 2)
+        self.assertEqual(self.stored(), [])
+        self.buffer.flush()
+        self.assertEqual(self.stored(), [
+            (1, u'message', u'#a', u'bye', 2),
+            (1, u'state', None, u'online', 1),
+        ])
+        self.add(1, minutes=2, channel=u'#b')
+        self.buffer.flush()
+        self.assertEqual(self.stored(), [
+            (1, u'message', u'#b', u'hi', 3),
+            (1, u'state', None, u'online', 1),
+        ])
+
+    def test_requeue(self):
+        def race(session, pending):
+            raise IntegrityError('INSERT', {}, Exception())
+        self.buffer._write = race
+        self.add(1, channel=u'#a')
+        self.buffer.flush()
+        del self.buffer._write
+        self.add(1, minutes=1, value=u'bye')
+        self.buffer.flush()
+        self.assertEqual(self.stored(), [(1, u'message', u'#a', u'bye', 2)])
+
+    def test_read_through(self):
+        self.add(1, channel=u'#a')
+        self.add(2, u'state', value=u'away')
+        self.buffer.flush()
+        self.add(1, minutes=1, value=u'bye')
+        self.add(3)
+        sightings = self.buffer.sightings(self.session, [1, 2])
+        sightings = sorted((s['identity_id'], s['type'], s['channel'],
+                            s['value'], s['time'], s['count'])
+                           for s in sightings)
+        self.assertEqual(sightings, [
+            (1, u'message', u'#a', u'bye', self.time + timedelta(minutes=1),
+             2),
+            (2, u'state', None, u'away', self.time, 1),
+        ])
+        self.assertEqual(self.stored(), [
+            (1, u'message', u'#a', u'hi', 1),
+            (2, u'state', None, u'away', 1),
+        ])
+
+# vi: set et sta sw=4 ts=4:
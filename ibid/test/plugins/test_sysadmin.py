@@ -0,0 +1,70 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.trial import unittest
+
+from ibid.plugins.sysadmin import OUIIndex
+
+registries = {
+    'oui.txt': """\
+00-22-72   (hex)\t\tAmerican Micro-Fuel Device Corp.
+002272     (base 16)\t\tAmerican Micro-Fuel Device Corp.
+\t\t\t\t2181 Buchanan Loop
+
+F8-02-78   (hex)\t\tIEEE Registration Authority
+F80278     (base 16)\t\tIEEE Registration Authority
+""",
+    'mam.txt': """\
+F8-02-78   (hex)\t\tDigatron Power Electronics GmbH
+300000-3FFFFF     (base 16)\t\tDigatron Power Electronics GmbH
+""",
+    'oui36.txt': """\
+F8-02-78   (hex)\t\tTiny Devices Ltd
+3AB000-3ABFFF     (base 16)\t\tTiny Devices Ltd
+""",
+}
+
+class TestOUIIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        filenames = []
+        for name, data in registries.iteritems():
+            filename = os.path.join(self.dir, name)
+            f = open(filename, 'w')
+            f.write(data)
+            f.close()
+            filenames.append(filename)
+        self.index = OUIIndex(os.path.join(self.dir, 'oui.idx'))
+        self.index.build(filenames)
+
+    def tearDown(self):
+        self.index.map.close()
+        rmtree(self.dir)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.count, 4)
+        self.assertEqual(self.index.lookup('002272aabbcc'),
+                         'American Micro-Fuel Device Corp.')
+        self.assertEqual(self.index.lookup('0022730000'), None)
+
+    def test_longest_prefix(self):
+        self.assertEqual(self.index.lookup('F80278123456'),
+                         'IEEE Registration Authority')
+        self.assertEqual(self.index.lookup('F80278312345'),
+                         'Digatron Power Electronics GmbH')
+        self.assertEqual(self.index.lookup('F802783AB123'),
+                         'Tiny Devices Ltd')
+
+    def test_reopen(self):
+        index = OUIIndex(self.index.filename)
+        index.open()
+        self.assertEqual(index.lookup('f8027830'),
+                         'Digatron Power Electronics GmbH')
+        index.map.close()
+
+# vi: set et sta sw=4 ts=4:
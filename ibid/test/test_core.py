@@ -1,12 +1,20 @@
 # Copyright (c) 2010, Jeremy Thurgood
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 from datetime import datetime, timedelta
+from threading import Event as ThreadEvent, Thread
+from time import sleep
 
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
 
 import ibid
+import ibid.test
 from ibid import core, event
+from ibid.db import EventSession
+from ibid.db.models import Identity
+from ibid.plugins import Processor, handler, match, periodic
 
 
 def _defer_cb(dfr, *args, **kw):
@@ -27,6 +35,47 @@ class TestProcessor(object):
         self.proc_func(event)
 
 
+class TestSavepoint(object):
+    """
+    A savepoint stub, that records what was done to it in its session.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.is_active = True
+
+    def commit(self):
+        self.session.calls.append('release')
+
+    def rollback(self):
+        self.session.calls.append('rollback to savepoint')
+
+
+class TestSession(object):
+    """
+    A database session stub, that records what was done to it.
+    """
+    def __init__(self):
+        self.calls = []
+        self.new = self.dirty = self.deleted = ()
+
+    def begin_nested(self):
+        self.calls.append('savepoint')
+        return TestSavepoint(self)
+
+    def flush(self):
+        ibid.db._before_flush(self, None, None)
+        self.calls.append('flush')
+
+    def commit(self):
+        self.calls.append('commit')
+
+    def rollback(self):
+        self.calls.append('rollback')
+
+    def close(self):
+        self.calls.append('close')
+
+
 class TestSource(object):
     """
     A source object stub.
@@ -417,4 +466,552 @@ class TestDispatcher(unittest.TestCase):
         self.dispatcher.call_later(0.01, _cl, ev)
         return dfr
 
+    def _add_asynchronous_processor(self, method):
+        "Add a processor whose asynchronous handler is method."
+        def prc(e):
+            e.setdefault('asynchronous', []).append((method, (u'foo',)))
+        self._add_processor(prc)
+
+    def test_dispatch_asynchronous_deferred(self):
+        "Later processors wait for an asynchronous handler's Deferred."
+        class Async(object):
+            def reply(self, event, text):
+                d = defer.Deferred()
+                d.addCallback(lambda _: event.addresponse(text))
+                _defer_cb(d, None)
+                return d
+        self._add_asynchronous_processor(Async().reply)
+        def prc(e):
+            e.addresponse(u'after %i', len(e.responses))
+        self._add_processor(prc)
+        def _cb(_ev, _self):
+            _self.assertEqual([u'foo', u'after 1'],
+                              [r['reply'] for r in _ev.responses])
+        return self._dispatch_and_assert(_cb, self._ev())
+
+    def test_dispatch_asynchronous_generator(self):
+        "Generator handlers are run like inlineCallbacks."
+        class Async(object):
+            def reply(self, event, text):
+                d = defer.Deferred()
+                _defer_cb(d, text.upper())
+                result = yield d
+                event.addresponse(result)
+        self._add_asynchronous_processor(Async().reply)
+        def _cb(_ev, _self):
+            _self.assertEqual([u'FOO'], [r['reply'] for r in _ev.responses])
+        return self._dispatch_and_assert(_cb, self._ev())
+
+    def test_dispatch_asynchronous_failure(self):
+        "Failed asynchronous handlers cause complaints."
+        class Async(object):
+            def reply(self, event, text):
+                return defer.fail(IOError(text))
+        self._add_asynchronous_processor(Async().reply)
+        def _cb(_ev, _self):
+            _self.assertEqual(u'network', _ev.complain)
+            _self.assertEqual(True, _ev.processed)
+        return self._dispatch_and_assert(_cb, self._ev())
+
+    def _ev_session(self, deferred=True):
+        "Create an event with a stub session."
+        ev = self._ev()
+        session = TestSession()
+        ev['session'] = EventSession(session, deferred)
+        return ev, session
+
+    def test_unit_of_work_default(self):
+        "Processors' commits aren't deferred by default."
+        self.assertEqual(False, self.dispatcher.unit_of_work)
+
+    def test_process_single_commit(self):
+        "Commits by several processors become a single commit."
+        ev, session = self._ev_session()
+        def prc(e):
+            e.session.commit()
+        self._add_processor(prc)
+        self._add_processor(prc)
+        pev = self.dispatcher._process(ev)
+        self.assertEqual(['savepoint', 'flush', 'release',
+                          'savepoint', 'flush', 'release',
+                          'commit', 'close'], session.calls)
+        self.assertTrue('session' not in pev)
+
+    def test_process_read_only(self):
+        "A session that was only read from is closed without committing."
+        ev, session = self._ev_session()
+        self._add_processor(lambda e: e.session)
+        self.dispatcher._process(ev)
+        self.assertEqual(['close'], session.calls)
+
+    def test_process_broken_processor_session(self):
+        "A processor that dies without using the session doesn't roll back."
+        ev, session = self._ev_session()
+        def prc(e):
+            e.session.commit()
+        def broken(e):
+            assert False
+        self._add_processor(prc)
+        self._add_processor(broken)
+        self.dispatcher._process(ev)
+        self.assertEqual(['savepoint', 'flush', 'release', 'commit', 'close'],
+                         session.calls)
+
+    def test_process_broken_processor_rollback(self):
+        "A processor that dies using the session only loses its own changes."
+        ev, session = self._ev_session()
+        def prc(e):
+            e.session.commit()
+        def broken(e):
+            e.session.commit()
+            assert False
+        self._add_processor(prc)
+        self._add_processor(broken)
+        self.dispatcher._process(ev)
+        self.assertEqual(['savepoint', 'flush', 'release',
+                          'savepoint', 'flush', 'rollback to savepoint',
+                          'commit', 'close'], session.calls)
+
+    def test_process_processor_rollback(self):
+        "A processor rolling back the session keeps earlier changes."
+        ev, session = self._ev_session()
+        def prc(e):
+            e.session.commit()
+        def rollback(e):
+            e.session.rollback()
+        self._add_processor(prc)
+        self._add_processor(rollback)
+        self.dispatcher._process(ev)
+        self.assertEqual(['savepoint', 'flush', 'release',
+                          'commit', 'close'], session.calls)
+
+    def test_process_after_commit(self):
+        "Callbacks are called after the commit, unless rolled back."
+        ev, session = self._ev_session()
+        def prc(e):
+            e.session.commit()
+            e.session.after_commit(session.calls.append, 'kept')
+        def broken(e):
+            e.session.after_commit(session.calls.append, 'dropped')
+            assert False
+        self._add_processor(prc)
+        self._add_processor(broken)
+        self.dispatcher._process(ev)
+        self.assertEqual(['savepoint', 'flush', 'release',
+                          'commit', 'kept', 'close'], session.calls)
+
+    def test_process_immediate_commit(self):
+        "Without unit of work, processors commit, and failures roll back."
+        ev, session = self._ev_session(deferred=False)
+        def prc(e):
+            e.session.commit()
+            e.session.after_commit(session.calls.append, 'called')
+        def broken(e):
+            e.session.after_commit(session.calls.append, 'dropped')
+            assert False
+        self._add_processor(prc)
+        self._add_processor(broken)
+        self.dispatcher._process(ev)
+        self.assertEqual(['commit', 'rollback', 'close'], session.calls)
+
+class TestDispatchQueues(unittest.TestCase):
+    """
+    Test the DispatchQueues class.
+    """
+
+    def setUp(self):
+        self.processed = []
+        self.gate = ThreadEvent()
+        self.gate.set()
+
+    def tearDown(self):
+        self.gate.set()
+        self.queues.stop()
+
+    def _process(self, ev):
+        self.gate.wait()
+        self.processed.append(ev.n)
+        return ev
+
+    def _queues(self, **kw):
+        self.queues = core.DispatchQueues(self._process, **kw)
+        return self.queues
+
+    def _ev(self, n, type='testmessage', channel='#chan'):
+        ev = event.Event('fakesource', type)
+        ev.channel = channel
+        ev.n = n
+        return ev
+
+    def test_order(self):
+        "Events in the same queue are processed in order."
+        queues = self._queues(threads=4)
+        dfrs = [queues.put(self._ev(n)) for n in range(10)]
+        def _cb(results, _self):
+            _self.assertEqual(range(10), _self.processed)
+            _self.assertEqual(range(10), [ev.n for ok, ev in results])
+            _self.assertEqual(10, queues.stats()['processed'])
+        return defer.DeferredList(dfrs).addCallback(_cb, self)
+
+    def test_coalesce(self):
+        "Waiting events of coalesced types aren't duplicated."
+        queues = self._queues(coalesce=('clock',))
+        self.gate.clear()
+        dfrs = [queues.put(self._ev(n, 'clock')) for n in range(3)]
+        self.assertEqual(1, queues.stats()['coalesced'])
+        self.gate.set()
+        def _cb(results, _self):
+            _self.assertEqual([0, 1], _self.processed)
+        return defer.DeferredList(dfrs).addCallback(_cb, self)
+
+    def test_high_water(self):
+        "Events are dropped when a queue is full."
+        queues = self._queues(limit=1)
+        self.gate.clear()
+        dfrs = [queues.put(self._ev(n)) for n in range(3)]
+        dfrs.append(queues.put(self._ev(3, channel='#other')))
+        stats = queues.stats()
+        self.assertEqual(1, stats['dropped'])
+        self.assertEqual(1, stats['max_depth'])
+        self.gate.set()
+        def _cb(results, _self):
+            _self.assertEqual([0, 1, 3], sorted(_self.processed))
+        return defer.DeferredList(dfrs).addCallback(_cb, self)
+
+class TestPeriodicScheduler(unittest.TestCase):
+    """
+    Test the PeriodicScheduler class.
+    """
+
+    def setUp(self):
+        self.config = ibid.config
+        ibid.test.set_config({u'plugins': {}})
+        self.calls = []
+        self.dfr = dfr = defer.Deferred()
+        calls = self.calls
+
+        class Poller(Processor):
+            @handler
+            def handle(self, event):
+                pass
+
+            @periodic(interval=1, initial_delay=0)
+            def poll(self, event):
+                calls.append(event)
+                reactor.callFromThread(dfr.callback, event)
+
+            @periodic(interval=0)
+            def never(self, event):
+                calls.append(event)
+
+        ibid.processors[:] = [Poller(u'poller')]
+        ibid.dispatcher = core.Dispatcher()
+        self.scheduler = core.PeriodicScheduler(u'timer', jitter=0)
+
+    def tearDown(self):
+        self.scheduler.stop()
+        ibid.dispatcher.shutdown()
+        ibid.dispatcher = None
+        ibid.processors[:] = []
+        ibid.config = self.config
+
+    def test_due_handler(self):
+        "Due handlers are run with a clock event from the scheduler."
+        tm = datetime.now()
+        self.scheduler.start()
+        def _cb(ev, _self):
+            _self.assertTrue(tm + timedelta(seconds=1) <= datetime.now())
+            _self.assertEqual(u'timer', ev.source)
+            _self.assertEqual(u'clock', ev.type)
+            _self.assertEqual(1, len(_self.calls))
+        return self.dfr.addCallback(_cb, self)
+
+    def test_clock_responses(self):
+        "Periodic handlers' responses are sent, skipping the processors."
+        processed = []
+        class Recorder(Processor):
+            event_types = (u'clock',)
+            addressed = False
+            processed = True
+            @handler
+            def record(self, event):
+                processed.append(event)
+        ibid.processors.append(Recorder(u'recorder'))
+        sent = defer.Deferred()
+        class Source(object):
+            def send(self, response):
+                sent.callback(response)
+        ibid.sources[u'testsource'] = Source()
+        class Announcer(Processor):
+            @periodic(interval=1, initial_delay=0)
+            def announce(self, event):
+                event.addresponse(u'news', source=u'testsource')
+        ibid.processors.append(Announcer(u'announcer'))
+        self.scheduler.start()
+        def _cb(response, _self):
+            del ibid.sources[u'testsource']
+            _self.assertEqual(u'news', response['reply'])
+            _self.assertEqual([], processed)
+        return sent.addCallback(_cb, self)
+    test_clock_responses.timeout = 10
+
+    def test_no_clock_processing(self):
+        "Processors don't run periodic handlers from clock events."
+        ev = event.Event(u'timer', u'clock')
+        ev.time = datetime.utcnow()
+        ibid.dispatcher._process(ev)
+        self.assertEqual([], self.calls)
+
+class TestLiteralPrefix(unittest.TestCase):
+    """
+    Test the extraction of literal prefixes from @match patterns.
+    """
+
+    def test_prefixes(self):
+        "Anchored literal text is extracted, in lower case."
+        for regex, prefix in (
+                (r'^karma\s+for\s+(.+)$', u'karma'),
+                (r'^RFC\s*(\d+)$', u'rfc'),
+                (r'^seen (\S+)$', u'seen '),
+                (r'^version$', u'version'),
+                (r'^what\?$', u'what?'),
+                (r'^colou?r$', u'colo'),
+                (r'^dispatch\s+stat(?:istic)?s$', u'dispatch'),
+            ):
+            self.assertEqual(prefix, core.literal_prefix(regex), regex)
+
+    def test_no_prefixes(self):
+        "Patterns without a definite literal start have no prefix."
+        for regex in (
+                r'karma',
+                r'^(?:re)?load\s+(\S+)$',
+                r'^lsmod|list\s+plugins$',
+                r'^\s*foo$',
+                r'^x?foo$',
+                r'^foo bar(?x)$',
+            ):
+            self.assertEqual(None, core.literal_prefix(regex), regex)
+
+    def test_alternation_in_groups(self):
+        "Alternation inside groups and classes doesn't prevent prefixes."
+        self.assertEqual(u'load',
+                core.literal_prefix(r'^load\s+(foo|bar)$'))
+        self.assertEqual(u'tell',
+                core.literal_prefix(r'^tell\s+[|a]$'))
+
+class TestDispatchIndex(unittest.TestCase):
+    """
+    Test the DispatchIndex class.
+    """
+
+    def setUp(self):
+        self.config = ibid.config
+        ibid.test.set_config({u'plugins': {}})
+        self.calls = []
+        calls = self.calls
+
+        class Karma(Processor):
+            @match(r'^karma\s+for\s+(.+)$')
+            def karma(self, event, subject):
+                calls.append(('karma', subject))
+
+            @match(r'^(.+)\+\+$')
+            def inc(self, event, subject):
+                calls.append(('inc', subject))
+
+        class Clock(Processor):
+            event_types = (u'clock',)
+            addressed = False
+
+            @handler
+            def tick(self, event):
+                calls.append(('tick',))
+
+        ibid.processors[:] = [Karma(u'karma'), Clock(u'clock')]
+        ibid.dispatch_index = self.index = core.DispatchIndex(ibid.processors)
+        self.dispatcher = core.Dispatcher()
+
+    def tearDown(self):
+        ibid.processors[:] = []
+        ibid.dispatch_index = None
+        ibid.config = self.config
+
+    def _ev(self, message, type=u'message'):
+        ev = event.Event(u'fakesource', type)
+        ev.addressed = True
+        ev.message = {'clean': message}
+        return ev
+
+    def test_prefix_match(self):
+        "Handlers are called as normal when their prefix matches."
+        self.dispatcher._process(self._ev(u'Karma for ibid'))
+        self.assertEqual([('karma', u'ibid')], self.calls)
+        stats = self.index.stats()[u'message']
+        self.assertEqual(1, stats['events'])
+        self.assertEqual(1, stats['processors'])
+        self.assertEqual(2, stats['regexes'])
+        self.assertEqual(0, stats['skipped'])
+
+    def test_prefix_mismatch(self):
+        "Prefixed handlers aren't regex-tested on other messages."
+        self.dispatcher._process(self._ev(u'ibid++'))
+        self.assertEqual([('inc', u'ibid')], self.calls)
+        stats = self.index.stats()[u'message']
+        self.assertEqual(1, stats['regexes'])
+        self.assertEqual(1, stats['skipped'])
+
+    def test_event_type_filter(self):
+        "Processors are only called for their event types."
+        self.dispatcher._process(self._ev(u'karma for ibid', u'clock'))
+        self.assertEqual([('tick',)], self.calls)
+        self.assertEqual(1, self.index.stats()[u'clock']['processors'])
+
+    def test_processed_fallthrough(self):
+        "Processors that don't want processed events don't get them."
+        ev = self._ev(u'karma for ibid')
+        ev.processed = True
+        self.dispatcher._process(ev)
+        self.assertEqual([], self.calls)
+
+    def test_unaddressed(self):
+        "Addressed processors don't see unaddressed events."
+        ev = self._ev(u'karma for ibid')
+        ev.addressed = False
+        self.dispatcher._process(ev)
+        self.assertEqual([], self.calls)
+
+class TestSQLite(unittest.TestCase):
+    """
+    Test the SQLite connection tuning.
+    """
+
+    def setUp(self):
+        self.connection = core.sqlite_creator(self.mktemp(),
+                                              {'busy_timeout': 100})()
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_pragmas(self):
+        "Connections are opened with the configured pragmas."
+        self.assertEqual('wal', self.connection.execute(
+                'PRAGMA journal_mode').fetchone()[0].lower())
+        self.assertEqual(1, self.connection.execute(
+                'PRAGMA synchronous').fetchone()[0])
+
+    def test_regexp(self):
+        "REGEXP is case-insensitive."
+        self.assertEqual(1, self.connection.execute(
+                "SELECT 'Foo Bar' REGEXP 'foo\\s'").fetchone()[0])
+        self.assertEqual(0, self.connection.execute(
+                "SELECT 'Foo Bar' REGEXP '^bar'").fetchone()[0])
+
+    def test_thread_connections(self):
+        "Threads' connections stay open while they run, and no longer."
+        config = ibid.config
+        options = ibid.options
+        ibid.config = ibid.test.FakeConfig({
+            'databases': {'ibid': 'sqlite:///' + self.mktemp()},
+            'debugging': {},
+        })
+        ibid.options = {'base': '.'}
+        try:
+            session = core.DatabaseManager(False)['ibid']
+        finally:
+            ibid.config = config
+            ibid.options = options
+        session().execute('SELECT 1')
+
+        errors = []
+        def connect():
+            try:
+                session().execute('SELECT 1')
+                sleep(0.01)
+                session().execute('SELECT 1')
+            except Exception, e:
+                errors.append(e)
+            session.remove()
+        threads = [Thread(target=connect) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual([(1,)], session().execute('SELECT 1').fetchall())
+
+        # Finished threads' connections are closed when a new one is opened
+        thread = Thread(target=connect)
+        thread.start()
+        thread.join()
+        self.assertEqual(2, len(session().bind.pool._all_conns))
+        self.assertEqual([], errors)
+        self.assertEqual([(1,)], session().execute('SELECT 1').fetchall())
+        session.remove()
+
+    def test_savepoints(self):
+        "Rolling back a processor's savepoint keeps earlier changes."
+        engine = create_engine('sqlite:///',
+                creator=core.sqlite_creator(self.mktemp()))
+        core.sqlite_savepoints(engine)
+        engine.execute('CREATE TABLE t (x INTEGER)')
+        session = EventSession(sessionmaker(bind=engine)())
+        session.use()
+        session.execute('INSERT INTO t VALUES (1)')
+        session.commit()
+        session.release()
+        session.use()
+        session.execute('INSERT INTO t VALUES (2)')
+        session.commit()
+        session.discard()
+        session.finish()
+        session.close()
+        self.assertEqual([(1,)],
+                         engine.execute('SELECT x FROM t').fetchall())
+
+    def _orm_session(self, path):
+        engine = create_engine('sqlite:///', creator=core.sqlite_creator(path))
+        core.sqlite_savepoints(engine)
+        Identity.__table__.create(engine)
+        return EventSession(sessionmaker(bind=engine)())
+
+    def test_lazy_savepoint(self):
+        "Unflushed changes by a failed processor are rolled back too."
+        session = self._orm_session(self.mktemp())
+        session.use()
+        session.add(Identity(u'test', u'joe'))
+        session.release()
+        session.use()
+        identity = session.query(Identity).first()
+        self.assertEqual(None, session.savepoint)
+        identity.identity = u'bob'
+        session.query(Identity).filter_by(identity=u'bob').first()
+        self.assertNotEqual(None, session.savepoint)
+        session.discard()
+        session.use()
+        session.add(Identity(u'test', u'ann'))
+        session.discard()
+        session.finish()
+        self.assertEqual([u'joe'], [identity.identity for identity
+                                    in session.query(Identity).all()])
+        session.close()
+
+    def test_read_only(self):
+        "Reading doesn't begin a transaction, which would keep a snapshot."
+        path = self.mktemp()
+        session = self._orm_session(path)
+        session.use()
+        self.assertEqual([], session.query(Identity).all())
+        session.release()
+        self.assertEqual(None, session.savepoint)
+        self.connection.close()
+        self.connection = core.sqlite_creator(path, {'busy_timeout': 100})()
+        self.connection.execute("INSERT INTO identities (source, identity) "
+                                "VALUES ('test', 'joe')")
+        self.connection.commit()
+        session.use()
+        self.assertEqual(1, session.query(Identity).count())
+        session.finish()
+        session.close()
+
 # vi: set et sta sw=4 ts=4:
@@ -0,0 +1,109 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from gzip import GzipFile
+from StringIO import StringIO
+from threading import Thread
+from urllib2 import HTTPError
+
+from twisted.internet import reactor
+from twisted.trial import unittest
+
+from ibid.utils.http import HTTPClient
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/plain')
+            body = ''
+        elif self.path == '/missing':
+            self.send_response(404)
+            body = 'Not found'
+        else:
+            self.send_response(200)
+            body = 'Hello ' * 100
+            if self.path == '/gzip':
+                buffer = StringIO()
+                gzipper = GzipFile(fileobj=buffer, mode='w')
+                gzipper.write(body)
+                gzipper.close()
+                body = buffer.getvalue()
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(HTTPServer):
+
+    def handle_error(self, request, client_address):
+        pass
+
+class TestHTTPClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%i' % self.server.server_port
+        self.client = HTTPClient()
+        self.client.configure(timeout=5)
+
+    def tearDown(self):
+        reactor.removeSystemEventTrigger(self.client._trigger)
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keepalive(self):
+        for i in range(3):
+            response = self.client.request(self.url + '/plain')
+            self.assertEqual(response.read(), 'Hello ' * 100)
+        stats = self.client.stats()['127.0.0.1:%i' % self.server.server_port]
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['reused'], 2)
+
+    def test_gzip(self):
+        response = self.client.request(self.url + '/gzip')
+        self.assertEqual(response.read(), 'Hello ' * 100)
+        self.assertEqual(response.headers.get('content-encoding'), None)
+
+    def test_max_size(self):
+        response = self.client.request(self.url + '/plain', max_size=10)
+        self.assertEqual(response.read(), 'Hello Hell')
+        self.assertEqual(self.client.pools, {})
+
+    def test_redirect(self):
+        response = self.client.request(self.url + '/redirect')
+        self.assertEqual(response.geturl(), self.url + '/plain')
+        self.assertRaises(HTTPError, self.client.request,
+                          self.url + '/redirect', redirects=0)
+        response = self.client.request(self.url + '/redirect', redirects=0,
+                                       raise_errors=False)
+        self.assertEqual(response.status, 302)
+
+    def test_error(self):
+        self.assertRaises(HTTPError, self.client.request,
+                          self.url + '/missing')
+        response = self.client.request(self.url + '/missing',
+                                       raise_errors=False)
+        self.assertEqual(response.status, 404)
+
+    def test_fetch(self):
+        def check(response):
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.read(), 'Hello ' * 100)
+        return self.client.fetch(self.url + '/gzip').addCallback(check)
+
+    def test_fetch_error(self):
+        d = self.client.fetch(self.url + '/missing')
+        return self.assertFailure(d, HTTPError)
+
+# vi: set et sta sw=4 ts=4:
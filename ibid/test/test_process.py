@@ -0,0 +1,50 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from twisted.trial import unittest
+
+from ibid.utils.process import ProcessPool, ProcessTimeout
+
+class TestProcessPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ProcessPool()
+        self.pool.configure(max_processes=2, timeout=5, max_output=100)
+
+    def tearDown(self):
+        return self.pool.close()
+
+    def test_spawn(self):
+        def check(result):
+            self.assertEqual(result, ('hello\n', 'oops\n', 3))
+            self.assertEqual(self.pool.stats()['sh']['runs'], 1)
+        return self.pool.spawn(['sh', '-c', 'cat; echo oops >&2; exit 3'],
+                               'hello\n').addCallback(check)
+
+    def test_timeout(self):
+        d = self.pool.spawn(['sleep', '10'], timeout=0.1)
+        return self.assertFailure(d, ProcessTimeout)
+
+    def test_max_output(self):
+        def check(result):
+            self.assertEqual(len(result[0]), 100)
+            self.assertEqual(self.pool.stats()['head']['truncated'], 1)
+        return self.pool.spawn(['head', '-c', '1000', '/dev/zero']) \
+                .addCallback(check)
+
+    def test_helper(self):
+        def request(input):
+            return self.pool.helper('sh', ['sh'], 'echo %s\n', input)
+        def check(result, expected):
+            self.assertEqual(result, expected)
+        d = request('echo hello\n')
+        d.addCallback(check, ('hello\n', ''))
+        d.addCallback(lambda result: request('echo world; echo oops >&2\n'))
+        d.addCallback(check, ('world\n', 'oops\n'))
+        d.addCallback(lambda result: request('exit\n'))
+        d = self.assertFailure(d, Exception)
+        d.addCallback(lambda result: request('echo again\n'))
+        d.addCallback(check, ('again\n', ''))
+        return d
+
+# vi: set et sta sw=4 ts=4:
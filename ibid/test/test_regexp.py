@@ -0,0 +1,72 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from sqlite3 import dbapi2 as sqlite
+
+from sqlalchemy import create_engine, Table, Column, MetaData, Unicode
+from sqlalchemy.orm import sessionmaker
+from twisted.trial import unittest
+
+from ibid.db import get_regexp_op
+from ibid.db.regexp import required_literal, RegexpTimeout, SQLRegexp
+
+class TestRequiredLiteral(unittest.TestCase):
+
+    def test_literals(self):
+        self.assertEqual(required_literal(u'Foo'), u'foo')
+        self.assertEqual(required_literal(u'^foo\\b bar.*baz$'), u'foo bar')
+        self.assertEqual(required_literal(u'a+ (x|y) hello'), u' hello')
+
+    def test_non_ascii(self):
+        self.assertEqual(required_literal(u'\xc9mile'), u'mile')
+        self.assertEqual(required_literal(u'caf\xe9s'), u'caf')
+        self.assertEqual(required_literal(u'\xe9\xe8'), None)
+
+    def test_no_literal(self):
+        for pattern in (u'foo|bar', u'[abc]+', u'(?u)foo', u'(unclosed'):
+            self.assertEqual(required_literal(pattern), None)
+
+class TestSQLRegexp(unittest.TestCase):
+
+    def setUp(self):
+        self.regexp = SQLRegexp()
+        self.regexp.configure(cache_size=2, timeout=0.000001)
+        self.connection = sqlite.connect(':memory:')
+        self.connection.create_function('regexp', 2, self.regexp)
+        self.connection.execute('CREATE TABLE t (value TEXT)')
+        self.connection.executemany('INSERT INTO t VALUES (?)',
+                                    [(u'value %i' % i,) for i in range(5000)])
+
+    def tearDown(self):
+        self.connection.close()
+
+    def count(self, pattern):
+        return self.connection.execute(
+                'SELECT count(*) FROM t WHERE value REGEXP ?',
+                (pattern,)).fetchone()[0]
+
+    def test_search(self):
+        self.assertEqual(self.count(u'^VALUE 12.$'), 10)
+        self.assertEqual(self.count(u'9$'), 500)
+        self.assertEqual(self.count(u'x'), 0)
+        self.assertEqual(len(self.regexp.cache), 1)
+
+    def test_prefilter(self):
+        engine = create_engine('sqlite://')
+        connection = engine.connect()
+        connection.connection.create_function('regexp', 2, self.regexp)
+        table = Table('t', MetaData(), Column('value', Unicode))
+        table.create(connection)
+        connection.execute(table.insert(), value=u'\xc9mile Zola')
+        op = get_regexp_op(sessionmaker(bind=engine)())
+        self.assertEqual(1, len(connection.execute(table.select(
+                op(table.c.value, u'\xc9mile'))).fetchall()))
+        connection.close()
+
+    def test_timeout(self):
+        def slow():
+            return self.count(u'(a|.)*(b|.)*$')
+        self.assertRaises(RegexpTimeout, self.regexp.limit, slow)
+        self.assertEqual(self.count(u'^value 1$'), 1)
+
+# vi: set et sta sw=4 ts=4:
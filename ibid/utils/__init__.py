@@ -2,21 +2,16 @@
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
 import codecs
-from gzip import GzipFile
 from htmlentitydefs import name2codepoint
 import logging
 import os
 import os.path
 import re
-import socket
-from StringIO import StringIO
-from sys import version_info
 from threading import Lock
 import time
 from urllib import urlencode, quote
 import urllib2
 from urlparse import urlparse, urlunparse
-import zlib
 from subprocess import Popen, PIPE
 
 import dateutil.parser
@@ -66,72 +61,52 @@ def cacheable_download(url, cachefile, headers={}, timeout=60):
 
     return f
 
-def _cacheable_download(url, cachefile, headers={}, timeout=60):
+def cache_path(cachefile):
+    """Return the full filename of cachefile, in the configured cachedir,
+    creating its directory if necessary"""
     # We do allow absolute paths, for people who know what they are doing,
     # but the common use case should be pluginname/cachefile.
-    if cachefile[0] not in (os.sep, os.altsep):
-        cachedir = ibid.config.plugins.get('cachedir', None)
-        if not cachedir:
-            cachedir = os.path.join(ibid.options['base'], 'cache')
-        elif cachedir[0] == "~":
-            cachedir = os.path.expanduser(cachedir)
-        cachedir = os.path.abspath(cachedir)
+    if cachefile[0] in (os.sep, os.altsep):
+        return cachefile
 
-        plugindir = os.path.join(cachedir, os.path.dirname(cachefile))
-        if not os.path.isdir(plugindir):
-            os.makedirs(plugindir)
+    cachedir = ibid.config.plugins.get('cachedir', None)
+    if not cachedir:
+        cachedir = os.path.join(ibid.options['base'], 'cache')
+    elif cachedir[0] == "~":
+        cachedir = os.path.expanduser(cachedir)
+    cachedir = os.path.abspath(cachedir)
 
-        cachefile = os.path.join(cachedir, cachefile)
+    plugindir = os.path.join(cachedir, os.path.dirname(cachefile))
+    if not os.path.isdir(plugindir):
+        os.makedirs(plugindir)
 
-    exists = os.path.isfile(cachefile)
+    return os.path.join(cachedir, cachefile)
 
-    req = urllib2.Request(url_to_bytestring(url))
-    for name, value in headers.iteritems():
-        req.add_header(name, value)
-    if not req.has_header('user-agent'):
-        req.add_header('User-Agent', 'Ibid/' + (ibid_version() or 'dev'))
+def _cacheable_download(url, cachefile, headers={}, timeout=60):
+    cachefile = cache_path(cachefile)
+    exists = os.path.isfile(cachefile)
 
+    headers = dict(headers)
     if exists:
         if os.path.isfile(cachefile + '.etag'):
             f = file(cachefile + '.etag', 'r')
-            req.add_header("If-None-Match", f.readline().strip())
+            headers['If-None-Match'] = f.readline().strip()
             f.close()
         else:
             modified = os.path.getmtime(cachefile)
             modified = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(modified))
-            req.add_header("If-Modified-Since", modified)
+            headers['If-Modified-Since'] = modified
 
-    kwargs = {}
-    if version_info[1] >= 6:
-        kwargs['timeout'] = timeout
-    else:
-        socket.setdefaulttimeout(timeout)
-    try:
-        try:
-            connection = urllib2.urlopen(req, **kwargs)
-        except urllib2.HTTPError, e:
-            if e.code == 304 and exists:
-                return cachefile
-            else:
-                raise
-    finally:
-        if version_info[1] < 6:
-            socket.setdefaulttimeout(None)
+    from ibid.utils.http import http_client
+    connection = http_client.request(url, headers=headers, timeout=timeout)
+    if connection.status == 304:
+        if exists:
+            return cachefile
+        raise urllib2.HTTPError(connection.url, connection.status,
+                                connection.reason, connection.headers, None)
 
     data = connection.read()
 
-    compression = connection.headers.get('content-encoding')
-    if compression:
-        if compression.lower() == "deflate":
-            try:
-                data = zlib.decompress(data)
-            except zlib.error:
-                data = zlib.decompress(data, -zlib.MAX_WBITS)
-        elif compression.lower() == "gzip":
-            compressedstream = StringIO(data)
-            gzipper = GzipFile(fileobj=compressedstream)
-            data = gzipper.read()
-
     etag = connection.headers.get('etag')
     if etag:
         f = file(cachefile + '.etag', 'w')
@@ -235,29 +210,34 @@ def url_regex():
 def is_url(url):
     return re.match('^' + url_regex() + '$', url, re.I) is not None
 
-def generic_webservice(url, params={}, headers={}):
-    "Retreive data from a webservice"
+def generic_webservice(url, params={}, headers={}, ttl=None):
+    """Retreive data from a webservice.
+    If ttl is set, responses are cached for that many seconds."""
 
     for key in params:
         if isinstance(params[key], unicode):
             params[key] = params[key].encode('utf-8')
 
     if params:
-        url = url_to_bytestring(url) + '?' + urlencode(params)
+        url = url_to_bytestring(url) + '?' + urlencode(sorted(params.items()))
 
-    req = urllib2.Request(url, headers=headers)
-    if not req.has_header('user-agent'):
-        req.add_header('User-Agent', 'Ibid/' + (ibid_version() or 'dev'))
+    from ibid.utils.http import http_client
+    def fetch():
+        return http_client.request(url, headers=headers).read()
 
-    f = urllib2.urlopen(req)
-    data = f.read()
-    f.close()
-    return data
+    if not ttl:
+        return fetch()
+
+    from ibid.utils.cache import response_cache
+    key = url
+    if headers:
+        key += '\n' + urlencode(sorted(headers.items()))
+    return response_cache.get(key, ttl, fetch)
 
-def json_webservice(url, params={}, headers={}):
+def json_webservice(url, params={}, headers={}, ttl=None):
     "Request data from a JSON webservice, and deserialise"
 
-    data = generic_webservice(url, params, headers)
+    data = generic_webservice(url, params, headers, ttl)
     try:
         return json.loads(data)
     except ValueError, e:
@@ -0,0 +1,347 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+import anydbm
+import cPickle
+import logging
+from threading import Lock
+from time import time
+
+from twisted.internet import reactor
+
+import ibid
+from ibid.compat import hashlib
+
+log = logging.getLogger('utils.cache')
+
+class LRUCache(object):
+    """A thread-safe mapping that holds at most size items, evicting the least
+    recently used first.
+    If ttl is set, items expire ttl seconds after they were stored.
+    Hits, misses, and evictions are counted.
+    """
+
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+        self._items = {}
+        self._tick = 0
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            item = self._items.get(key)
+            if item is not None and self.ttl is not None \
+                    and time() - item[1] > self.ttl:
+                del self._items[key]
+                item = None
+
+            if item is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._tick += 1
+            item[2] = self._tick
+            return item[0]
+        finally:
+            self.lock.release()
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.lock.acquire()
+        try:
+            self._tick += 1
+            self._items[key] = [value, time(), self._tick]
+            if len(self._items) > self.size:
+                self._evict()
+        finally:
+            self.lock.release()
+
+    def _evict(self):
+        "Drop the least recently used tenth of the cache. Hold the lock."
+        keep = int(self.size * 0.9)
+        items = sorted(self._items.iteritems(), key=lambda item: item[1][2])
+        for key, item in items[:len(items) - keep]:
+            del self._items[key]
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        self.lock.acquire()
+        try:
+            del self._items[key]
+        finally:
+            self.lock.release()
+
+    def pop(self, key, default=None):
+        self.lock.acquire()
+        try:
+            item = self._items.pop(key, None)
+            if item is None:
+                return default
+            return item[0]
+        finally:
+            self.lock.release()
+
+    def discard(self, keys):
+        "Remove all of keys that are present"
+        self.lock.acquire()
+        try:
+            for key in keys:
+                self._items.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        self.lock.acquire()
+        try:
+            item = self._items.get(key)
+            return item is not None and (self.ttl is None
+                                         or time() - item[1] <= self.ttl)
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self._items)
+
+    def items(self):
+        "Return a snapshot list of (key, value) pairs"
+        self.lock.acquire()
+        try:
+            return [(key, item[0]) for key, item in self._items.iteritems()]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self._items.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        "Return a dict of the cache's size and counters"
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+_missing = object()
+
+class ResponseCache(object):
+    """A cache of web service responses, shared between plugins.
+    Responses are held in an LRUCache, and optionally in a dbm file, so
+    they survive restarts. The file is keyed by a hash of the key, so that
+    the URLs (and any credentials in them) aren't stored, and holds up to
+    store_size responses that haven't expired yet.
+    A response that has expired less than stale seconds ago is returned
+    while a fresh copy is fetched in the background.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.memory = None
+        self.store = None
+        self.store_count = 0
+        self.refreshing = set()
+        self._trigger = None
+        self.hits = self.misses = self.stale_hits = self.stores = 0
+
+    def configure(self, size=None, stale=None, max_item_size=None,
+                  store=None, store_size=None):
+        "Apply the [http] configuration section, overridden by arguments"
+        config = ibid.config and ibid.config.get('http', {}) or {}
+        if stale is None:
+            stale = config.get('cache_stale', 600)
+        if store is None:
+            store = config.get('cache_store', False) in (True, 'True', 'true')
+        self.stale = int(stale)
+        self.max_item_size = int(max_item_size
+                                 or config.get('cache_max_item_size', 65536))
+        self.store_size = int(store_size
+                              or config.get('cache_store_size', 5000))
+        self.memory = LRUCache(int(size or config.get('cache_size', 500)))
+
+        self.close()
+        if store:
+            from ibid.utils import cache_path
+            filename = cache_path('http/responses')
+            self.lock.acquire()
+            try:
+                try:
+                    self.store = anydbm.open(filename, 'c')
+                    self._prune()
+                    if self._trigger is None:
+                        self._trigger = reactor.addSystemEventTrigger(
+                                'during', 'shutdown', self.close)
+                except anydbm.error, e:
+                    log.warning(u"Couldn't open response cache %s: %s",
+                                filename, e)
+            finally:
+                self.lock.release()
+
+    def get(self, key, ttl, fetch):
+        """Return the value of key, if it was stored less than ttl seconds
+        ago, otherwise the result of calling fetch(), which is stored.
+        """
+        if self.memory is None:
+            self.configure()
+        if not ttl or ttl < 0:
+            return fetch()
+
+        item = self._lookup(key)
+        now = time()
+        if item is not None:
+            stored, value = item
+            if now - stored <= ttl:
+                self._count('hits')
+                return value
+            if now <= self._expires(stored, ttl):
+                self._count('stale_hits')
+                self._refresh(key, ttl, fetch)
+                return value
+
+        self._count('misses')
+        value = fetch()
+        self.set(key, value, ttl)
+        return value
+
+    def set(self, key, value, ttl=0):
+        """Store value under key. In the file, it is kept until it has been
+        stale for as long as get() would return it, after ttl seconds."""
+        if self.memory is None:
+            self.configure()
+        item = (time(), value)
+        pickled = cPickle.dumps(item + (self._expires(item[0], ttl),),
+                                cPickle.HIGHEST_PROTOCOL)
+        if len(pickled) > self.max_item_size:
+            return
+        self.memory[key] = item
+        self.lock.acquire()
+        try:
+            self.stores += 1
+            if self.store is not None:
+                key = self._store_key(key)
+                if not self.store.has_key(key):
+                    self.store_count += 1
+                self.store[key] = pickled
+                if self.store_count > self.store_size:
+                    self._prune()
+        finally:
+            self.lock.release()
+
+    def _expires(self, stored, ttl):
+        "When a response stored with ttl stops being returned while stale"
+        return stored + ttl + min(ttl, self.stale)
+
+    def _lookup(self, key):
+        item = self.memory.get(key)
+        if item is not None or self.store is None:
+            return item
+        self.lock.acquire()
+        try:
+            pickled = self.store.get(self._store_key(key))
+        finally:
+            self.lock.release()
+        if pickled is None:
+            return None
+        try:
+            item = cPickle.loads(pickled)[:2]
+        except Exception:
+            return None
+        self.memory[key] = item
+        return item
+
+    def _store_key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+
+    def _prune(self):
+        """Drop expired responses from the file, and the oldest ones beyond
+        store_size. Hold the lock."""
+        now = time()
+        live = []
+        for key in self.store.keys():
+            try:
+                stored, value, expires = cPickle.loads(self.store[key])
+            except Exception:
+                expires = None
+            if expires is None or expires < now:
+                del self.store[key]
+            else:
+                live.append((stored, key))
+
+        if len(live) > self.store_size:
+            live.sort()
+            keep = int(self.store_size * 0.9)
+            for stored, key in live[:len(live) - keep]:
+                del self.store[key]
+            del live[:len(live) - keep]
+        self.store_count = len(live)
+
+    def _refresh(self, key, ttl, fetch):
+        self.lock.acquire()
+        try:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        finally:
+            self.lock.release()
+
+        def refresh():
+            try:
+                try:
+                    self.set(key, fetch(), ttl)
+                except Exception, e:
+                    log.debug(u'Failed to refresh %s: %s', key, e)
+            finally:
+                self.lock.acquire()
+                try:
+                    self.refreshing.discard(key)
+                finally:
+                    self.lock.release()
+
+        reactor.callFromThread(reactor.callInThread, refresh)
+
+    def _count(self, counter):
+        self.lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.store is not None:
+                self.store.close()
+                self.store = None
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        "Return the cache's counters and hit rate"
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'size': self.memory is not None and len(self.memory) or 0,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'hit_rate': lookups and float(self.hits + self.stale_hits)
+                                    / lookups or 0.0,
+        }
+
+response_cache = ResponseCache()
+
+# vi: set et sta sw=4 ts=4:
@@ -3,16 +3,12 @@
 
 import cgi
 import inspect
-import zlib
-import urllib3
-from gzip import GzipFile
-from io import StringIO
 
 from html5lib import HTMLParser, treebuilders
 from bs4 import BeautifulSoup
 
 from ibid.compat import ElementTree
-from ibid.utils import url_to_bytestring
+from ibid.utils.http import http_client
 
 class ContentTypeException(Exception):
     pass
@@ -20,8 +16,7 @@ class ContentTypeException(Exception):
 def get_html_parse_tree(url, data=None, headers={}, treetype='beautifulsoup'):
     "Request a URL, parse with html5lib, and return a parse tree from it"
 
-    req = urllib3.Request(url_to_bytestring(url), data, headers)
-    f = urllib3.urlopen(req)
+    f = http_client.request(url, data, headers)
 
     if f.info().gettype() not in ('text/html', 'application/xhtml+xml'):
         f.close()
@@ -36,18 +31,6 @@ def get_html_parse_tree(url, data=None, headers={}, treetype='beautifulsoup'):
         (mediaType, params) = cgi.parse_header(contentType)
         encoding = params.get('charset')
 
-    compression = f.headers.get('content-encoding')
-    if compression:
-        if compression.lower() == "deflate":
-            try:
-                data = zlib.decompress(data)
-            except zlib.error:
-                data = zlib.decompress(data, -zlib.MAX_WBITS)
-        elif compression.lower() == "gzip":
-            compressedstream = StringIO(data)
-            gzipper = GzipFile(fileobj=compressedstream)
-            data = gzipper.read()
-
     if treetype == "beautifulsoup":
         return BeautifulSoup(data, convertEntities=BeautifulSoup.HTML_ENTITIES)
     elif treetype == "etree":
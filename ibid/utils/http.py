@@ -0,0 +1,369 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+"""A shared HTTP client, which keeps connections to each host alive between
+requests."""
+
+from gzip import GzipFile
+import httplib
+import logging
+import socket
+from StringIO import StringIO
+from sys import version_info
+from threading import Lock, Semaphore
+from time import time
+from urllib import getproxies_environment
+from urllib2 import HTTPError, URLError
+from urlparse import urljoin, urlparse, urlunparse
+import zlib
+
+from twisted.internet import defer, reactor
+from twisted.web import error as web_error
+from twisted.web.client import HTTPClientFactory
+
+import ibid
+from ibid.utils import ibid_version, url_to_bytestring
+
+log = logging.getLogger('utils.http')
+
+def decode_content(data, encoding):
+    "Undo a gzip or deflate Content-Encoding"
+    if encoding:
+        encoding = encoding.lower()
+        if encoding == 'deflate':
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                return zlib.decompress(data, -zlib.MAX_WBITS)
+        elif encoding in ('gzip', 'x-gzip'):
+            return GzipFile(fileobj=StringIO(data)).read()
+    return data
+
+class HTTPResponse(object):
+    """A response that has been read in full.
+    Looks enough like a urllib2 response for existing callers.
+    """
+
+    def __init__(self, url, status, reason, headers, data):
+        self.url = url
+        self.status = self.code = status
+        self.reason = self.msg = reason
+        self.headers = headers
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def getheaders(self):
+        return self.headers.items()
+
+class HTTPClient(object):
+    """Makes HTTP requests over pools of keep-alive connections, one pool
+    per host.
+    Responses are transparently decompressed, and redirects followed.
+    The number of concurrent requests is limited, and the latency of each
+    host's requests is recorded.
+    """
+
+    redirect_codes = (301, 302, 303, 307)
+    retry_methods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pools = {}
+        self.hosts = {}
+        self.semaphore = None
+        self.pool_size = 4
+        self.timeout = 60
+        self.idle_timeout = 15
+        self._trigger = None
+
+    def configure(self, pool_size=None, max_requests=None, timeout=None,
+                  idle_timeout=None):
+        "Apply the [http] configuration section, overridden by arguments"
+        config = ibid.config and ibid.config.get('http', {}) or {}
+        self.pool_size = int(pool_size or config.get('pool_size', 4))
+        self.timeout = float(timeout or config.get('timeout', 60))
+        self.idle_timeout = float(idle_timeout
+                                  or config.get('idle_timeout', 15))
+        max_requests = int(max_requests or config.get('max_requests', 16))
+        self.semaphore = Semaphore(max_requests)
+        self.deferred_semaphore = defer.DeferredSemaphore(max_requests)
+        if self._trigger is None:
+            self._trigger = reactor.addSystemEventTrigger(
+                    'during', 'shutdown', self.close)
+
+    def _headers(self, headers, data, compressed=True):
+        headers = dict((name.title(), value)
+                       for name, value in headers.iteritems())
+        headers.setdefault('User-Agent', 'Ibid/' + (ibid_version() or 'dev'))
+        if compressed:
+            headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        if data is not None:
+            headers.setdefault('Content-Type',
+                               'application/x-www-form-urlencoded')
+        return headers
+
+    def request(self, url, data=None, headers={}, method=None, timeout=None,
+                max_size=None, redirects=5, raise_errors=True):
+        """Request url and return an HTTPResponse.
+        If max_size is given, at most that many bytes of the body are read.
+        HTTP errors, and redirects beyond the limit, raise urllib2.HTTPError,
+        unless raise_errors is False, and connection errors raise
+        urllib2.URLError.
+        """
+        if self.semaphore is None:
+            self.configure()
+
+        if isinstance(url, unicode):
+            url = url_to_bytestring(url)
+        if method is None:
+            method = data is None and 'GET' or 'POST'
+        method = method.upper()
+        headers = self._headers(headers, data, max_size is None)
+
+        while True:
+            response = self._request(url, method, data, headers,
+                                     timeout or self.timeout, max_size)
+            location = response.headers.get('location')
+            if response.status not in self.redirect_codes or not location:
+                break
+            if redirects <= 0:
+                if raise_errors:
+                    raise HTTPError(url, response.status, u'Too many '
+                            u'redirects: %s' % response.reason,
+                            response.headers, StringIO(response.data))
+                break
+            redirects -= 1
+            url = urljoin(url, location)
+            if response.status == 303 or method == 'POST':
+                method = method != 'HEAD' and 'GET' or 'HEAD'
+                data = None
+                headers.pop('Content-Type', None)
+
+        if raise_errors and response.status >= 400:
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, StringIO(response.data))
+        return response
+
+    def _request(self, url, method, data, headers, timeout, max_size):
+        scheme, netloc, path, params, query = urlparse(url)[:5]
+        scheme = scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise URLError(u'Unsupported URL scheme: %s' % scheme)
+        host = netloc.rsplit('@', 1)[-1].lower()
+        proxy = getproxies_environment().get(scheme)
+        if proxy and scheme == 'http':
+            selector = url
+        else:
+            selector = urlunparse(('', '', path or '/', params, query, ''))
+        key = (scheme, host, proxy)
+
+        semaphore = self.semaphore
+        semaphore.acquire()
+        start = time()
+        try:
+            for attempt in (1, 2):
+                conn, reused = self._connection(key, timeout)
+                try:
+                    conn.request(method, selector, data, headers)
+                    response = conn.getresponse()
+                    if max_size is None:
+                        body = response.read()
+                    else:
+                        body = response.read(max_size)
+                except (socket.error, httplib.HTTPException), e:
+                    conn.close()
+                    # The server may have dropped an idle connection
+                    if reused and attempt == 1 \
+                            and method in self.retry_methods:
+                        continue
+                    self._record(host, start, error=True)
+                    if isinstance(e, socket.error):
+                        raise URLError(e)
+                    raise
+                break
+        finally:
+            semaphore.release()
+
+        if response.isclosed() and not response.will_close:
+            self._release(key, conn)
+        else:
+            conn.close()
+        self._record(host, start, reused=reused)
+
+        headers = response.msg
+        if response.isclosed() and headers.get('content-encoding'):
+            body = decode_content(body, headers['content-encoding'])
+            del headers['content-encoding']
+        log.debug(u'%s %s: %i in %.3fs', method, url, response.status,
+                  time() - start)
+        return HTTPResponse(url, response.status, response.reason, headers,
+                            body)
+
+    def fetch(self, url, data=None, headers={}, method=None, timeout=None,
+              redirects=5):
+        """Request url without blocking, for asynchronous handlers.
+        Must be called in the reactor thread. Returns a Deferred that fires
+        with an HTTPResponse, or fails like request().
+        """
+        if self.semaphore is None:
+            self.configure()
+
+        if isinstance(url, unicode):
+            url = url_to_bytestring(url)
+        if method is None:
+            method = data is None and 'GET' or 'POST'
+        return self.deferred_semaphore.run(self._fetch, url, data,
+                self._headers(headers, data), method.upper(),
+                timeout or self.timeout, redirects)
+
+    def _fetch(self, url, data, headers, method, timeout, redirects):
+        host = urlparse(url)[1].rsplit('@', 1)[-1].lower()
+        factory = HTTPClientFactory(url, method=method, postdata=data,
+                headers=headers, agent=headers.pop('User-Agent'),
+                timeout=timeout, redirectLimit=redirects + 1)
+        if factory.scheme == 'https':
+            from twisted.internet import ssl
+            reactor.connectSSL(factory.host, factory.port, factory,
+                               ssl.ClientContextFactory())
+        else:
+            reactor.connectTCP(factory.host, factory.port, factory)
+
+        start = time()
+        def headers():
+            return httplib.HTTPMessage(StringIO(''.join(
+                    '%s: %s\r\n' % (name, value) for name, values
+                    in (factory.response_headers or {}).iteritems()
+                    for value in values)))
+
+        def succeeded(data):
+            self._record(host, start)
+            response_headers = headers()
+            if response_headers.get('content-encoding'):
+                data = decode_content(data, response_headers['content-encoding'])
+                del response_headers['content-encoding']
+            log.debug(u'%s %s: %s in %.3fs', method, factory.url,
+                      factory.status, time() - start)
+            return HTTPResponse(factory.url, int(factory.status),
+                                factory.message, response_headers, data)
+
+        def failed(failure):
+            if not failure.check(web_error.Error):
+                self._record(host, start, error=True)
+                return failure
+            self._record(host, start)
+            e = failure.value
+            response = HTTPResponse(factory.url, int(e.status), e.message,
+                                    headers(), e.response or '')
+            if response.status < 400:
+                return response
+            raise HTTPError(response.url, response.status, response.reason,
+                            response.headers, StringIO(response.data))
+
+        return factory.deferred.addCallbacks(succeeded, failed)
+
+    def _connection(self, key, timeout):
+        "Return an idle (connection, True), or a new (connection, False)"
+        now = time()
+        self.lock.acquire()
+        try:
+            pool = self.pools.get(key, [])
+            while pool:
+                conn, used = pool.pop()
+                if now - used < self.idle_timeout and conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        finally:
+            self.lock.release()
+
+        scheme, host, proxy = key
+        kwargs = {}
+        if version_info[1] >= 6:
+            kwargs['timeout'] = timeout
+        if proxy:
+            conn_host = urlparse(proxy)[1]
+        else:
+            conn_host = host
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(conn_host, **kwargs)
+            if proxy:
+                conn.set_tunnel(host)
+        else:
+            conn = httplib.HTTPConnection(conn_host, **kwargs)
+        if version_info[1] < 6:
+            socket.setdefaulttimeout(timeout)
+            try:
+                conn.connect()
+            finally:
+                socket.setdefaulttimeout(None)
+        return conn, False
+
+    def _release(self, key, conn):
+        self.lock.acquire()
+        try:
+            pool = self.pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append((conn, time()))
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def _record(self, host, start, error=False, reused=False):
+        elapsed = time() - start
+        self.lock.acquire()
+        try:
+            stats = self.hosts.get(host)
+            if stats is None:
+                stats = self.hosts[host] = {'requests': 0, 'errors': 0,
+                        'reused': 0, 'time': 0.0, 'max_time': 0.0}
+            stats['requests'] += 1
+            stats['errors'] += error and 1 or 0
+            stats['reused'] += reused and 1 or 0
+            stats['time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        "Close all idle connections"
+        self.lock.acquire()
+        try:
+            pools = self.pools
+            self.pools = {}
+        finally:
+            self.lock.release()
+        for pool in pools.itervalues():
+            for conn, used in pool:
+                conn.close()
+
+    def stats(self):
+        "Return request counts and latencies, per host"
+        self.lock.acquire()
+        try:
+            stats = {}
+            for host, host_stats in self.hosts.iteritems():
+                stats[host] = dict(host_stats)
+                stats[host]['mean_time'] = \
+                        host_stats['time'] / host_stats['requests']
+            return stats
+        finally:
+            self.lock.release()
+
+http_client = HTTPClient()
+
+# vi: set et sta sw=4 ts=4:
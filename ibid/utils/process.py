@@ -0,0 +1,340 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+"""A shared service for running external commands from the reactor, without
+tying up dispatcher threads."""
+
+import logging
+import os
+from random import randint
+from threading import Lock
+from time import time
+
+from twisted.internet import defer, error, protocol, reactor
+from twisted.internet.threads import blockingCallFromThread
+from twisted.python.threadable import isInIOThread
+
+import ibid
+from ibid.utils import get_process_output
+
+log = logging.getLogger('utils.process')
+
+class ProcessTimeout(Exception):
+    "Raised when a command takes longer than its timeout"
+    pass
+
+class ProcessFailed(Exception):
+    "Raised when a helper process exits unexpectedly"
+    pass
+
+class _OutputProtocol(protocol.ProcessProtocol):
+    """Collect a process's output, up to max_output bytes of each stream,
+    and fire deferred with (output, error, code) when it exits.
+    Any further output is discarded.
+    """
+
+    def __init__(self, deferred, input, max_output):
+        self.deferred = deferred
+        self.input = input
+        self.max_output = max_output
+        self.output = []
+        self.error = []
+        self.sizes = {'output': 0, 'error': 0}
+        self.timed_out = False
+        self.truncated = False
+        self.timer = None
+        self.killer = None
+
+    def connectionMade(self):
+        if self.input:
+            self.transport.write(self.input)
+        self.transport.closeStdin()
+
+    def _received(self, name, data):
+        room = self.max_output - self.sizes[name]
+        if len(data) > room:
+            self.truncated = True
+            data = data[:room]
+        if data:
+            getattr(self, name).append(data)
+            self.sizes[name] += len(data)
+
+    def outReceived(self, data):
+        self._received('output', data)
+
+    def errReceived(self, data):
+        self._received('error', data)
+
+    def kill(self, signal='TERM'):
+        try:
+            self.transport.signalProcess(signal)
+        except error.ProcessExitedAlready:
+            return
+        if signal != 'KILL':
+            self.killer = reactor.callLater(2, self.kill, 'KILL')
+
+    def timeout(self):
+        self.timer = None
+        self.timed_out = True
+        self.kill()
+
+    def processEnded(self, reason):
+        for call in (self.timer, self.killer):
+            if call is not None and call.active():
+                call.cancel()
+        if self.timed_out:
+            self.deferred.errback(ProcessTimeout())
+        else:
+            code = reason.value.exitCode
+            if code is None:
+                code = -(reason.value.signal or 0)
+            self.deferred.callback((''.join(self.output),
+                                    ''.join(self.error), code))
+
+class _HelperProtocol(protocol.ProcessProtocol):
+    "Pass a helper process's events on to its HelperProcess"
+
+    def __init__(self, helper):
+        self.helper = helper
+        self.ended = defer.Deferred()
+
+    def outReceived(self, data):
+        if self.helper.process is self:
+            self.helper.outReceived(data)
+
+    def errReceived(self, data):
+        if self.helper.process is self:
+            self.helper.errReceived(data)
+
+    def processEnded(self, reason):
+        if self.helper.process is self:
+            self.helper.process = None
+            self.helper._finish(failure=ProcessFailed(
+                    u'%s exited' % self.helper.command[0]))
+        self.ended.callback(None)
+
+class HelperProcess(object):
+    """A long-lived interactive process, which answers one request at a time.
+    Each request is followed by a command that prints a unique marker,
+    which shows where its output ends. The process is restarted if it
+    exits, or a request times out.
+    """
+
+    def __init__(self, command, marker_command, env=None):
+        self.command = command
+        self.marker_command = marker_command
+        self.env = env
+        self.process = None
+        self.queue = defer.DeferredLock()
+        self.pending = None
+
+    def request(self, input, timeout, max_output):
+        "Return a Deferred that fires with (output, error) for input"
+        return self.queue.run(self._request, input, timeout, max_output)
+
+    def _request(self, input, timeout, max_output):
+        if self.process is None:
+            self.process = _HelperProtocol(self)
+            reactor.spawnProcess(self.process, self.command[0], self.command,
+                                 self.env is None and os.environ or self.env)
+        marker = 'ibid-%i' % randint(0, 1 << 30)
+        self.pending = {
+            'deferred': defer.Deferred(),
+            'marker': '%s\n' % marker,
+            'output': '',
+            'error': '',
+            'max_output': max_output,
+            'timer': reactor.callLater(timeout, self._timeout),
+        }
+        self.process.transport.write(input + self.marker_command % marker)
+        return self.pending['deferred']
+
+    def _finish(self, result=None, failure=None, pending=None):
+        if pending is not None and pending is not self.pending:
+            return
+        pending, self.pending = self.pending, None
+        if pending is None:
+            return
+        if pending['timer'].active():
+            pending['timer'].cancel()
+        if failure is not None:
+            pending['deferred'].errback(failure)
+        else:
+            pending['deferred'].callback(result)
+
+    def _complete(self, pending):
+        self._finish((pending['output'][:-len(pending['marker'])],
+                      pending['error']), pending=pending)
+
+    def _timeout(self):
+        self.kill()
+        self._finish(failure=ProcessTimeout())
+
+    def outReceived(self, data):
+        pending = self.pending
+        if pending is None:
+            return
+        pending['output'] += data
+        if len(pending['output']) > pending['max_output'] + 100:
+            self.kill()
+            self._finish(failure=ProcessFailed(u'Too much output'))
+            return
+        output = pending['output']
+        if output.endswith(pending['marker']):
+            # Let any error output written before the marker arrive first
+            reactor.callLater(0, self._complete, pending)
+
+    def errReceived(self, data):
+        if self.pending is not None:
+            self.pending['error'] += data
+
+    def kill(self):
+        "Kill the process, returning a Deferred that fires when it has exited"
+        process, self.process = self.process, None
+        if process is None:
+            return defer.succeed(None)
+        try:
+            process.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+        return process.ended
+
+class ProcessPool(object):
+    """Runs commands from the reactor, limiting how many run at once, how
+    long they can take, and how much output is kept.
+    Time spent and failures are recorded for each command.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.semaphore = None
+        self.commands = {}
+        self.helpers = {}
+        self.timeout = 30
+        self.max_output = 65536
+
+    def configure(self, max_processes=None, timeout=None, max_output=None):
+        "Apply the [processes] configuration section, overridden by arguments"
+        config = ibid.config and ibid.config.get('processes', {}) or {}
+        self.timeout = float(timeout or config.get('timeout', 30))
+        self.max_output = int(max_output or config.get('max_output', 65536))
+        self.semaphore = defer.DeferredSemaphore(
+                int(max_processes or config.get('max_processes', 4)))
+
+    def spawn(self, command, input=None, timeout=None, max_output=None,
+              env=None):
+        """Run command, a list of arguments, feeding it input.
+        Must be called in the reactor thread. Returns a Deferred that fires
+        with (output, error, exit code), or fails with ProcessTimeout.
+        """
+        if self.semaphore is None:
+            self.configure()
+        command = [isinstance(arg, unicode) and arg.encode('utf-8') or arg
+                   for arg in command]
+        return self.semaphore.run(self._spawn, command, input,
+                                  timeout or self.timeout,
+                                  max_output or self.max_output, env)
+
+    def _spawn(self, command, input, timeout, max_output, env):
+        d = defer.Deferred()
+        process = _OutputProtocol(d, input, max_output)
+        start = time()
+        try:
+            reactor.spawnProcess(process, command[0], command,
+                                 env is None and os.environ or env)
+        except (OSError, IOError), e:
+            self._record(command[0], start, error=True)
+            return defer.fail(e)
+        process.timer = reactor.callLater(timeout, process.timeout)
+
+        def finished(result):
+            self._record(command[0], start, error=result[2] != 0,
+                         truncated=process.truncated)
+            return result
+        def failed(failure):
+            self._record(command[0], start, error=True,
+                         timed_out=failure.check(ProcessTimeout) is not None)
+            return failure
+        return d.addCallbacks(finished, failed)
+
+    def run(self, command, input=None, timeout=None, max_output=None,
+            env=None):
+        """Like spawn(), but block until the command finishes, for handlers
+        running in dispatcher threads.
+        """
+        if isInIOThread():
+            # We can't wait for the reactor from its own thread
+            return get_process_output(command, input)
+        return blockingCallFromThread(reactor, self.spawn, command, input,
+                                      timeout, max_output, env)
+
+    def helper(self, name, command, marker_command, input, timeout=None,
+               max_output=None, env=None):
+        """Send input to the long-lived helper process name, started with
+        command, and return a Deferred that fires with (output, error).
+        marker_command is formatted with a marker string, and must make the
+        helper print that marker on a line of its own.
+        Must be called in the reactor thread.
+        """
+        if self.semaphore is None:
+            self.configure()
+        helper = self.helpers.get(name)
+        if helper is None or helper.command != command:
+            if helper is not None:
+                helper.kill()
+            helper = self.helpers[name] = HelperProcess(command,
+                                                        marker_command, env)
+        start = time()
+        d = helper.request(input, timeout or self.timeout,
+                           max_output or self.max_output)
+        def finished(result):
+            self._record(name, start, helper=True)
+            return result
+        def failed(failure):
+            self._record(name, start, error=True, helper=True,
+                         timed_out=failure.check(ProcessTimeout) is not None)
+            return failure
+        return d.addCallbacks(finished, failed)
+
+    def _record(self, name, start, error=False, timed_out=False,
+                truncated=False, helper=False):
+        elapsed = time() - start
+        self.lock.acquire()
+        try:
+            stats = self.commands.get(name)
+            if stats is None:
+                stats = self.commands[name] = {'runs': 0, 'errors': 0,
+                        'timeouts': 0, 'truncated': 0, 'helper_runs': 0,
+                        'time': 0.0, 'max_time': 0.0}
+            stats['runs'] += 1
+            stats['errors'] += error and 1 or 0
+            stats['timeouts'] += timed_out and 1 or 0
+            stats['truncated'] += truncated and 1 or 0
+            stats['helper_runs'] += helper and 1 or 0
+            stats['time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        "Return run counts and times, per command"
+        self.lock.acquire()
+        try:
+            stats = {}
+            for name, command_stats in self.commands.iteritems():
+                stats[name] = dict(command_stats)
+                stats[name]['mean_time'] = \
+                        command_stats['time'] / command_stats['runs']
+            return stats
+        finally:
+            self.lock.release()
+
+    def close(self):
+        "Stop all helper processes. Returns a Deferred"
+        helpers, self.helpers = self.helpers, {}
+        return defer.DeferredList([helper.kill()
+                                   for helper in helpers.itervalues()])
+
+process_pool = ProcessPool()
+
+# vi: set et sta sw=4 ts=4:
@@ -62,6 +62,7 @@ setup(
         'scripts/ibid-db',
         'scripts/ibid-factpack',
         'scripts/ibid-knab-import',
+        'scripts/ibid-logsearch',
         'scripts/ibid-memgraph',
         'scripts/ibid-objgraph',
         'scripts/ibid-pb-client',